@@ -0,0 +1,89 @@
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+from Server.MotorControllerLibs.CANControlledMotors.estop import emergency_stop
+from Server.MotorControllerLibs.CANControlledMotors.multi_axis_move import (
+    MultiAxisMove,
+)
+from Server.MotorControllerLibs.CANControlledMotors.odrivecontroller import (
+    OdriveController,
+)
+
+
+class ArmBus:
+    def __init__(self):
+        """
+        All the ODrive joints of the arm. Every node shares the one bus receiver, which routes heartbeats,
+        version replies and SDO replies to whichever node's setup is waiting for them.
+        """
+        self.controllers = {}
+        self.setup_times = {}
+
+    def setup_all(self, nodes):
+        """
+        Construct (and so set up) every joint's OdriveController at the same time instead of one after another.
+        A joint that fails doesn't stop the others, its error is reported once every setup has finished.
+        :param nodes: list of OdriveController keyword arguments, e.g. [{"id_number": 0, "gear_ratio": 50}, ...]
+        :return: dict of node id -> OdriveController, RuntimeError naming the joints that failed if any did
+        """
+        start = perf_counter()
+        with ThreadPoolExecutor(max_workers=max(1, len(nodes))) as executor:
+            futures = {
+                kwargs["id_number"]: executor.submit(OdriveController, **kwargs)
+                for kwargs in nodes
+            }
+
+        failed = {}
+        for node_id, future in futures.items():
+            try:
+                controller = future.result()
+            except Exception as e:
+                print(f"ODrive with id {node_id}: setup failed: {e}")
+                failed[node_id] = e
+                continue
+            self.controllers[node_id] = controller
+            self.setup_times[node_id] = controller.setup_time
+        if failed:
+            raise RuntimeError(
+                f"ODrive setup failed for nodes {sorted(failed)}"
+            ) from next(iter(failed.values()))
+
+        total = perf_counter() - start
+        print("ODrive setup times:")
+        for node_id, seconds in sorted(self.setup_times.items()):
+            print(f"  node {node_id}: {seconds:.2f} s")
+        print(
+            f"  all {len(futures)} nodes: {total:.2f} s "
+            f"(sequential would be ~{sum(self.setup_times[n] for n in futures):.2f} s)"
+        )
+        return dict(self.controllers)
+
+    def move(self, angles, speed_offset=1):
+        """
+        Move several joints so they all start and finish at the same time
+        :param angles: dict of node id -> angle in degrees
+        :param speed_offset: offset for the speed/accel of every joint
+        :return: the started MultiAxisMove, wait() on it to block until every joint has arrived
+        """
+        move = MultiAxisMove(
+            {self.controllers[node_id]: angle for node_id, angle in angles.items()},
+            speed_offset,
+        )
+        move.start()
+        return move
+
+    def emergency_stop(self, mode="estop", timeout=0.5, started=None):
+        """
+        Stop every joint in one burst, see estop.emergency_stop
+        :param mode: "estop" (latches ESTOP_REQUESTED) or "idle"
+        :param timeout: seconds to wait for the heartbeats confirming it
+        :param started: perf_counter() of when the stop was asked for, None for now
+        :return: the emergency_stop report, ValueError if no joint is set up
+        """
+        report = emergency_stop(list(self.controllers), mode, timeout, started)
+        for controller in self.controllers.values():
+            controller.stopped()
+        return report
+
+    def __getitem__(self, node_id):
+        return self.controllers[node_id]
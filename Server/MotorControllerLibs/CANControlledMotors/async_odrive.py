@@ -0,0 +1,863 @@
+"""
+asyncio counterparts of BusManager, OdriveController and ArmBus. Everything runs on the event loop's thread:
+replies, heartbeats and encoder messages resolve asyncio futures, so any number of reads and moves can be in
+flight without a thread each, e.g.
+    async with AsyncBus("can0") as bus:
+        arm = AsyncArm(bus)
+        await arm.setup_all([{"id_number": 0}, {"id_number": 1}])
+        positions = await asyncio.gather(*(arm[n].get_encoder_pos() for n in arm.controllers))
+        await arm.move({0: 90, 1: 45})
+Endpoints are the same prepared handles can_functions uses, CANSimple frames the same layouts as cansimple.
+"""
+
+import asyncio
+import struct
+from collections import deque
+from math import isclose
+from time import monotonic, perf_counter, time
+
+from Server.MotorControllerLibs.CANControlledMotors.bus_manager import (
+    CMD_TX_SDO,
+    OPCODE_WRITE,
+    RX_SDO_IDS,
+    SDO_REPLY_TIMEOUT,
+    arbitration_id,
+    sdo_header,
+)
+from Server.MotorControllerLibs.CANControlledMotors.can_functions import (
+    BITRATE,
+    CHANNEL,
+    INTERFACE,
+    EndpointHandle,
+    _bring_up_interface,
+    get_endpoint_data,
+    prepare_endpoint,
+)
+from Server.MotorControllerLibs.CANControlledMotors import cansimple
+from Server.MotorControllerLibs.CANControlledMotors.estop import (
+    AXIS_ERROR_ESTOP_REQUESTED,
+    STOP_FRAMES,
+)
+from Server.MotorControllerLibs.CANControlledMotors.multi_axis_move import (
+    MultiAxisMove,
+)
+from Server.MotorControllerLibs.CANControlledMotors.odrivecontroller import (
+    TELEMETRY_MAX_AGE,
+    clear_errors,
+    input_mode,
+    pos_estimate,
+    save_configuration,
+    vbus_voltage,
+    vel_estimate,
+)
+from Server.MotorControllerLibs.CANControlledMotors.shadow_registers import (
+    TRAJ_ACCEL_LIMIT,
+    TRAJ_DECEL_LIMIT,
+    TRAJ_VEL_LIMIT,
+    shadow_registers,
+)
+from Server.MotorControllerLibs.CANControlledMotors.telemetry import (
+    CYCLIC_MESSAGES,
+    telemetry,
+)
+from constants import OdriveSpeeds
+
+CMD_GET_VERSION = 0x00
+CMD_HEARTBEAT = 0x01
+CMD_ENCODER_ESTIMATES = 0x09
+
+version = struct.Struct("<BBBBBBBB")
+
+
+class AsyncBus:
+    def __init__(
+        self,
+        channel=CHANNEL,
+        interface=INTERFACE,
+        bitrate=BITRATE,
+        reply_timeout=SDO_REPLY_TIMEOUT,
+    ):
+        """
+        One CAN interface driven from the running event loop through python-can's Notifier. On SocketCAN the
+        socket is watched by the loop itself; interfaces without a file descriptor (virtual) get the Notifier's
+        reader thread, which hands every frame to the loop. Open it with start() or async with.
+        :param channel: CAN channel name
+        :param interface: python-can interface name
+        :param bitrate: bitrate the socketcan interface is brought up with
+        :param reply_timeout: seconds an SDO request waits for its reply, see bus_manager.SDO_REPLY_TIMEOUT
+        """
+        self.channel = channel
+        self.interface = interface
+        self.bitrate = bitrate
+        self.reply_timeout = reply_timeout
+        self.bus = None
+        self._notifier = None
+        self._message = None
+
+        # (node_id, endpoint_id) -> queue of (future, reply_struct, data), the first one is in flight
+        self._pending = {}
+        # (node_id, endpoint_id) -> timer handles of the request in flight
+        self._sdo_timers = {}
+        # arbitration_id -> queue of futures resolved by the next matching frame
+        self._waiters = {}
+        # arbitration_id -> list of callbacks called with every matching frame
+        self._listeners = {}
+
+    async def start(self):
+        """
+        Open the bus and start receiving
+        :return: self
+        """
+        # python-can is slow to import, so it is only imported once a bus is actually needed
+        import can
+
+        if self.interface == "socketcan":
+            _bring_up_interface(self.channel, self.bitrate)
+        self._message = can.Message
+        self.bus = can.interface.Bus(self.channel, interface=self.interface)
+        self._notifier = can.Notifier(
+            self.bus, [self._dispatch], loop=asyncio.get_running_loop()
+        )
+        return self
+
+    async def close(self):
+        """
+        Stop receiving, close the bus and cancel everything still waiting on a frame
+        :return:
+        """
+        if self._notifier is not None:
+            self._notifier.stop()
+            self._notifier = None
+        if self.bus is not None:
+            self.bus.shutdown()
+            self.bus = None
+        for timers in self._sdo_timers.values():
+            for timer in timers:
+                timer.cancel()
+        for queue in self._pending.values():
+            for future, _, _ in queue:
+                if future is not None:
+                    future.cancel()
+        for queue in self._waiters.values():
+            for future in queue:
+                future.cancel()
+        self._sdo_timers.clear()
+        self._pending.clear()
+        self._waiters.clear()
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+        return False
+
+    def send(self, arbitration_id, data):
+        """
+        Send a single standard-id frame straight away
+        :param arbitration_id: arbitration id of the frame
+        :param data: payload bytes
+        :return:
+        """
+        self.bus.send(
+            self._message(
+                arbitration_id=arbitration_id, data=data, is_extended_id=False
+            )
+        )
+
+    def send_burst(self, frames):
+        """
+        Send several frames back to back, nothing else on the loop can get in between
+        :param frames: list of (arbitration_id, data)
+        :return:
+        """
+        for arb_id, data in frames:
+            self.send(arb_id, data)
+
+    def subscribe(self, arbitration_id, callback):
+        """
+        Call callback(msg) on the loop for every frame with this arbitration id
+        :param arbitration_id: arbitration id to listen for
+        :param callback: function taking a can.Message, must not block
+        :return:
+        """
+        self._listeners.setdefault(arbitration_id, []).append(callback)
+
+    def unsubscribe(self, arbitration_id, callback):
+        """
+        Remove a callback added with subscribe
+        :param arbitration_id: arbitration id it was registered for
+        :param callback: the registered callback
+        :return:
+        """
+        listeners = self._listeners.get(arbitration_id, [])
+        if callback in listeners:
+            listeners.remove(callback)
+        if not listeners:
+            self._listeners.pop(arbitration_id, None)
+
+    def next_message(self, arbitration_id):
+        """
+        Get a future for the next frame received with this arbitration id.
+        Call before sending whatever triggers the frame so the reply can't be missed.
+        :param arbitration_id: arbitration id to wait for
+        :return: asyncio Future resolving to the can.Message
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(arbitration_id, deque()).append(future)
+        return future
+
+    def sdo_request(self, node_id, endpoint_id, data, reply_struct=None):
+        """
+        Send an RxSdo frame, optionally registering for its TxSdo reply before the frame goes out.
+        Like BusManager.sdo_request only one request per (node, endpoint) is in flight, later ones (writes
+        included) go out in order once it is answered. A request without a reply after reply_timeout fails
+        with TimeoutError and keeps its place for as long again, so its late reply is dropped.
+        :param node_id: Node id of the ODrive controller
+        :param endpoint_id: endpoint id from flat_endpoints.json
+        :param data: complete frame payload, header included
+        :param reply_struct: struct.Struct to decode the reply with (header included), None if no reply is expected
+        :return: asyncio Future resolving to the decoded value, or None if no reply is expected
+        """
+        future = None
+        if reply_struct is not None:
+            future = asyncio.get_running_loop().create_future()
+        key = (node_id, endpoint_id)
+        queue = self._pending.get(key)
+        if queue:
+            # behind the request in flight
+            queue.append((future, reply_struct, data))
+            return future
+        if future is not None:
+            self._pending[key] = deque(((future, reply_struct, data),))
+            self._start_sdo_timers(key, future)
+        self.send(RX_SDO_IDS[node_id], data)
+        return future
+
+    def _start_sdo_timers(self, key, future):
+        loop = asyncio.get_running_loop()
+        self._sdo_timers[key] = (
+            loop.call_later(self.reply_timeout, self._sdo_timed_out, future),
+            loop.call_later(2 * self.reply_timeout, self._sdo_given_up, key),
+        )
+
+    def _sdo_timed_out(self, future):
+        if not future.done():
+            future.set_exception(TimeoutError("no SDO reply"))
+
+    def _sdo_given_up(self, key):
+        # the reply is as late again as the timeout, stop waiting for it
+        self._sdo_timers.pop(key, None)
+        self._pending[key].popleft()
+        self._next_sdo(key)
+
+    def _next_sdo(self, key):
+        # send what waited behind the request that just finished: writes until the next request with a reply
+        queue = self._pending[key]
+        while queue:
+            future, _, data = queue[0]
+            if future is None:
+                queue.popleft()
+                self.send(RX_SDO_IDS[key[0]], data)
+            elif future.cancelled():
+                # given up on before it went out
+                queue.popleft()
+            else:
+                self._start_sdo_timers(key, future)
+                self.send(RX_SDO_IDS[key[0]], data)
+                break
+        if not queue:
+            del self._pending[key]
+
+    async def read(self, obj_path, node_id, timeout=None):
+        """
+        Get the value of a property
+        :param obj_path: Path (or EndpointHandle) of the property
+        :param node_id: Node id of the ODrive controller
+        :param timeout: seconds to wait for the reply, None for the bus's reply_timeout
+        :return: the value
+        """
+        handle = _handle(obj_path)
+        if handle.read_data is None:
+            raise TypeError(f"{handle.path} is a function and can't be read")
+        future = self.sdo_request(
+            node_id, handle.endpoint_id, handle.read_data, handle.reply_struct
+        )
+        return await asyncio.wait_for(future, timeout)
+
+    async def write(self, value, obj_path, node_id, return_value=False, timeout=None):
+        """
+        Write a property (or call a function)
+        :param value: What value to send, None for functions without inputs
+        :param obj_path: Path (or EndpointHandle) of the property or function
+        :param node_id: Node id of the ODrive controller
+        :param return_value: if True, wait for and return any output
+        :param timeout: seconds to wait for the reply, None for the bus's reply_timeout
+        :return: the output, or None if return_value is False
+        """
+        handle = _handle(obj_path)
+        data = (
+            handle.write_data
+            if value is None
+            else handle.write_struct.pack(OPCODE_WRITE, handle.endpoint_id, 0, value)
+        )
+        future = self.sdo_request(
+            node_id,
+            handle.endpoint_id,
+            data,
+            handle.write_reply_struct if return_value else None,
+        )
+        if future is None:
+            return None
+        return await asyncio.wait_for(future, timeout)
+
+    async def read_many(self, requests, timeout=None):
+        """
+        Read several properties at once, every request is on the wire before the first reply is awaited
+        :param requests: list of (path or EndpointHandle, node_id)
+        :param timeout: seconds to wait for each reply, None for the bus's reply_timeout
+        :return: list of values, in the order of requests
+        """
+        return await asyncio.gather(
+            *(self.read(obj_path, node_id, timeout) for obj_path, node_id in requests)
+        )
+
+    async def telemetry(self, node_ids, messages=None):
+        """
+        Decoded cyclic messages of some nodes as they arrive, e.g.
+            async for node_id, message, sample in bus.telemetry([0, 1], ["encoder"]):
+        :param node_ids: nodes to listen to
+        :param messages: message names from telemetry.CYCLIC_MESSAGES, None for all of them
+        :return: async iterator of (node_id, message name, (monotonic timestamp, *fields))
+        """
+        queue = asyncio.Queue()
+        subscriptions = []
+        for node_id in node_ids:
+            for cmd_id, (name, layout, _) in CYCLIC_MESSAGES.items():
+                if messages is None or name in messages:
+                    callback = _decoder(node_id, name, layout, queue.put_nowait)
+                    arb_id = arbitration_id(node_id, cmd_id)
+                    self.subscribe(arb_id, callback)
+                    subscriptions.append((arb_id, callback))
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            for arb_id, callback in subscriptions:
+                self.unsubscribe(arb_id, callback)
+
+    def _dispatch(self, msg):
+        if msg.is_error_frame:
+            return
+        arb_id = msg.arbitration_id
+
+        if arb_id & 0x1F == CMD_TX_SDO and len(msg.data) >= sdo_header.size:
+            _, endpoint_id, _ = sdo_header.unpack_from(msg.data)
+            key = (arb_id >> 5, endpoint_id)
+            queue = self._pending.get(key)
+            if queue:
+                # always the reply to the request in flight, dropped if it was given up on (timed out)
+                future, reply_struct, _ = queue.popleft()
+                for timer in self._sdo_timers.pop(key, ()):
+                    timer.cancel()
+                if not future.done():
+                    try:
+                        future.set_result(reply_struct.unpack_from(msg.data)[3])
+                    except struct.error as e:
+                        future.set_exception(e)
+                self._next_sdo(key)
+
+        waiters = self._waiters.pop(arb_id, None)
+        if waiters:
+            for future in waiters:
+                if not future.done():
+                    future.set_result(msg)
+
+        listeners = self._listeners.get(arb_id)
+        if listeners:
+            for callback in list(listeners):
+                try:
+                    callback(msg)
+                except Exception as e:
+                    print(f"Error in CAN listener for {hex(arb_id)}: {e}")
+
+
+def _handle(obj_path):
+    if isinstance(obj_path, EndpointHandle):
+        return obj_path
+    return prepare_endpoint(obj_path)
+
+
+def _decoder(node_id, name, layout, deliver):
+    def decode(msg):
+        deliver((node_id, name, (monotonic(),) + layout.unpack_from(msg.data)))
+
+    return decode
+
+
+class AsyncOdriveController:
+    def __init__(self, bus, id_number, gear_ratio=25, motor_reversed=False):
+        """
+        OdriveController for an AsyncBus. Nothing is sent until setup() is awaited; from then on the node's
+        heartbeat and encoder messages keep heartbeat and encoder up to date and complete moves.
+        :param bus: AsyncBus the ODrive is on
+        :param id_number: the CAN Bus ID of the ODrive
+        :param gear_ratio: The gear ratio of the motor, it is in terms of x:1.
+        :param motor_reversed: Whether or not the motor is reversed
+        """
+        self.bus = bus
+        self.node_id = id_number
+        self.enabled = False
+        self.position = 0
+        self.requested_position = 0
+        self.gear_ratio = gear_ratio
+
+        self.reversed = motor_reversed
+
+        self.max_speed = OdriveSpeeds.max_speed * (self.gear_ratio / 25)
+        self.max_accel = OdriveSpeeds.max_accel * (self.gear_ratio / 25)
+        self.max_decel = OdriveSpeeds.max_decel * (self.gear_ratio / 25)
+
+        self.moving = False
+        self.move_future = None
+        self.setup_time = None
+
+        # latest (monotonic timestamp, *fields) of each cyclic message, None until the first one
+        self.heartbeat = None
+        self.encoder = None
+        # (target, tolerance, started, seen busy) of the move in flight
+        self._move = None
+        self.tolerance = 0.1
+
+        bus.subscribe(arbitration_id(id_number, CMD_HEARTBEAT), self._on_heartbeat)
+        bus.subscribe(
+            arbitration_id(id_number, CMD_ENCODER_ESTIMATES), self._on_encoder
+        )
+
+    async def setup(self):
+        """
+        Bring up the ODrive like odrivecontroller.setup: wait for power and presence, check its firmware against
+        the endpoint table, write the configuration (saving it only if it changed) and zero the motor
+        :return: seconds the setup took
+        """
+        start = perf_counter()
+        node_id = self.node_id
+        bus = self.bus
+        print(f"Setting up CAN for ODrive with id: {node_id}")
+
+        while await bus.read(vbus_voltage, node_id) < 40:
+            await asyncio.sleep(0.1)
+        await bus.next_message(arbitration_id(node_id, CMD_HEARTBEAT))
+        await self._check_version()
+
+        await bus.write(None, clear_errors, node_id)
+
+        settings = [
+            (cansimple.INPUT_MODE_TRAP_TRAJ, input_mode),
+            (self.max_speed, prepare_endpoint(TRAJ_VEL_LIMIT)),
+            (self.max_accel, prepare_endpoint(TRAJ_ACCEL_LIMIT)),
+            (self.max_decel, prepare_endpoint(TRAJ_DECEL_LIMIT)),
+        ] + telemetry.rate_settings()
+        stored = await bus.read_many([(handle, node_id) for _, handle in settings])
+        changed = [
+            (value, handle)
+            for (value, handle), current in zip(settings, stored)
+            # floats come back rounded to single precision
+            if not isclose(value, current, rel_tol=1e-6)
+        ]
+        for value, handle in settings:
+            shadow_registers.record(node_id, handle.path, value)
+
+        if changed:
+            for value, handle in changed:
+                await bus.write(value, handle, node_id)
+            await bus.write(None, save_configuration, node_id)
+            # the ODrive reboots to save, it is back once it answers again
+            await bus.next_message(arbitration_id(node_id, CMD_HEARTBEAT))
+            await self._check_version()
+        else:
+            print(f"ODrive with id {node_id}: stored configuration matches, not saving")
+
+        self.zero_motor()
+        self.setup_time = perf_counter() - start
+        print(
+            f"------------------ ODrive with id {node_id} setup complete in {self.setup_time:.2f} s ------------------"
+        )
+        return self.setup_time
+
+    async def _check_version(self):
+        version_id = arbitration_id(self.node_id, CMD_GET_VERSION)
+        reply = self.bus.next_message(version_id)
+        self.bus.send(version_id, b"")
+        msg = await reply
+        (
+            _,
+            hw_product_line,
+            hw_version,
+            hw_variant,
+            fw_major,
+            fw_minor,
+            fw_revision,
+            _,
+        ) = version.unpack(msg.data)
+        endpoint_data = get_endpoint_data()
+        if endpoint_data["fw_version"] != f"{fw_major}.{fw_minor}.{fw_revision}" or (
+            endpoint_data["hw_version"]
+            != f"{hw_product_line}.{hw_version}.{hw_variant}"
+        ):
+            raise RuntimeError(
+                f"Endpoint JSON file is for hardware version {endpoint_data['hw_version']} and firmware version "
+                f"{endpoint_data['fw_version']}, but ODrive with id {self.node_id} is hardware version "
+                f"{hw_product_line}.{hw_version}.{hw_variant} and firmware version {fw_major}.{fw_minor}.{fw_revision}"
+            )
+
+    def _on_heartbeat(self, msg):
+        self.heartbeat = (monotonic(),) + CYCLIC_MESSAGES[CMD_HEARTBEAT][1].unpack_from(
+            msg.data
+        )
+        move = self._move
+        if move is None or self.heartbeat[0] <= move[2]:
+            return
+        axis_state, trajectory_done = self.heartbeat[2], self.heartbeat[4]
+        if not trajectory_done:
+            self._move = move[:3] + (True, False)
+        elif move[3] and axis_state != cansimple.AXIS_STATE_CLOSED_LOOP_CONTROL:
+            # stopped (e-stop, error) rather than arrived
+            self.stopped()
+        elif move[3]:
+            self._complete(move[0] if self.encoder is None else self.encoder[1])
+        else:
+            self._move = move[:4] + (True,)
+            # a move short enough to finish between two heartbeats
+            if self.encoder is not None and abs(move[0] - self.encoder[1]) <= move[1]:
+                self._complete(self.encoder[1])
+
+    def _on_encoder(self, msg):
+        self.encoder = (monotonic(),) + CYCLIC_MESSAGES[CMD_ENCODER_ESTIMATES][
+            1
+        ].unpack_from(msg.data)
+        move = self._move
+        # passing through the tolerance band on the way in doesn't count until the trajectory is done
+        if move is not None and move[4] and abs(move[0] - self.encoder[1]) <= move[1]:
+            self._complete(self.encoder[1])
+
+    def _complete(self, position):
+        self._move = None
+        self.moving = False
+        if self.move_future is not None and not self.move_future.done():
+            self.move_future.set_result(position)
+
+    def enable_motor(self):
+        self.bus.send(
+            arbitration_id(self.node_id, cansimple.CMD_SET_AXIS_STATE),
+            cansimple.u32.pack(cansimple.AXIS_STATE_CLOSED_LOOP_CONTROL),
+        )
+        self.enabled = True
+
+    def disable_motor(self):
+        self.bus.send(
+            arbitration_id(self.node_id, cansimple.CMD_SET_AXIS_STATE),
+            cansimple.u32.pack(cansimple.AXIS_STATE_IDLE),
+        )
+        self.enabled = False
+
+    def zero_motor(self):
+        self.bus.send(
+            arbitration_id(self.node_id, cansimple.CMD_SET_ABSOLUTE_POSITION),
+            cansimple.f32.pack(0),
+        )
+        self.position = 0
+
+    async def get_encoder_pos(self):
+        if (
+            self.encoder is not None
+            and monotonic() - self.encoder[0] <= TELEMETRY_MAX_AGE
+        ):
+            return self.encoder[1]
+        return await self.bus.read(pos_estimate, self.node_id)
+
+    async def get_encoder_vel(self):
+        if (
+            self.encoder is not None
+            and monotonic() - self.encoder[0] <= TELEMETRY_MAX_AGE
+        ):
+            return self.encoder[2]
+        return await self.bus.read(vel_estimate, self.node_id)
+
+    async def get_angle(self):
+        pos = await self.get_encoder_pos()
+        return (pos * 360) / self.gear_ratio
+
+    def set_speed(self, speed):
+        """
+        Set the speed of the motor
+        :param speed: speed in rotations per second
+        :return:
+        """
+        self.bus.send_burst(
+            shadow_registers.frames(self.node_id, {TRAJ_VEL_LIMIT: speed})
+        )
+        self.max_speed = speed
+
+    def set_accel_decel(self, accel, decel):
+        """
+        Set the acceleration and deceleration of the motor
+        :param accel: acceleration in rotations per second per second
+        :param decel: deceleration in rotations per second per second
+        :return:
+        """
+        self.bus.send_burst(
+            shadow_registers.frames(
+                self.node_id, {TRAJ_ACCEL_LIMIT: accel, TRAJ_DECEL_LIMIT: decel}
+            )
+        )
+        self.max_accel = accel
+        self.max_decel = decel
+
+    def angle_to_rotation(self, angle):
+        """
+        Convert a joint angle to a motor position
+        :param angle: angle in degrees
+        :return: position in revolutions, with the gear ratio and reversal applied
+        """
+        if self.reversed:
+            angle = -angle
+        return (angle / 360) * self.gear_ratio
+
+    def start_position(self):
+        """
+        Get the position the next trajectory will start from, see OdriveController.start_position.
+        Never touches the bus: a move in flight starts from the latest encoder sample.
+        :return: position in revolutions
+        """
+        if self.moving and self.encoder is not None:
+            return self.encoder[1]
+        return self.requested_position
+
+    def begin_move(self, pos):
+        """
+        Track a move and update the commanded position, call right before the position command goes out
+        :param pos: pos in revolutions
+        :return: asyncio Future resolving to the settled position once the move is complete
+        """
+        if not self.enabled:
+            self.enable_motor()
+        if self.move_future is not None:
+            # superseded
+            self.move_future.cancel()
+        self.moving = True
+        self.move_future = asyncio.get_running_loop().create_future()
+        # target, tolerance, start, trajectory seen running, trajectory done since the start
+        self._move = (pos, self.tolerance, monotonic(), False, False)
+
+        self.requested_position = pos
+        self.position = (pos * 360) / self.gear_ratio
+        return self.move_future
+
+    def traj_limit_values(self, speed_offset=1):
+        """
+        Get the trap_traj limits for a move
+        :param speed_offset: offset for the speed/accel of the motor
+        :return: dict of endpoint path -> value, for shadow_registers
+        """
+        return {
+            TRAJ_VEL_LIMIT: self.max_speed * speed_offset,
+            TRAJ_ACCEL_LIMIT: self.max_accel * speed_offset,
+            TRAJ_DECEL_LIMIT: self.max_decel * speed_offset,
+        }
+
+    async def move_to_rotation(self, pos, speed_offset=1):
+        """
+        Move to a position and wait until the axis gets there
+        :param pos: pos in revolutions
+        :param speed_offset: offset for the speed/accel of the motor, only for this move
+        :return: the settled position in revolutions
+        """
+        node_id = self.node_id
+        frames = shadow_registers.frames(node_id, self.traj_limit_values(speed_offset))
+        future = self.begin_move(pos)
+        frames.append(
+            (
+                arbitration_id(node_id, cansimple.CMD_SET_INPUT_POS),
+                cansimple.input_pos_data(pos),
+            )
+        )
+        if speed_offset != 1:
+            # the ODrive plans the trajectory when the position arrives, so the limits can go back straight after
+            frames += shadow_registers.frames(node_id, self.traj_limit_values())
+        self.bus.send_burst(frames)
+        return await future
+
+    async def move_to_angle(self, angle, speed_offset=1):
+        """
+        Move to an angle and wait until the axis gets there
+        :param angle: angle in degrees
+        :param speed_offset: offset for the speed/accel of the motor, only for this move
+        :return: the settled position in revolutions
+        """
+        return await self.move_to_rotation(self.angle_to_rotation(angle), speed_offset)
+
+    def stopped(self):
+        """
+        Forget the move in flight after the axis has been put in IDLE
+        :return:
+        """
+        self._move = None
+        if self.move_future is not None:
+            self.move_future.cancel()
+        self.enabled = False
+        self.moving = False
+
+    async def emergency_stop(self, mode="estop", timeout=0.5):
+        """
+        Stop the motor, see AsyncArm.emergency_stop
+        :param mode: "estop" (latches ESTOP_REQUESTED) or "idle"
+        :param timeout: seconds to wait for the heartbeat confirming it
+        :return: the emergency stop report
+        """
+        return await emergency_stop(self.bus, [self], mode, timeout)
+
+
+async def emergency_stop(bus, controllers, mode="estop", timeout=0.5):
+    """
+    Stop several axes in one burst and wait for their heartbeats to report IDLE, see estop.emergency_stop
+    :param bus: AsyncBus the controllers are on
+    :param controllers: list of AsyncOdriveController
+    :param mode: "estop" (latches ESTOP_REQUESTED) or "idle"
+    :param timeout: seconds to wait for the heartbeats
+    :return: dict with the nodes that confirmed (node id -> ms after the stop) and those that didn't
+    """
+    started = perf_counter()
+    cmd_id, data = STOP_FRAMES[mode]
+    # an axis that was already IDLE only confirms an estop once the error is latched too
+    required_error = AXIS_ERROR_ESTOP_REQUESTED if mode == "estop" else 0
+
+    loop = asyncio.get_running_loop()
+    waits = {controller.node_id: loop.create_future() for controller in controllers}
+
+    def listener(node_id):
+        def on_heartbeat(msg):
+            wait = waits[node_id]
+            axis_error, axis_state = CYCLIC_MESSAGES[CMD_HEARTBEAT][1].unpack_from(
+                msg.data
+            )[:2]
+            if (
+                not wait.done()
+                and msg.timestamp > stop_time
+                and axis_state == cansimple.AXIS_STATE_IDLE
+                and axis_error & required_error == required_error
+            ):
+                wait.set_result((perf_counter() - started) * 1e3)
+
+        return on_heartbeat
+
+    # listening before the burst goes out so a fast heartbeat can't be missed, only heartbeats received
+    # after it count: msg.timestamp is the receive time on the time() clock, so one that was already
+    # waiting to be dispatched can't confirm an axis that was IDLE anyway
+    listeners = [
+        (arbitration_id(node_id, CMD_HEARTBEAT), listener(node_id)) for node_id in waits
+    ]
+    for arb_id, callback in listeners:
+        bus.subscribe(arb_id, callback)
+    try:
+        stop_time = time()
+        bus.send_burst(
+            [
+                (arbitration_id(controller.node_id, cmd_id), data)
+                for controller in controllers
+            ]
+        )
+        sent_ms = (perf_counter() - started) * 1e3
+        for controller in controllers:
+            controller.stopped()
+
+        await asyncio.wait(list(waits.values()), timeout=timeout)
+    finally:
+        for arb_id, callback in listeners:
+            bus.unsubscribe(arb_id, callback)
+    confirmed = {
+        node_id: wait.result() for node_id, wait in waits.items() if wait.done()
+    }
+    report = {
+        "mode": mode,
+        "sent_ms": sent_ms,
+        "confirmed": confirmed,
+        "unconfirmed": [node_id for node_id in waits if node_id not in confirmed],
+        "total_ms": max(confirmed.values()) if confirmed else None,
+    }
+    print(
+        f"Emergency stop ({mode}) sent to {len(waits)} nodes in {sent_ms:.2f} ms, "
+        f"{len(confirmed)} confirmed"
+    )
+    return report
+
+
+class AsyncArm:
+    def __init__(self, bus):
+        """
+        All the ODrive joints of the arm on one AsyncBus, see ArmBus
+        :param bus: AsyncBus the joints are on
+        """
+        self.bus = bus
+        self.controllers = {}
+        self.setup_times = {}
+
+    async def setup_all(self, nodes):
+        """
+        Set up every joint at the same time
+        :param nodes: list of AsyncOdriveController keyword arguments, e.g. [{"id_number": 0, "gear_ratio": 50}, ...]
+        :return: dict of node id -> AsyncOdriveController
+        """
+        start = perf_counter()
+        controllers = [AsyncOdriveController(self.bus, **kwargs) for kwargs in nodes]
+        await asyncio.gather(*(controller.setup() for controller in controllers))
+        for controller in controllers:
+            self.controllers[controller.node_id] = controller
+            self.setup_times[controller.node_id] = controller.setup_time
+        print(
+            f"ODrive setup of {len(controllers)} nodes: {perf_counter() - start:.2f} s"
+        )
+        return dict(self.controllers)
+
+    async def move(self, angles, speed_offset=1):
+        """
+        Move several joints so they all start and finish at the same time, see MultiAxisMove
+        :param angles: dict of node id -> angle in degrees
+        :param speed_offset: offset for the speed/accel of every joint
+        :return: dict of node id -> settled position once every joint has arrived
+        """
+        move = MultiAxisMove(
+            {self.controllers[node_id]: angle for node_id, angle in angles.items()},
+            speed_offset,
+        )
+        joints, frames = move.build()
+        futures = [controller.begin_move(target) for controller, target in joints]
+        self.bus.send_burst(frames)
+        positions = await asyncio.gather(*futures)
+        return {
+            controller.node_id: position
+            for (controller, _), position in zip(joints, positions)
+        }
+
+    async def get_angles(self):
+        """
+        :return: dict of node id -> angle in degrees of every joint
+        """
+        angles = await asyncio.gather(
+            *(controller.get_angle() for controller in self.controllers.values())
+        )
+        return dict(zip(self.controllers, angles))
+
+    async def emergency_stop(self, mode="estop", timeout=0.5):
+        """
+        Stop every joint in one burst, see emergency_stop
+        :param mode: "estop" (latches ESTOP_REQUESTED) or "idle"
+        :param timeout: seconds to wait for the heartbeats confirming it
+        :return: the emergency stop report
+        """
+        return await emergency_stop(
+            self.bus, list(self.controllers.values()), mode, timeout
+        )
+
+    def __getitem__(self, node_id):
+        return self.controllers[node_id]
@@ -0,0 +1,174 @@
+from threading import Lock, Thread
+from time import monotonic, sleep
+
+import numpy as np
+
+from Server.MotorControllerLibs.CANControlledMotors.telemetry import telemetry
+
+# node ids are 6 bits
+MAX_NODES = 64
+
+# one row per node id
+health_dtype = np.dtype(
+    [
+        ("axis_error", "<u4"),
+        ("axis_state", "u1"),
+        ("procedure_result", "u1"),
+        ("trajectory_done", "?"),
+        ("stale", "?"),
+        ("last_seen", "<f8"),
+    ]
+)
+# fields that raise change events, in row order
+EVENT_FIELDS = ("axis_error", "axis_state", "procedure_result", "trajectory_done")
+
+
+class AxisHealth:
+    def __init__(self, telemetry, stale_after=0.5, check_interval=0.1):
+        """
+        The latest heartbeat of every node in one array indexed by node id, so axis state and errors are
+        always at hand without polling an endpoint. Listeners hear about every change, including a node
+        going stale (no heartbeat for stale_after seconds) and coming back.
+        :param telemetry: Telemetry decoding the heartbeats
+        :param stale_after: seconds without a heartbeat before a node is stale
+        :param check_interval: seconds between staleness checks
+        """
+        self.stale_after = stale_after
+        self.check_interval = check_interval
+
+        self.table = np.zeros(MAX_NODES, dtype=health_dtype)
+        # nan until the node's first heartbeat
+        self.table["last_seen"] = np.nan
+
+        # replaced rather than mutated so the receiver thread can iterate it without a lock
+        self._listeners = ()
+        self._lock = Lock()
+        self._watchdog = None
+
+        telemetry.add_listener(self._on_sample)
+
+    def add_listener(self, callback):
+        """
+        Call callback(node_id, field, old, new) whenever a field of a node changes.
+        field is one of EVENT_FIELDS or "stale". Called from the receiver or watchdog thread, must not block.
+        :param callback: function
+        :return:
+        """
+        self._listeners = self._listeners + (callback,)
+
+    def remove_listener(self, callback):
+        """
+        Remove a callback added with add_listener
+        :param callback: the registered callback
+        :return:
+        """
+        self._listeners = tuple(
+            listener for listener in self._listeners if listener is not callback
+        )
+
+    def _notify(self, node_id, field, old, new):
+        for listener in self._listeners:
+            try:
+                listener(node_id, field, old, new)
+            except Exception as e:
+                print(f"Error in axis health listener: {e}")
+
+    def _on_sample(self, node_id, message, sample):
+        if message != "heartbeat":
+            return
+        timestamp, axis_error, axis_state, procedure_result, trajectory_done = sample
+        with self._lock:
+            old = self.table[node_id].item()
+            self.table[node_id] = (
+                axis_error,
+                axis_state,
+                procedure_result,
+                trajectory_done,
+                False,
+                timestamp,
+            )
+            if self._watchdog is None:
+                self._watchdog = Thread(target=self._watchdog_loop, daemon=True)
+                self._watchdog.start()
+
+        new = (axis_error, axis_state, procedure_result, bool(trajectory_done))
+        for field, before, after in zip(EVENT_FIELDS, old, new):
+            if before != after:
+                self._notify(node_id, field, before, after)
+        if old[4]:
+            self._notify(node_id, "stale", True, False)
+
+    def _watchdog_loop(self):
+        while True:
+            sleep(self.check_interval)
+            with self._lock:
+                # nan compares False, nodes never seen can't go stale
+                newly_stale = np.flatnonzero(
+                    (monotonic() - self.table["last_seen"] > self.stale_after)
+                    & ~self.table["stale"]
+                )
+                self.table["stale"][newly_stale] = True
+            for node_id in newly_stale:
+                self._notify(int(node_id), "stale", False, True)
+
+    def nodes(self):
+        """
+        :return: list of node ids that have sent a heartbeat
+        """
+        return np.flatnonzero(~np.isnan(self.table["last_seen"])).tolist()
+
+    def state(self, node_id, with_age=True):
+        """
+        Get a node's latest heartbeat
+        :param node_id: Node id of the ODrive controller
+        :param with_age: include the age, leave it out for a state that is kept around rather than used now
+        :return: dict of the heartbeat fields, stale, and age in seconds (None if never seen)
+        """
+        row = self.table[node_id].item()
+        state = dict(zip(health_dtype.names, row))
+        last_seen = state.pop("last_seen")
+        if with_age:
+            state["age"] = None if np.isnan(last_seen) else monotonic() - last_seen
+        return state
+
+    def stale_nodes(self):
+        """
+        :return: list of node ids that have stopped sending heartbeats
+        """
+        return np.flatnonzero(self.table["stale"]).tolist()
+
+    def errors(self):
+        """
+        :return: dict of node id -> axis error, for nodes reporting one
+        """
+        nodes = np.flatnonzero(self.table["axis_error"])
+        return {
+            int(node_id): int(error)
+            for node_id, error in zip(nodes, self.table["axis_error"][nodes])
+        }
+
+    def snapshot(self, with_age=True):
+        """
+        :param with_age: include each node's age, see state
+        :return: dict of node id -> state() for every node that has sent a heartbeat
+        """
+        return {node_id: self.state(node_id, with_age) for node_id in self.nodes()}
+
+    def publish(self, data, key="axis_health"):
+        """
+        Keep data[key] set to snapshot(), e.g. a Server's data dict so clients can get it over the data channel.
+        It is only rebuilt when something changes, not on every heartbeat, so it leaves out the age, which would
+        be frozen at the last change; stale says whether the heartbeats are still coming.
+        :param data: dict to publish into
+        :param key: key to publish under
+        :return:
+        """
+
+        def update(node_id, field, old, new):
+            data[key] = self.snapshot(with_age=False)
+
+        data[key] = self.snapshot(with_age=False)
+        self.add_listener(update)
+
+
+axis_health = AxisHealth(telemetry)
@@ -0,0 +1,626 @@
+import struct
+from collections import deque
+from concurrent.futures import CancelledError, Future
+from heapq import heappop, heappush
+from itertools import count
+from threading import Condition, Lock, Thread
+from time import monotonic
+
+OPCODE_READ = 0x00
+OPCODE_WRITE = 0x01
+
+CMD_RX_SDO = 0x04
+CMD_TX_SDO = 0x05
+
+# opcode, endpoint id, reserved
+sdo_header = struct.Struct("<BHB")
+
+
+def arbitration_id(node_id, cmd_id):
+    """
+    Build a CANSimple arbitration id
+    :param node_id: Node id of the ODrive controller
+    :param cmd_id: CANSimple command id
+    :return: the 11 bit arbitration id
+    """
+    return node_id << 5 | cmd_id
+
+
+# RxSdo arbitration id of every possible node id (6 bits)
+RX_SDO_IDS = tuple(arbitration_id(node_id, CMD_RX_SDO) for node_id in range(64))
+
+# transmit priority classes, lower goes first
+PRIORITY_SAFETY = 0
+PRIORITY_MOTION = 1
+PRIORITY_CONFIG = 2
+PRIORITY_TELEMETRY = 3
+PRIORITY_NAMES = ("safety", "motion", "config", "telemetry")
+
+# queueing delays kept per class for the percentiles in tx_stats
+DELAY_HISTORY = 1000
+
+# seconds an SDO request waits for its reply before failing with TimeoutError. It keeps its place in line
+# for as long again, so a late reply is dropped rather than handed to the request after it
+SDO_REPLY_TIMEOUT = 1.0
+# seconds between checks for SDO requests past their timeout, done by the receiver thread
+SDO_SWEEP_INTERVAL = 0.05
+
+
+class LaneStats:
+    __slots__ = ("sent", "expired", "failed", "max_delay", "delays")
+
+    def __init__(self):
+        self.sent = 0
+        self.expired = 0
+        self.failed = 0
+        self.max_delay = 0.0
+        self.delays = deque(maxlen=DELAY_HISTORY)
+
+
+class SdoRequest:
+    __slots__ = ("future", "reply_struct", "data", "priority", "deadline", "sent_at")
+
+    def __init__(self, future, reply_struct, data, priority, deadline):
+        """
+        An RxSdo frame waiting for its turn on its (node, endpoint), see BusManager.sdo_request
+        :param future: Future for the reply, None for a write that isn't acknowledged
+        :param reply_struct: struct.Struct to decode the reply with
+        :param data: complete frame payload
+        :param priority: transmit priority class
+        :param deadline: monotonic() time it has to be sent by, None for no deadline
+        """
+        self.future = future
+        self.reply_struct = reply_struct
+        self.data = data
+        self.priority = priority
+        self.deadline = deadline
+        # monotonic() time it was queued for transmit, None while it waits behind another request
+        self.sent_at = None
+
+
+class BusManager:
+    def __init__(
+        self, bus, receive_filters=True, metrics=None, reply_timeout=SDO_REPLY_TIMEOUT
+    ):
+        """
+        Owns a single CAN interface: one background thread receives every frame and routes it by arbitration id,
+        so requests for many nodes can be in flight at once without stealing each others replies.
+        Another thread transmits: frames are queued by priority class (safety, motion, config, telemetry),
+        earliest deadline first within a class, frames without a deadline after those with one, in the order
+        they were queued. The lanes only order what is queued, a frame still waits for the transmit thread to
+        be scheduled; the e-stop bypasses the queue altogether, see send_now.
+        With receive_filters the interface only passes up frames something is waiting or listening for
+        (in the kernel on SocketCAN), the filters follow the subscriptions as they change.
+        :param bus: an open python-can bus (socketcan, virtual, ...)
+        :param receive_filters: install acceptance filters for the subscribed arbitration ids
+        :param metrics: BusMetrics counting the bus load and SDO round trip times, None to not count them
+        :param reply_timeout: seconds an SDO request waits for its reply, see SDO_REPLY_TIMEOUT
+        """
+        # imported here rather than at module level, python-can takes ~150 ms to import
+        from can import CanError, Message
+
+        self._message = Message
+        self._can_error = CanError
+
+        self.bus = bus
+        self.send_lock = Lock()
+        self.running = False
+
+        self._pending_lock = Lock()
+        # (node_id, endpoint_id) -> queue of SdoRequest, the first one is in flight awaiting its TxSdo
+        self._pending = {}
+        self.reply_timeout = reply_timeout
+        self._next_sweep = 0.0
+        # arbitration_id -> queue of futures resolved by the next matching frame
+        self._waiters = {}
+        # arbitration_id -> list of callbacks called with every matching frame
+        self._listeners = {}
+
+        self.receive_filters = receive_filters
+        # ids that stay in the filters once asked for: SDO replies and one-off waits (heartbeat, version)
+        self._sticky_ids = set()
+        # ids the installed filters accept, None when everything is received
+        self._filter_ids = None
+        self.frames_received = 0
+        self.frames_used = 0
+        # called with (msg, transmitted) for every frame sent or received, e.g. by can_recorder.
+        # replaced rather than mutated so the threads can iterate it without a lock
+        self._taps = ()
+        self.metrics = metrics
+        if metrics is not None:
+            self._taps = (metrics.tap,)
+
+        self._receiver_thread = None
+
+        self._tx_condition = Condition()
+        # heap of (priority, deadline, sequence, queued at, messages, future)
+        self._tx_queue = []
+        self._tx_sequence = count()
+        self._tx_stats = [LaneStats() for _ in PRIORITY_NAMES]
+        self._transmit_thread = None
+
+    def start(self):
+        """
+        Start the receiver and transmit threads
+        :return:
+        """
+        if self.running:
+            return
+        self.running = True
+        self._receiver_thread = Thread(target=self._receive_loop, daemon=True)
+        self._receiver_thread.start()
+        self._transmit_thread = Thread(target=self._transmit_loop, daemon=True)
+        self._transmit_thread.start()
+
+    def stop(self):
+        """
+        Stop the receiver and transmit threads and fail anything still queued or waiting on a reply
+        :return:
+        """
+        with self._tx_condition:
+            self.running = False
+            self._tx_condition.notify()
+        if self._receiver_thread is not None:
+            self._receiver_thread.join()
+            self._receiver_thread = None
+        if self._transmit_thread is not None:
+            self._transmit_thread.join()
+            self._transmit_thread = None
+
+        with self._tx_condition:
+            unsent = [entry[5] for entry in self._tx_queue]
+            self._tx_queue.clear()
+        for future in unsent:
+            future.cancel()
+
+        self._tx_condition = Condition()
+        # heap of (priority, deadline, sequence, queued at, messages, future)
+        self._tx_queue = []
+        self._tx_sequence = count()
+        self._tx_stats = [LaneStats() for _ in PRIORITY_NAMES]
+        self._transmit_thread = None
+
+        with self._pending_lock:
+            pending = [
+                request.future
+                for queue in self._pending.values()
+                for request in queue
+                if request.future is not None
+            ]
+            pending += [future for queue in self._waiters.values() for future in queue]
+            self._pending.clear()
+            self._waiters.clear()
+        for future in pending:
+            future.cancel()
+
+    def send(self, arbitration_id, data, priority=PRIORITY_CONFIG, deadline=None):
+        """
+        Queue a single standard-id frame
+        :param arbitration_id: arbitration id of the frame
+        :param data: payload bytes
+        :param priority: PRIORITY_SAFETY, PRIORITY_MOTION, PRIORITY_CONFIG or PRIORITY_TELEMETRY
+        :param deadline: seconds from now the frame has to be sent within, it is dropped after that.
+        None waits as long as it takes.
+        :return: Future resolving once the frame has been handed to the interface
+        """
+        return self.send_burst([(arbitration_id, data)], priority, deadline)
+
+    def send_burst(self, frames, priority=PRIORITY_CONFIG, deadline=None):
+        """
+        Queue several standard-id frames that go out back to back, no other frame lands in the middle
+        :param frames: list of (arbitration_id, data)
+        :param priority: PRIORITY_SAFETY, PRIORITY_MOTION, PRIORITY_CONFIG or PRIORITY_TELEMETRY
+        :param deadline: seconds from now the frames have to be sent within, they are dropped after that.
+        None waits as long as it takes.
+        :return: Future resolving once every frame has been handed to the interface
+        """
+        messages = [
+            self._message(arbitration_id=arb_id, data=data, is_extended_id=False)
+            for arb_id, data in frames
+        ]
+        future = Future()
+        now = monotonic()
+        with self._tx_condition:
+            if self.running:
+                heappush(
+                    self._tx_queue,
+                    (
+                        priority,
+                        float("inf") if deadline is None else now + deadline,
+                        next(self._tx_sequence),
+                        now,
+                        messages,
+                        future,
+                    ),
+                )
+                self._tx_condition.notify()
+                return future
+
+        # not started, nothing to queue behind
+        future.set_running_or_notify_cancel()
+        self._transmit(messages, future, self._tx_stats[priority], 0.0)
+        return future
+
+    def send_now(self, frames):
+        """
+        Send frames straight from the calling thread, ahead of everything queued and without taking
+        the send lock, so nothing already in progress can hold them up. Only for the e-stop.
+        :param frames: list of (arbitration_id, data)
+        :return:
+        """
+        messages = [
+            self._message(arbitration_id=arb_id, data=data, is_extended_id=False)
+            for arb_id, data in frames
+        ]
+        send = self.bus.send
+        for msg in messages:
+            send(msg)
+        self._tap(messages, True)
+
+    def add_tap(self, callback):
+        """
+        Call callback(msg, transmitted) for every frame handed to the interface (transmitted True) and every frame
+        received from it (False). Called from the transmit, receiver or e-stop thread, must be quick and not block.
+        :param callback: function
+        :return:
+        """
+        self._taps = self._taps + (callback,)
+
+    def remove_tap(self, callback):
+        """
+        Remove a callback added with add_tap
+        :param callback: the registered callback
+        :return:
+        """
+        # == rather than is, so a bound method like BusMetrics.tap matches
+        self._taps = tuple(tap for tap in self._taps if tap != callback)
+
+    def tx_stats(self):
+        """
+        Get the transmit counters and queueing delays of every priority class
+        :return: dict of class name -> dict of sent, expired, failed and queued frame groups,
+        mean / p99 / max queueing delay in ms
+        """
+        with self._tx_condition:
+            queued = [0] * len(PRIORITY_NAMES)
+            for entry in self._tx_queue:
+                queued[entry[0]] += 1
+        stats = {}
+        for priority, name in enumerate(PRIORITY_NAMES):
+            lane = self._tx_stats[priority]
+            delays = sorted(lane.delays)
+            stats[name] = {
+                "sent": lane.sent,
+                "expired": lane.expired,
+                "failed": lane.failed,
+                "queued": queued[priority],
+                "mean_delay_ms": sum(delays) / len(delays) * 1e3 if delays else 0.0,
+                "p99_delay_ms": (
+                    delays[min(len(delays) - 1, int(len(delays) * 0.99))] * 1e3
+                    if delays
+                    else 0.0
+                ),
+                "max_delay_ms": lane.max_delay * 1e3,
+            }
+        return stats
+
+    def subscribe(self, arbitration_id, callback):
+        """
+        Call callback(msg) from the receiver thread for every frame with this arbitration id
+        :param arbitration_id: arbitration id to listen for
+        :param callback: function taking a can.Message, must not block
+        :return:
+        """
+        with self._pending_lock:
+            self._listeners.setdefault(arbitration_id, []).append(callback)
+            self._update_filters()
+
+    def unsubscribe(self, arbitration_id, callback):
+        """
+        Remove a callback added with subscribe
+        :param arbitration_id: arbitration id it was registered for
+        :param callback: the registered callback
+        :return:
+        """
+        with self._pending_lock:
+            listeners = self._listeners.get(arbitration_id, [])
+            if callback in listeners:
+                listeners.remove(callback)
+            if not listeners:
+                self._listeners.pop(arbitration_id, None)
+            self._update_filters()
+
+    def next_message(self, arbitration_id):
+        """
+        Get a future for the next frame received with this arbitration id.
+        Call before sending whatever triggers the frame so the reply can't be missed.
+        :param arbitration_id: arbitration id to wait for
+        :return: Future resolving to the can.Message
+        """
+        future = Future()
+        with self._pending_lock:
+            self._waiters.setdefault(arbitration_id, deque()).append(future)
+            self._sticky_ids.add(arbitration_id)
+            self._update_filters()
+        return future
+
+    def sdo_request(
+        self,
+        node_id,
+        endpoint_id,
+        data,
+        reply_struct=None,
+        priority=PRIORITY_CONFIG,
+        deadline=None,
+    ):
+        """
+        Send an RxSdo frame, optionally registering for its TxSdo reply before the frame goes out.
+        A reply only carries the node and endpoint id, so only one request per (node, endpoint) is in flight
+        at a time: the reply always belongs to it. Later requests for the same endpoint, writes included,
+        wait their turn and go out in the order they were made, requests for other endpoints aren't held up.
+        A request without a reply after reply_timeout fails with TimeoutError.
+        :param node_id: Node id of the ODrive controller
+        :param endpoint_id: endpoint id from flat_endpoints.json
+        :param data: complete frame payload, header included
+        :param reply_struct: struct.Struct to decode the reply with (header included), None if no reply is expected
+        :param priority: transmit priority class
+        :param deadline: seconds from now the request has to be sent within, None waits as long as it takes
+        :return: Future resolving to the decoded value, or None if no reply is expected
+        """
+        future = None if reply_struct is None else Future()
+        request = SdoRequest(
+            future,
+            reply_struct,
+            data,
+            priority,
+            None if deadline is None else monotonic() + deadline,
+        )
+        key = (node_id, endpoint_id)
+        with self._pending_lock:
+            queue = self._pending.get(key)
+            if queue:
+                # behind the request in flight
+                queue.append(request)
+                return future
+            if future is not None:
+                request.sent_at = monotonic()
+                self._pending[key] = deque((request,))
+                self._sticky_ids.add(arbitration_id(node_id, CMD_TX_SDO))
+                self._update_filters()
+
+        self._send_sdo(key, request)
+        return future
+
+    def _send_sdo(self, key, request):
+        deadline = request.deadline
+        sent = self.send(
+            RX_SDO_IDS[key[0]],
+            request.data,
+            request.priority,
+            None if deadline is None else max(0.0, deadline - monotonic()),
+        )
+        if request.future is not None:
+            sent.add_done_callback(
+                lambda sent: self._check_sdo_sent(key, request, sent)
+            )
+
+    def _next_sdo(self, key):
+        # send what waited behind the request that just finished: writes until the next request with a reply
+        to_send = []
+        with self._pending_lock:
+            queue = self._pending.get(key)
+            while queue:
+                request = queue[0]
+                if request.future is None:
+                    to_send.append(queue.popleft())
+                elif request.future.cancelled():
+                    # given up on before it went out
+                    queue.popleft()
+                else:
+                    request.sent_at = monotonic()
+                    to_send.append(request)
+                    break
+            if not queue:
+                self._pending.pop(key, None)
+        for request in to_send:
+            self._send_sdo(key, request)
+
+    def _expire_sdo(self, now):
+        # fail requests past their timeout, and give up on their reply once it is as late again
+        expired = []
+        finished = []
+        with self._pending_lock:
+            for key, queue in self._pending.items():
+                request = queue[0]
+                waited = now - request.sent_at
+                if waited < self.reply_timeout:
+                    continue
+                if not request.future.done():
+                    expired.append(request.future)
+                if waited >= 2 * self.reply_timeout:
+                    queue.popleft()
+                    finished.append(key)
+        for future in expired:
+            if future.set_running_or_notify_cancel():
+                future.set_exception(TimeoutError("no SDO reply"))
+        for key in finished:
+            self._next_sdo(key)
+
+    def set_receive_filters(self, enabled):
+        """
+        Turn the acceptance filters on or off, off receives every frame on the bus
+        :param enabled: True to filter
+        :return:
+        """
+        with self._pending_lock:
+            self.receive_filters = enabled
+            if enabled:
+                self._update_filters()
+            else:
+                self._filter_ids = None
+                self.bus.set_filters(None)
+
+    def _update_filters(self):
+        # caller holds _pending_lock, so the filter is in place before the request it is for goes out
+        if not self.receive_filters:
+            return
+        wanted = self._sticky_ids.union(self._listeners)
+        if wanted == self._filter_ids:
+            return
+        self._filter_ids = wanted
+        # no subscriptions yet leaves the interface receiving everything
+        self.bus.set_filters(
+            [
+                {"can_id": arb_id, "can_mask": 0x7FF, "extended": False}
+                for arb_id in sorted(wanted)
+            ]
+        )
+
+    def rx_stats(self):
+        """
+        :return: dict of frames received from the interface, frames something was waiting or listening for,
+        and the number of arbitration ids the filters accept (None when not filtering)
+        """
+        return {
+            "received": self.frames_received,
+            "used": self.frames_used,
+            "filters": None if self._filter_ids is None else len(self._filter_ids),
+        }
+
+    def _check_sdo_sent(self, key, request, sent):
+        if not sent.cancelled() and sent.exception() is None:
+            return
+        # the request never went out (dropped, bus error, stopped), so no reply is coming
+        with self._pending_lock:
+            queue = self._pending.get(key)
+            in_flight = bool(queue) and queue[0] is request
+            if in_flight:
+                queue.popleft()
+        future = request.future
+        if not future.done() and future.set_running_or_notify_cancel():
+            future.set_exception(
+                CancelledError() if sent.cancelled() else sent.exception()
+            )
+        if in_flight:
+            self._next_sdo(key)
+
+    def _transmit_loop(self):
+        while True:
+            with self._tx_condition:
+                while self.running and not self._tx_queue:
+                    self._tx_condition.wait()
+                if not self.running:
+                    return
+                priority, deadline, _, queued_at, messages, future = heappop(
+                    self._tx_queue
+                )
+
+            lane = self._tx_stats[priority]
+            now = monotonic()
+            if now > deadline:
+                lane.expired += 1
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(
+                        TimeoutError(
+                            f"{PRIORITY_NAMES[priority]} frame not sent within its deadline"
+                        )
+                    )
+                continue
+            if future.set_running_or_notify_cancel():
+                self._transmit(messages, future, lane, now - queued_at)
+
+    def _transmit(self, messages, future, lane, delay):
+        try:
+            with self.send_lock:
+                for msg in messages:
+                    self.bus.send(msg)
+        except Exception as e:
+            lane.failed += 1
+            print(f"Error sending CAN frame: {e}")
+            future.set_exception(e)
+            return
+        self._tap(messages, True)
+        lane.sent += 1
+        lane.delays.append(delay)
+        if delay > lane.max_delay:
+            lane.max_delay = delay
+        future.set_result(None)
+
+    def _tap(self, messages, transmitted):
+        for tap in self._taps:
+            try:
+                for msg in messages:
+                    tap(msg, transmitted)
+            except Exception as e:
+                print(f"Error in CAN tap {tap}: {e}")
+
+    def _receive_loop(self):
+        while self.running:
+            try:
+                msg = self.bus.recv(timeout=0.1)
+            except self._can_error as e:
+                print(f"Error receiving CAN frame: {e}")
+                continue
+            if msg is not None and not msg.is_error_frame:
+                try:
+                    self._dispatch(msg)
+                except Exception as e:
+                    print(f"Error dispatching CAN frame {hex(msg.arbitration_id)}: {e}")
+            now = monotonic()
+            if now >= self._next_sweep:
+                self._next_sweep = now + SDO_SWEEP_INTERVAL
+                self._expire_sdo(now)
+
+    def _dispatch(self, msg):
+        arb_id = msg.arbitration_id
+        request = None
+        self.frames_received += 1
+        if self._taps:
+            self._tap((msg,), False)
+
+        with self._pending_lock:
+            if arb_id & 0x1F == CMD_TX_SDO and len(msg.data) >= sdo_header.size:
+                _, endpoint_id, _ = sdo_header.unpack_from(msg.data)
+                key = (arb_id >> 5, endpoint_id)
+                queue = self._pending.get(key)
+                if queue:
+                    # the reply of the request in flight, even if it was given up on
+                    request = queue.popleft()
+
+            waiters = self._waiters.pop(arb_id, None)
+            listeners = self._listeners.get(arb_id)
+            if listeners:
+                listeners = list(listeners)
+
+        if request is not None or waiters or listeners:
+            self.frames_used += 1
+
+        # futures are completed outside the lock so their callbacks may issue new requests
+        if request is not None:
+            if self.metrics is not None:
+                self.metrics.round_trip(
+                    arb_id >> 5,
+                    endpoint_id,
+                    request.data[0],
+                    monotonic() - request.sent_at,
+                )
+            future = request.future
+            # a request that timed out or was cancelled drops its late reply
+            if not future.done() and future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(request.reply_struct.unpack_from(msg.data)[3])
+                except struct.error as e:
+                    future.set_exception(e)
+            self._next_sdo(key)
+
+        if waiters:
+            for future in waiters:
+                if future.set_running_or_notify_cancel():
+                    future.set_result(msg)
+
+        if listeners:
+            for callback in listeners:
+                try:
+                    callback(msg)
+                except Exception as e:
+                    print(f"Error in CAN listener for {hex(arb_id)}: {e}")
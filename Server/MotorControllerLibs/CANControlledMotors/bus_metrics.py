@@ -0,0 +1,281 @@
+from threading import Lock
+from time import monotonic
+
+# HDR style histogram layout: values below 2 * SUB_BUCKETS are counted exactly, above that every power of two
+# is split into SUB_BUCKETS buckets, so every bucket is within 1 / SUB_BUCKETS (~3%) of the value it counts
+SUB_BUCKET_BITS = 5
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+# values in microseconds, anything over ~35 minutes goes in the last bucket
+MAX_VALUE = (1 << 31) - 1
+BUCKETS = SUB_BUCKETS * (MAX_VALUE.bit_length() - SUB_BUCKET_BITS + 1)
+
+# bits of a standard id data frame: SOF, id, RTR, IDE, r0, DLC, data, CRC, delimiters, ACK, EOF and intermission
+FRAME_BITS = tuple(47 + 8 * dlc for dlc in range(9))
+
+# frame and byte counters the kernel keeps for a SocketCAN interface, before any acceptance filter
+INTERFACE_STATISTICS = "/sys/class/net/{}/statistics/{}"
+
+# seconds of bus load kept, one bucket per second
+LOAD_HISTORY = 60
+
+OPCODE_NAMES = ("read", "write")
+
+
+class LatencyHistogram:
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        """
+        Fixed size log-linear histogram of durations in microseconds, recording is a few integer operations
+        and the memory use doesn't grow with the number of samples
+        """
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, microseconds):
+        """
+        Count one duration
+        :param microseconds: duration as an int
+        :return:
+        """
+        value = min(max(microseconds, 0), MAX_VALUE)
+        if value < SUB_BUCKETS << 1:
+            index = value
+        else:
+            shift = value.bit_length() - SUB_BUCKET_BITS - 1
+            index = SUB_BUCKETS * shift + (value >> shift)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """
+        :param percent: 0 to 100
+        :return: the highest value in the bucket holding the percentile, in microseconds
+        """
+        if not self.count:
+            return 0
+        rank = max(1, round(self.count * percent / 100))
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                if index < SUB_BUCKETS << 1:
+                    return index
+                shift = index // SUB_BUCKETS - 1
+                top = index % SUB_BUCKETS + SUB_BUCKETS
+                return min(((top + 1) << shift) - 1, self.max)
+        return self.max
+
+    def summary(self):
+        """
+        :return: dict of the number of samples and the mean, p50, p90, p99 and max in ms
+        """
+        return {
+            "count": self.count,
+            "mean_ms": self.total / self.count / 1e3 if self.count else 0.0,
+            "p50_ms": self.percentile(50) / 1e3,
+            "p90_ms": self.percentile(90) / 1e3,
+            "p99_ms": self.percentile(99) / 1e3,
+            "max_ms": self.max / 1e3,
+        }
+
+
+class BusMetrics:
+    def __init__(self, bitrate, channel=None):
+        """
+        Counters and latency histograms of one bus: frames and bits on the wire each way, per node and per second,
+        and SDO round trip times per endpoint, node and opcode. Received frames and round trips are only counted
+        by the receiver thread, sent frames come from the transmit thread and from send_now's callers too, so
+        only those take a lock.
+        Only frames that reach Python are counted, with the BusManager's acceptance filters on that leaves out
+        other nodes' traffic nothing subscribed to, so utilization() is a lower bound. On SocketCAN the kernel's
+        interface counters see every frame, see interface_utilization.
+        :param bitrate: the bus bitrate in bit/s, for the utilization estimate
+        :param channel: SocketCAN interface name for interface_utilization, None if there is none (virtual)
+        """
+        self.bitrate = bitrate
+        self.channel = channel
+        # caller -> (monotonic time, frames, data bytes) of its last interface counter reading
+        self._interface_samples = {}
+        self._transmitted_lock = Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Zero every counter and histogram
+        :return:
+        """
+        self.started = monotonic()
+        # index 0 received, 1 transmitted
+        self.frames = [0, 0]
+        self.bits = [0, 0]
+        self.node_frames = [[0] * 64, [0] * 64]
+        # one bucket per second, stamped with the second it counts
+        self._load_second = [[-1] * LOAD_HISTORY, [-1] * LOAD_HISTORY]
+        self._load_frames = [[0] * LOAD_HISTORY, [0] * LOAD_HISTORY]
+        self._load_bits = [[0] * LOAD_HISTORY, [0] * LOAD_HISTORY]
+        # endpoint id / node id / opcode -> LatencyHistogram
+        self.endpoint_latency = {}
+        self.node_latency = {}
+        self.opcode_latency = {}
+
+    def tap(self, msg, transmitted):
+        """
+        Count a frame, see BusManager.add_tap
+        :param msg: can.Message
+        :param transmitted: True if it was sent, False if received
+        :return:
+        """
+        if transmitted:
+            with self._transmitted_lock:
+                self._count(msg, 1)
+        else:
+            self._count(msg, 0)
+
+    def _count(self, msg, direction):
+        bits = FRAME_BITS[msg.dlc]
+        self.frames[direction] += 1
+        self.bits[direction] += bits
+        self.node_frames[direction][msg.arbitration_id >> 5] += 1
+
+        second = int(monotonic())
+        slot = second % LOAD_HISTORY
+        if self._load_second[direction][slot] != second:
+            self._load_second[direction][slot] = second
+            self._load_frames[direction][slot] = 0
+            self._load_bits[direction][slot] = 0
+        self._load_frames[direction][slot] += 1
+        self._load_bits[direction][slot] += bits
+
+    def round_trip(self, node_id, endpoint_id, opcode, seconds):
+        """
+        Count an SDO request answered after seconds
+        :param node_id: Node id of the ODrive controller
+        :param endpoint_id: endpoint id from flat_endpoints.json
+        :param opcode: OPCODE_READ or OPCODE_WRITE
+        :param seconds: time from the request to its reply
+        :return:
+        """
+        microseconds = int(seconds * 1e6)
+        for table, key in (
+            (self.endpoint_latency, endpoint_id),
+            (self.node_latency, node_id),
+            (self.opcode_latency, opcode),
+        ):
+            histogram = table.get(key)
+            if histogram is None:
+                histogram = table[key] = LatencyHistogram()
+            histogram.record(microseconds)
+
+    def utilization(self, window=5):
+        """
+        Estimate the share of the bus in use over the last complete seconds
+        :param window: seconds to average over, at most LOAD_HISTORY
+        :return: dict of frames per second, utilization without stuff bits and with the worst case stuffing
+        """
+        now = int(monotonic())
+        window = min(window, LOAD_HISTORY, max(1, now - int(self.started)))
+        frames = 0
+        bits = 0
+        for direction in (0, 1):
+            for second, slot_frames, slot_bits in zip(
+                self._load_second[direction],
+                self._load_frames[direction],
+                self._load_bits[direction],
+            ):
+                if now - window <= second < now:
+                    frames += slot_frames
+                    bits += slot_bits
+        # SOF through CRC are bit stuffed, at worst one stuff bit per four bits after the first:
+        # (33 + 8 * dlc) // 4 = 8 per frame plus a quarter of the payload bits
+        stuffed = bits + 8 * frames + (bits - FRAME_BITS[0] * frames) // 4
+        return {
+            "frames_per_second": frames / window,
+            "utilization": bits / (window * self.bitrate),
+            "utilization_max": stuffed / (window * self.bitrate),
+        }
+
+    def interface_utilization(self, caller=None):
+        """
+        Estimate the share of the bus in use from the kernel's counters of the SocketCAN interface, which count
+        every frame on the bus whatever the acceptance filters pass up, averaged since the caller's previous call
+        :param caller: key the reading is kept under, so a periodic publisher's window isn't cut short by
+        someone else asking in between
+        :return: dict like utilization, None on the first call or without SocketCAN counters
+        """
+        if self.channel is None:
+            return None
+        try:
+            frames = 0
+            data_bytes = 0
+            for direction in ("rx", "tx"):
+                with open(
+                    INTERFACE_STATISTICS.format(self.channel, direction + "_packets")
+                ) as f:
+                    frames += int(f.read())
+                with open(
+                    INTERFACE_STATISTICS.format(self.channel, direction + "_bytes")
+                ) as f:
+                    data_bytes += int(f.read())
+        except (OSError, ValueError):
+            return None
+        now = monotonic()
+        previous = self._interface_samples.get(caller)
+        self._interface_samples[caller] = (now, frames, data_bytes)
+        if previous is None or now <= previous[0]:
+            return None
+        elapsed = now - previous[0]
+        frames -= previous[1]
+        bits = FRAME_BITS[0] * frames + 8 * (data_bytes - previous[2])
+        stuffed = bits + 8 * frames + (bits - FRAME_BITS[0] * frames) // 4
+        return {
+            "frames_per_second": frames / elapsed,
+            "utilization": bits / (elapsed * self.bitrate),
+            "utilization_max": stuffed / (elapsed * self.bitrate),
+        }
+
+    def stats(self, endpoint_names=None, window=5, caller=None):
+        """
+        :param endpoint_names: dict of endpoint id -> path to label endpoints with, None for ids
+        :param window: seconds the utilization is averaged over
+        :param caller: key for interface_utilization
+        :return: dict of the bus load of the frames that reached Python and of the whole interface (None when
+        unknown), frame counters and round trip summaries (see LatencyHistogram.summary) by endpoint, node
+        and opcode
+        """
+        names = endpoint_names or {}
+        elapsed = monotonic() - self.started
+        return {
+            "bitrate": self.bitrate,
+            "load": self.utilization(window),
+            "interface_load": self.interface_utilization(caller),
+            "frames": {
+                "received": self.frames[0],
+                "sent": self.frames[1],
+                "utilization_total": sum(self.bits) / (elapsed * self.bitrate),
+                "per_node": {
+                    node_id: {"received": received, "sent": sent}
+                    for node_id, (received, sent) in enumerate(zip(*self.node_frames))
+                    if received or sent
+                },
+            },
+            "round_trips": {
+                "endpoint": {
+                    names.get(endpoint_id, endpoint_id): histogram.summary()
+                    for endpoint_id, histogram in list(self.endpoint_latency.items())
+                },
+                "node": {
+                    node_id: histogram.summary()
+                    for node_id, histogram in list(self.node_latency.items())
+                },
+                "opcode": {
+                    OPCODE_NAMES[opcode]: histogram.summary()
+                    for opcode, histogram in list(self.opcode_latency.items())
+                },
+            },
+        }
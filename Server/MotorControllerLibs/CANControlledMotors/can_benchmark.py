@@ -0,0 +1,522 @@
+"""
+Benchmarks for the CAN layer. Run from the repository root:
+    python -m Server.MotorControllerLibs.CANControlledMotors.can_benchmark [--sim] [benchmark ...]
+With no benchmark names every benchmark is run. --sim runs against simulated ODrives on a virtual bus.
+"""
+
+import argparse
+import os
+import struct
+import subprocess
+import sys
+from statistics import mean, median
+from threading import Event
+from time import perf_counter, sleep
+
+from Server.MotorControllerLibs.CANControlledMotors import cansimple
+from Server.MotorControllerLibs.CANControlledMotors.bus_manager import (
+    PRIORITY_NAMES,
+    PRIORITY_SAFETY,
+    PRIORITY_TELEMETRY,
+    RX_SDO_IDS,
+    arbitration_id,
+)
+from Server.MotorControllerLibs.CANControlledMotors.can_functions import (
+    ENDPOINTS_FILE,
+    OPCODE_WRITE,
+    connect,
+    format_lookup,
+    get_bus_manager,
+    get_endpoint_data,
+    endpoint_cache_path,
+    get_property_value,
+    load_endpoint_data,
+    prepare_endpoint,
+    read_many,
+    send_bus_message,
+)
+
+NODE_IDS = [0, 1, 2, 3, 4, 5]
+READ_PATHS = [
+    "axis0.pos_estimate",
+    "axis0.vel_estimate",
+    "axis0.motor.torque_estimate",
+    "vbus_voltage",
+]
+
+
+def report(name, samples):
+    """
+    Print a latency summary
+    :param name: label for the measurement
+    :param samples: list of durations in seconds
+    :return: mean duration in seconds
+    """
+    ordered = sorted(samples)
+    p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+    print(
+        f"{name:<32} mean {mean(ordered) * 1e3:8.3f} ms   "
+        f"median {median(ordered) * 1e3:8.3f} ms   p99 {p99 * 1e3:8.3f} ms"
+    )
+    return mean(ordered)
+
+
+def bench_batch_reads(node_ids=NODE_IDS, paths=READ_PATHS, samples=200):
+    """
+    Time one sample of every path on every node, one round trip at a time versus read_many
+    """
+    requests = [(path, node_id) for node_id in node_ids for path in paths]
+    print(f"Batch reads: {len(node_ids)} nodes x {len(paths)} endpoints per sample")
+
+    serial = []
+    for _ in range(samples):
+        start = perf_counter()
+        for path, node_id in requests:
+            get_property_value(path, node_id, timeout=1)
+        serial.append(perf_counter() - start)
+
+    batch = []
+    for _ in range(samples):
+        start = perf_counter()
+        read_many(requests, timeout=1)
+        batch.append(perf_counter() - start)
+
+    serial_mean = report("serial get_property_value", serial)
+    batch_mean = report("read_many", batch)
+    print(f"speedup {serial_mean / batch_mean:.1f}x")
+
+
+def bench_fast_path(node_id=0, samples=2000):
+    """
+    Time each hot command from the call until its last frame has been handed to the interface, through the
+    generic SDO path versus its CANSimple command. The current state, limits and torque are read first and
+    written back unchanged, so the axis keeps doing whatever it was doing.
+    """
+    print(
+        f"Per command latency until sent, SDO endpoint write vs CANSimple, node {node_id}"
+    )
+    state, vel_limit, accel_limit, decel_limit, torque = read_many(
+        [
+            ("axis0.current_state", node_id),
+            ("axis0.trap_traj.config.vel_limit", node_id),
+            ("axis0.trap_traj.config.accel_limit", node_id),
+            ("axis0.trap_traj.config.decel_limit", node_id),
+            ("axis0.controller.input_torque", node_id),
+        ],
+        timeout=1,
+    )
+    # name, (SDO frames, CANSimple frames), SDO path, CANSimple path
+    commands = [
+        (
+            "axis state",
+            (1, 1),
+            lambda: send_bus_message(state, "axis0.requested_state", node_id),
+            lambda: cansimple.set_axis_state(node_id, state),
+        ),
+        (
+            "traj vel limit",
+            (1, 1),
+            lambda: send_bus_message(
+                vel_limit, "axis0.trap_traj.config.vel_limit", node_id
+            ),
+            lambda: cansimple.set_traj_vel_limit(node_id, vel_limit),
+        ),
+        (
+            "traj accel limits",
+            (2, 1),
+            lambda: (
+                send_bus_message(
+                    accel_limit, "axis0.trap_traj.config.accel_limit", node_id
+                ),
+                send_bus_message(
+                    decel_limit, "axis0.trap_traj.config.decel_limit", node_id
+                ),
+            ),
+            lambda: cansimple.set_traj_accel_limits(node_id, accel_limit, decel_limit),
+        ),
+        (
+            "input torque",
+            (1, 1),
+            lambda: send_bus_message(torque, "axis0.controller.input_torque", node_id),
+            lambda: cansimple.set_input_torque(node_id, torque),
+        ),
+    ]
+
+    manager = get_bus_manager(node_id)
+    sent = Event()
+    expected = [0]
+    sent_at = [0.0]
+
+    def tap(msg, transmitted):
+        # timed in the transmit thread, waking this thread up again is not part of the latency
+        if transmitted:
+            expected[0] -= 1
+            if expected[0] == 0:
+                sent_at[0] = perf_counter()
+                sent.set()
+
+    manager.add_tap(tap)
+    try:
+        for name, frames, sdo, fast in commands:
+            results = []
+            for send, count in zip((sdo, fast), frames):
+                durations = []
+                for _ in range(samples):
+                    sent.clear()
+                    expected[0] = count
+                    start = perf_counter()
+                    send()
+                    if not sent.wait(1):
+                        raise TimeoutError(f"{name} not sent")
+                    durations.append(sent_at[0] - start)
+                results.append(median(durations))
+            print(
+                f"{name:<20} SDO {results[0] * 1e6:8.2f} us   "
+                f"CANSimple {results[1] * 1e6:8.2f} us   {results[0] / results[1]:.1f}x"
+            )
+    finally:
+        manager.remove_tap(tap)
+
+
+def bench_codec(path="axis0.controller.input_pos", samples=200000):
+    """
+    Time encoding a write frame and decoding a reply frame, resolving the endpoint on every call
+    (as send_bus_message used to) versus through a prepared EndpointHandle. Does not touch the bus.
+    """
+    print(f"Encode/decode cost per frame for {path}")
+    endpoints = get_endpoint_data()["endpoints"]
+    reply = struct.pack("<BHBf", 0, endpoints[path]["id"], 0, 1.0)
+
+    def encode_before():
+        return struct.pack(
+            "<BHB" + format_lookup[endpoints[path]["type"]],
+            OPCODE_WRITE,
+            endpoints[path]["id"],
+            0,
+            1.0,
+        )
+
+    def decode_before():
+        return struct.unpack("<BHB" + format_lookup[endpoints[path]["type"]], reply)[3]
+
+    handle = prepare_endpoint(path)
+
+    def encode_after():
+        return handle.write_struct.pack(OPCODE_WRITE, handle.endpoint_id, 0, 1.0)
+
+    def decode_after():
+        return handle.reply_struct.unpack_from(reply)[3]
+
+    for name, before, after in (
+        ("encode", encode_before, encode_after),
+        ("decode", decode_before, decode_after),
+    ):
+        results = []
+        for function in (before, after):
+            start = perf_counter()
+            for _ in range(samples):
+                function()
+            results.append((perf_counter() - start) / samples)
+        print(
+            f"{name:<8} per call lookup {results[0] * 1e9:7.1f} ns   "
+            f"prepared {results[1] * 1e9:7.1f} ns   {results[0] / results[1]:.1f}x"
+        )
+
+
+def bench_estop_latency(node_ids=NODE_IDS, backlog=500, samples=100):
+    """
+    Time how long a stop frame takes to reach the interface with a saturated backlog of telemetry polls queued:
+    sent with send_now from the calling thread (what estop.emergency_stop does), queued in the safety lane,
+    and queued in the telemetry lane as plain FIFO would. Each is timed from the call until a transmit tap
+    sees the frame. The probe is a Get_Version request so it is safe to run on real hardware.
+    """
+    manager = get_bus_manager()
+    probe_id = arbitration_id(node_ids[0], 0x00)
+    poll = prepare_endpoint("axis0.pos_estimate").read_data
+    print(f"Stop frame latency behind {backlog} queued telemetry polls")
+
+    sent = Event()
+    sent_at = [0.0]
+
+    def tap(msg, transmitted):
+        # timed in the sending thread, waking this thread up again is not part of the latency
+        if transmitted and msg.arbitration_id == probe_id:
+            sent_at[0] = perf_counter()
+            sent.set()
+
+    paths = (
+        ("send_now (e-stop)", lambda: manager.send_now([(probe_id, b"")])),
+        ("safety lane", lambda: manager.send(probe_id, b"", PRIORITY_SAFETY)),
+        (
+            "telemetry lane (FIFO)",
+            lambda: manager.send(probe_id, b"", PRIORITY_TELEMETRY),
+        ),
+    )
+    manager.add_tap(tap)
+    try:
+        for name, send in paths:
+            latencies = []
+            for _ in range(samples):
+                for i in range(backlog):
+                    last = manager.send(
+                        RX_SDO_IDS[node_ids[i % len(node_ids)]],
+                        poll,
+                        PRIORITY_TELEMETRY,
+                    )
+                sent.clear()
+                start = perf_counter()
+                send()
+                if not sent.wait(5):
+                    raise TimeoutError(f"{name} probe not sent")
+                latencies.append(sent_at[0] - start)
+                last.result()
+            report(name, latencies)
+            print(f"{'':<32} worst {max(latencies) * 1e3:8.3f} ms")
+    finally:
+        manager.remove_tap(tap)
+
+    stats = manager.tx_stats()
+    for name in PRIORITY_NAMES:
+        lane = stats[name]
+        if lane["sent"]:
+            print(
+                f"{name + ' queueing delay':<32} mean {lane['mean_delay_ms']:8.3f} ms   "
+                f"p99 {lane['p99_delay_ms']:8.3f} ms   max {lane['max_delay_ms']:8.3f} ms"
+            )
+
+
+def bench_receive_filters(node_id=0, seconds=2.0):
+    """
+    Count the frames that reach Python in a window with the cyclic messages of one node subscribed,
+    with acceptance filters versus receiving everything on the bus. Needs the other nodes' telemetry
+    on the bus (e.g. --sim).
+    """
+    from Server.MotorControllerLibs.CANControlledMotors.telemetry import telemetry
+
+    manager = get_bus_manager()
+    telemetry.add_node(node_id)
+    print(f"Frames reaching Python in {seconds:.0f} s, node {node_id} subscribed")
+
+    results = []
+    for name, enabled in (("filtered", True), ("unfiltered", False)):
+        manager.set_receive_filters(enabled)
+        before = manager.rx_stats()
+        sleep(seconds)
+        after = manager.rx_stats()
+        received = after["received"] - before["received"]
+        used = after["used"] - before["used"]
+        results.append(received)
+        print(
+            f"{name:<32} received {received / seconds:8.0f}/s   used {used / seconds:8.0f}/s   "
+            f"({used / max(received, 1):.0%} used)"
+        )
+    manager.set_receive_filters(True)
+    telemetry.remove_node(node_id)
+    print(f"wakeups {results[1] / max(results[0], 1):.1f}x lower with filters")
+
+
+def bench_recorder(node_id=0, samples=2000):
+    """
+    Time endpoint round trips with and without the CAN recorder running, plus the cost of recording one frame
+    on the bus threads
+    """
+    import tempfile
+
+    from can import Message
+
+    from Server.MotorControllerLibs.CANControlledMotors.can_recorder import (
+        CanRecorder,
+        load,
+    )
+
+    print(f"Recording overhead, {samples} round trips to node {node_id}")
+    path = os.path.join(tempfile.mkdtemp(), "benchmark.canrec")
+    handle = prepare_endpoint("axis0.pos_estimate")
+
+    def round_trips():
+        durations = []
+        for _ in range(samples):
+            start = perf_counter()
+            handle.get(node_id, timeout=1)
+            durations.append(perf_counter() - start)
+        return durations
+
+    baseline = report("not recording", round_trips())
+    recorder = CanRecorder(path).start()
+    recording = report("recording", round_trips())
+    recorder.stop()
+    _, records = load(path)
+    print(
+        f"{'':<32} {len(records)} frames recorded, "
+        f"overhead {(recording - baseline) * 1e6:+.1f} us per round trip"
+    )
+
+    # the part that runs on the bus threads, the writer thread does the rest
+    recorder = CanRecorder(path).start()
+    tap = recorder._tap(0)
+    msg = Message(arbitration_id=RX_SDO_IDS[node_id], data=handle.read_data)
+    start = perf_counter()
+    for _ in range(samples * 100):
+        tap(msg, True)
+    per_frame = (perf_counter() - start) / (samples * 100)
+    recorder.stop()
+    print(f"{'tap per frame':<32} {per_frame * 1e9:8.0f} ns")
+    os.remove(path)
+
+
+def bench_metrics(node_id=0, samples=2000):
+    """
+    Time endpoint round trips with the bus metrics counting and switched off, plus the cost of each hook
+    """
+    from can import Message
+
+    from Server.MotorControllerLibs.CANControlledMotors.bus_metrics import BusMetrics
+
+    manager = get_bus_manager(node_id)
+    metrics = manager.metrics
+    handle = prepare_endpoint("axis0.pos_estimate")
+    print(f"Bus metrics overhead, {samples} round trips to node {node_id}")
+
+    def round_trips():
+        durations = []
+        for _ in range(samples):
+            start = perf_counter()
+            handle.get(node_id, timeout=1)
+            durations.append(perf_counter() - start)
+        return durations
+
+    manager.remove_tap(metrics.tap)
+    manager.metrics = None
+    baseline = report("metrics off", round_trips())
+    manager.metrics = metrics
+    manager.add_tap(metrics.tap)
+    counted = report("metrics on", round_trips())
+    print(f"{'':<32} overhead {(counted - baseline) * 1e6:+.1f} us per round trip")
+
+    scratch = BusMetrics(metrics.bitrate)
+    msg = Message(arbitration_id=RX_SDO_IDS[node_id], data=handle.read_data)
+    for name, hook in (
+        ("tap per frame", lambda: scratch.tap(msg, True)),
+        (
+            "round trip per reply",
+            lambda: scratch.round_trip(node_id, handle.endpoint_id, 0, 0.002),
+        ),
+    ):
+        start = perf_counter()
+        for _ in range(samples * 100):
+            hook()
+        print(f"{name:<32} {(perf_counter() - start) / (samples * 100) * 1e9:8.0f} ns")
+
+
+IMPORT_MODULES = [
+    "Server.MotorControllerLibs.CANControlledMotors.can_functions",
+    "Server.MotorControllerLibs.CANControlledMotors.cansimple",
+    "Server.MotorControllerLibs.CANControlledMotors.telemetry",
+    "Server.arm_main",
+]
+
+
+def _time_import(module, repository_root):
+    # os._exit skips the non-daemon server threads arm_main starts
+    code = (
+        "import os, time\n"
+        "start = time.perf_counter()\n"
+        f"import {module}\n"
+        "print(time.perf_counter() - start, flush=True)\n"
+        "os._exit(0)\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=repository_root,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def bench_import(modules=IMPORT_MODULES, samples=10):
+    """
+    Time importing each module in a fresh interpreter, plus loading the endpoint table with and without its cache
+    """
+    repository_root = os.path.realpath(
+        os.path.join(os.path.dirname(__file__), "../../..")
+    )
+    print("Import time in a fresh interpreter")
+    for module in modules:
+        try:
+            durations = [_time_import(module, repository_root) for _ in range(samples)]
+        except RuntimeError as e:
+            print(f"{module:<64} failed: {e}")
+            continue
+        report(module, durations)
+
+    cache_path = endpoint_cache_path(ENDPOINTS_FILE)
+    cold = []
+    warm = []
+    for _ in range(samples):
+        if cache_path is not None and os.path.exists(cache_path):
+            os.remove(cache_path)
+        start = perf_counter()
+        load_endpoint_data()
+        cold.append(perf_counter() - start)
+        start = perf_counter()
+        load_endpoint_data()
+        warm.append(perf_counter() - start)
+    report("endpoint table from JSON", cold)
+    report("endpoint table from cache", warm)
+
+
+BENCHMARKS = {
+    "batch_reads": bench_batch_reads,
+    "fast_path": bench_fast_path,
+    "codec": bench_codec,
+    "import": bench_import,
+    "estop_latency": bench_estop_latency,
+    "receive_filters": bench_receive_filters,
+    "recorder": bench_recorder,
+    "metrics": bench_metrics,
+}
+
+
+def start_simulator(node_ids=NODE_IDS, reply_latency=0.0005, channel="benchmark"):
+    """
+    Run the benchmarks against simulated ODrives on a virtual bus instead of can0
+    :param node_ids: node ids to simulate
+    :param reply_latency: seconds each simulated ODrive takes to answer
+    :param channel: virtual channel name
+    :return: the running OdriveSimulator
+    """
+    from Server.MotorControllerLibs.CANControlledMotors.odrive_simulator import (
+        OdriveSimulator,
+    )
+
+    simulator = OdriveSimulator(node_ids, channel=channel, reply_latency=reply_latency)
+    simulator.start()
+    connect(channel, interface="virtual")
+    return simulator
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CAN layer benchmarks")
+    parser.add_argument("benchmarks", nargs="*", help=", ".join(BENCHMARKS))
+    parser.add_argument(
+        "--sim", action="store_true", help="use simulated ODrives on a virtual bus"
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0005,
+        help="simulated reply latency in seconds",
+    )
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark {name}")
+
+    if args.sim:
+        start_simulator(reply_latency=args.latency)
+    for name in args.benchmarks or list(BENCHMARKS):
+        BENCHMARKS[name]()
+        print()
@@ -1,31 +1,27 @@
-import can
+import os
+import pickle
+import re
 import struct
-import json
 import subprocess
-from threading import Lock
-from time import sleep
-
-can_bus_lock = Lock()
-
-with open("MotorControllerLibs/CANControlledMotors/flat_endpoints.json", "r") as f:
-    endpoint_data = json.load(f)
-    endpoints = endpoint_data["endpoints"]
-
-command = "sudo ip link set can0 up type can bitrate 250000"
-try:
-    subprocess.run(command, shell=True, check=True)
-    print("CAN Connection command executed successfully.")
-except subprocess.CalledProcessError as e:
-    if (
-        e
-        == "Command 'sudo ip link set can0 up type can bitrate 250000' returned non-zero exit status 2."
-    ):
-        print("CAN Connection command already executed.")
-    else:
-        print(f"Error: {e}")
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from threading import Lock, Thread
+from time import monotonic, sleep
+
+from Server.MotorControllerLibs.CANControlledMotors.bus_manager import (
+    BusManager,
+    OPCODE_READ,
+    OPCODE_WRITE,
+    PRIORITY_CONFIG,
+    sdo_header,
+)
+from Server.MotorControllerLibs.CANControlledMotors.bus_metrics import BusMetrics
 
-OPCODE_READ = 0x00
-OPCODE_WRITE = 0x01
+file_path = os.path.dirname(os.path.realpath(__file__))
+ENDPOINTS_FILE = os.path.join(file_path, "flat_endpoints.json")
+
+CHANNEL = "can0"
+INTERFACE = "socketcan"
+BITRATE = 250000
 
 # See https://docs.python.org/3/library/struct.html#format-characters
 format_lookup = {
@@ -41,134 +37,531 @@ format_lookup = {
     "float": "f",
 }
 
-bus = can.interface.Bus("can0", bustype="socketcan")
+# node id -> channel of the bus it is on, nodes not listed are on the default bus (the first one connected)
+NODE_CHANNELS = {}
+
+# Nothing below is loaded or opened until it is first needed, see get_endpoint_data and connect
+_endpoint_data = None
+# channel -> open python-can bus / its BusManager
+_buses = {}
+_managers = {}
+_default_channel = None
+_default_interface = INTERFACE
+_connect_lock = Lock()
 
 
-def send_bus_message(value, obj_path, node_id, return_value=False):
+def endpoint_cache_path(json_path):
     """
-    Send a CAN message to an ODrive
-    :param return_value: if True, return any output
-    :param value: What value to send
-    :param obj_path: Path of the property to send to
+    Get the cache file for an endpoint table, named after its firmware version and crc.
+    Those sit at the top of the file, so the key is known without parsing all of it
+    :param json_path: path of the flat_endpoints.json file
+    :return: path of the pickle cache, or None if the file has no version header
+    """
+    with open(json_path, "r") as f:
+        header = f.read(256)
+    crc = re.search(r'"crc"\s*:\s*(\d+)', header)
+    fw_version = re.search(r'"fw_version"\s*:\s*"([^"]+)"', header)
+    if crc is None or fw_version is None:
+        return None
+    base = os.path.splitext(json_path)[0]
+    return f"{base}.{fw_version.group(1)}.{crc.group(1)}.pickle"
+
+
+def load_endpoint_data(json_path=ENDPOINTS_FILE):
+    """
+    Load an endpoint table, from the pickle cache next to it if there is one for the same crc and firmware version
+    :param json_path: path of the flat_endpoints.json file
+    :return: the endpoint table
+    """
+    cache_path = endpoint_cache_path(json_path)
+    if cache_path is not None:
+        try:
+            with open(cache_path, "rb") as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            pass
+
+    # only needed when the cache is cold
+    import json
+
+    with open(json_path, "r") as f:
+        data = json.load(f)
+
+    if cache_path is not None:
+        try:
+            with open(cache_path + ".tmp", "wb") as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(cache_path + ".tmp", cache_path)
+        except OSError as e:
+            print(f"Could not write endpoint cache: {e}")
+    return data
+
+
+def get_endpoint_data():
+    """
+    Get the endpoint table, loading it on first use
+    :return: the contents of flat_endpoints.json
+    """
+    global _endpoint_data
+    if _endpoint_data is None:
+        _endpoint_data = load_endpoint_data()
+    return _endpoint_data
+
+
+def endpoint_names():
+    """
+    :return: dict of endpoint id -> endpoint path, for labelling ids seen on the bus
+    """
+    return {
+        endpoint["id"]: path
+        for path, endpoint in get_endpoint_data()["endpoints"].items()
+        if "id" in endpoint
+    }
+
+
+def _bring_up_interface(channel, bitrate):
+    command = f"sudo ip link set {channel} up type can bitrate {bitrate}"
+    try:
+        subprocess.run(command, shell=True, check=True)
+        print("CAN Connection command executed successfully.")
+    except subprocess.CalledProcessError as e:
+        if e.returncode == 2:
+            print("CAN Connection command already executed.")
+        else:
+            print(f"Error: {e}")
+
+
+def connect(channel=CHANNEL, interface=INTERFACE, bitrate=BITRATE):
+    """
+    Open a bus and start its receiver and transmit threads. Called automatically with the defaults on first use,
+    call it yourself first to use another interface (e.g. interface="virtual"). Every bus gets its own threads
+    and queues; the first one connected is the default bus, channels in NODE_CHANNELS that aren't connected
+    yet are opened with the default bus's interface when first used.
+    :param channel: CAN channel name
+    :param interface: python-can interface name
+    :param bitrate: bitrate the socketcan interface is brought up with
+    :return: the BusManager of the channel
+    """
+    global _default_channel, _default_interface
+    with _connect_lock:
+        manager = _managers.get(channel)
+        if manager is not None:
+            return manager
+
+        # python-can is slow to import, so it is only imported once a bus is actually needed
+        import can
+
+        if interface == "socketcan":
+            _bring_up_interface(channel, bitrate)
+        bus = can.interface.Bus(channel, interface=interface)
+
+        # every received frame goes through the manager's receiver thread, nothing else may read from bus directly
+        manager = BusManager(
+            bus,
+            metrics=BusMetrics(bitrate, channel if interface == "socketcan" else None),
+        )
+        manager.start()
+        _buses[channel] = bus
+        _managers[channel] = manager
+        if _default_channel is None:
+            _default_channel = channel
+            _default_interface = interface
+        return manager
+
+
+def set_node_channel(node_id, channel):
+    """
+    Put a node on a bus, before anything is sent to it
     :param node_id: Node id of the ODrive controller
+    :param channel: CAN channel name, e.g. "can1"
     :return:
     """
-    with can_bus_lock:
-        # Convert path to endpoint ID
-        endpoint_id = endpoints[obj_path]["id"]
-        endpoint_type = endpoints[obj_path]["type"]
-
-        if endpoint_type == "function":
-            if value is None:
-                bus.send(
-                    can.Message(
-                        arbitration_id=(node_id << 5 | 0x04),  # 0x04: RxSdo
-                        data=struct.pack(
-                            "<BHB",
-                            OPCODE_WRITE,
-                            endpoint_id,
-                            0,
-                        ),
-                        is_extended_id=False,
-                    )
-                )
-            else:
-                bus.send(
-                    can.Message(
-                        arbitration_id=(node_id << 5 | 0x04),  # 0x04: RxSdo
-                        data=struct.pack(
-                            "<BHB"
-                            + format_lookup[endpoints[obj_path]["inputs"][0]["type"]],
-                            OPCODE_WRITE,
-                            endpoint_id,
-                            0,
-                            value,
-                        ),
-                        is_extended_id=False,
-                    )
-                )
-
-            if return_value and len(endpoints[obj_path]["outputs"]) > 0:
-                # Await reply
-                for msg in bus:
-                    if msg.arbitration_id == (node_id << 5 | 0x05):  # 0x05: TxSdo
-                        break
-
-                # Unpack and print reply
-                _, _, _, return_value = struct.unpack(
-                    "<BHB" + format_lookup[endpoint_type], msg.data
-                )
-                return return_value
-            return
+    NODE_CHANNELS[node_id] = channel
+
+
+def get_bus_manager(node_id=None):
+    """
+    Get the BusManager of a node's bus, opening the bus on first use
+    :param node_id: Node id of the ODrive controller, None for the default bus
+    :return: BusManager
+    """
+    channel = NODE_CHANNELS.get(node_id, _default_channel)
+    if channel is None:
+        return connect()
+    manager = _managers.get(channel)
+    if manager is None:
+        return connect(channel, _default_interface)
+    return manager
+
+
+def get_bus_managers():
+    """
+    :return: dict of channel -> BusManager of every connected bus
+    """
+    return dict(_managers)
+
+
+def bus_metrics(window=5, names=None, caller=None):
+    """
+    Get the load and round trip statistics of every connected bus, see BusMetrics.stats
+    :param window: seconds the bus utilization is averaged over
+    :param names: endpoint names from endpoint_names(), None to look them up
+    :param caller: key the interface counter readings are kept under, see BusMetrics.interface_utilization
+    :return: dict of channel -> stats
+    """
+    if names is None:
+        names = endpoint_names()
+    # connect may add a bus meanwhile
+    return {
+        channel: manager.metrics.stats(names, window, caller)
+        for channel, manager in list(_managers.items())
+        if manager.metrics is not None
+    }
+
+
+def publish_bus_metrics(data, key="bus_metrics", interval=1.0):
+    """
+    Keep data[key] set to bus_metrics(), e.g. a Server's data dict so clients can get it over the data channel
+    :param data: dict to publish into
+    :param key: key to publish under
+    :param interval: seconds between updates
+    :return:
+    """
+
+    def update_loop():
+        names = None
+        while True:
+            try:
+                if names is None:
+                    names = endpoint_names()
+                data[key] = bus_metrics(names=names, caller=key)
+            except Exception as e:
+                print(f"Error publishing bus metrics: {e}")
+            sleep(interval)
+
+    Thread(target=update_loop, daemon=True).start()
+
+
+def _split_by_bus(frames):
+    groups = {}
+    for frame in frames:
+        # arbitration id is node id << 5 | command id
+        groups.setdefault(get_bus_manager(frame[0] >> 5), []).append(frame)
+    return groups
+
+
+def send_burst(frames, priority=PRIORITY_CONFIG, deadline=None):
+    """
+    Queue frames for any number of nodes, back to back on each bus they are on
+    :param frames: list of (arbitration_id, data)
+    :param priority: transmit priority class, see bus_manager
+    :param deadline: seconds from now the frames have to be sent within, None waits as long as it takes
+    :return: list of Futures, one per bus
+    """
+    return [
+        manager.send_burst(group, priority, deadline)
+        for manager, group in _split_by_bus(frames).items()
+    ]
 
-        # Send write command
-        bus.send(
-            can.Message(
-                arbitration_id=(node_id << 5 | 0x04),  # 0x04: RxSdo
-                data=struct.pack(
-                    "<BHB" + format_lookup[endpoint_type],
-                    OPCODE_WRITE,
-                    endpoint_id,
-                    0,
-                    value,
-                ),
-                is_extended_id=False,
-            )
+
+def send_now(frames):
+    """
+    Send frames for any number of nodes straight away on every bus they are on, see BusManager.send_now
+    :param frames: list of (arbitration_id, data)
+    :return:
+    """
+    for manager, group in _split_by_bus(frames).items():
+        manager.send_now(group)
+
+
+def __getattr__(name):
+    # module level names from before the lazy startup, resolved (and loaded) on access
+    if name == "endpoint_data":
+        return get_endpoint_data()
+    if name == "endpoints":
+        return get_endpoint_data()["endpoints"]
+    if name == "bus_manager":
+        return get_bus_manager()
+    if name == "bus":
+        get_bus_manager()
+        return _buses[_default_channel]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+class EndpointHandle:
+    __slots__ = (
+        "path",
+        "endpoint_id",
+        "read_data",
+        "write_struct",
+        "write_data",
+        "reply_struct",
+        "write_reply_struct",
+    )
+
+    def __init__(self, obj_path):
+        """
+        Everything needed to talk to one endpoint, resolved once: the endpoint id, the constant read frame
+        and compiled layouts for writes and replies. Get one with prepare_endpoint. Nothing is looked up
+        until the handle is first used, so handles can be prepared at import without loading the endpoint
+        table; an unknown path raises KeyError then.
+        :param obj_path: Path of the property or function
+        """
+        self.path = obj_path
+
+    def __getattr__(self, name):
+        # only called for slots that aren't filled yet, i.e. before the first use
+        self._resolve()
+        return object.__getattribute__(self, name)
+
+    def _resolve(self):
+        endpoint = get_endpoint_data()["endpoints"][self.path]
+        self.endpoint_id = endpoint["id"]
+
+        if endpoint["type"] == "function":
+            inputs, outputs = endpoint["inputs"], endpoint["outputs"]
+            value_format = format_lookup[inputs[0]["type"]] if inputs else ""
+            reply_format = format_lookup[outputs[0]["type"]] if outputs else None
+            self.read_data = None
+            self.reply_struct = None
+        else:
+            # property writes are not acknowledged
+            value_format = format_lookup[endpoint["type"]]
+            reply_format = None
+            self.read_data = sdo_header.pack(OPCODE_READ, self.endpoint_id, 0)
+            self.reply_struct = struct.Struct("<BHB" + value_format)
+
+        self.write_struct = struct.Struct("<BHB" + value_format)
+        # frame for writes without a value (functions without inputs)
+        self.write_data = sdo_header.pack(OPCODE_WRITE, self.endpoint_id, 0)
+        self.write_reply_struct = (
+            None if reply_format is None else struct.Struct("<BHB" + reply_format)
         )
 
-        if "outputs" in endpoints[obj_path] and return_value:
-            # Await reply
-            for msg in bus:
-                if msg.arbitration_id == (node_id << 5 | 0x05):  # 0x05: TxSdo
-                    break
+    def __repr__(self):
+        return f"EndpointHandle({self.path!r}, id={self.endpoint_id})"
 
-            # Unpack and print reply
-            _, _, _, return_value = struct.unpack(
-                "<BHB" + format_lookup[endpoint_type], msg.data
-            )
-            return return_value
+    def request_read(self, node_id, priority=PRIORITY_CONFIG, deadline=None):
+        """
+        Request the value of the property without waiting for the reply
+        :param node_id: Node id of the ODrive controller
+        :param priority: transmit priority class, see bus_manager
+        :param deadline: seconds from now the request has to be sent within, None waits as long as it takes
+        :return: Future resolving to the value
+        """
+        if self.read_data is None:
+            raise TypeError(f"{self.path} is a function and can't be read")
+        return get_bus_manager(node_id).sdo_request(
+            node_id,
+            self.endpoint_id,
+            self.read_data,
+            self.reply_struct,
+            priority,
+            deadline,
+        )
+
+    def request_write(
+        self,
+        value,
+        node_id,
+        return_value=False,
+        priority=PRIORITY_CONFIG,
+        deadline=None,
+    ):
+        """
+        Write the property (or call the function) without waiting for the reply
+        :param value: What value to send, None for functions without inputs
+        :param node_id: Node id of the ODrive controller
+        :param return_value: if True, register for the reply
+        :param priority: transmit priority class, see bus_manager
+        :param deadline: seconds from now the request has to be sent within, None waits as long as it takes
+        :return: Future resolving to the reply, or None if no reply was requested
+        """
+        data = (
+            self.write_data
+            if value is None
+            else self.write_struct.pack(OPCODE_WRITE, self.endpoint_id, 0, value)
+        )
+        return get_bus_manager(node_id).sdo_request(
+            node_id,
+            self.endpoint_id,
+            data,
+            self.write_reply_struct if return_value else None,
+            priority,
+            deadline,
+        )
+
+    def get(self, node_id, timeout=None, priority=PRIORITY_CONFIG):
+        """
+        Get the value of the property
+        :param node_id: Node id of the ODrive controller
+        :param timeout: seconds to wait for the reply, None waits forever
+        :param priority: transmit priority class, see bus_manager
+        :return:
+        """
+        return _result(self.request_read(node_id, priority, timeout), timeout)
+
+    def set(
+        self, value, node_id, return_value=False, timeout=None, priority=PRIORITY_CONFIG
+    ):
+        """
+        Write the property (or call the function)
+        :param value: What value to send, None for functions without inputs
+        :param node_id: Node id of the ODrive controller
+        :param return_value: if True, return any output
+        :param timeout: seconds to wait for the reply, None waits forever
+        :param priority: transmit priority class, see bus_manager
+        :return:
+        """
+        future = self.request_write(value, node_id, return_value, priority, timeout)
+        if future is None:
+            return
+        return _result(future, timeout)
+
+
+_handles = {}
 
 
-def get_property_value(obj_path, node_id):
+def prepare_endpoint(obj_path):
+    """
+    Get the (cached) handle for an endpoint, hold on to it for anything on a hot path
+    :param obj_path: Path of the property or function
+    :return: EndpointHandle
+    """
+    handle = _handles.get(obj_path)
+    if handle is None:
+        handle = _handles[obj_path] = EndpointHandle(obj_path)
+    return handle
+
+
+def _handle(obj_path):
+    if isinstance(obj_path, EndpointHandle):
+        return obj_path
+    return prepare_endpoint(obj_path)
+
+
+def request_bus_message(value, obj_path, node_id, return_value=False):
+    """
+    Send a CAN message to an ODrive without waiting for the reply
+    :param value: What value to send, None for functions without inputs
+    :param obj_path: Path (or EndpointHandle) of the property to send to
+    :param node_id: Node id of the ODrive controller
+    :param return_value: if True, register for the reply
+    :return: Future resolving to the reply, or None if no reply was requested
+    """
+    return _handle(obj_path).request_write(value, node_id, return_value)
+
+
+def request_property_value(obj_path, node_id):
+    """
+    Request the value of a property from an ODrive without waiting for the reply
+    :param obj_path: Path (or EndpointHandle) of the property to get
+    :param node_id: Node id of odrive controller
+    :return: Future resolving to the value
+    """
+    return _handle(obj_path).request_read(node_id)
+
+
+def _result(future, timeout):
+    try:
+        return future.result(timeout)
+    except FutureTimeoutError:
+        # waiting ran out (before 3.11 not the builtin TimeoutError): the request keeps its place in line,
+        # the receiver drops its late reply
+        future.cancel()
+        raise
+
+
+def send_bus_message(value, obj_path, node_id, return_value=False, timeout=None):
+    """
+    Send a CAN message to an ODrive
+    :param return_value: if True, return any output
+    :param value: What value to send
+    :param obj_path: Path (or EndpointHandle) of the property to send to
+    :param node_id: Node id of the ODrive controller
+    :param timeout: seconds to wait for the reply, None waits forever
+    :return:
+    """
+    future = request_bus_message(value, obj_path, node_id, return_value)
+    if future is None:
+        return
+    return _result(future, timeout)
+
+
+def get_property_value(obj_path, node_id, timeout=None):
     """
     Get the value of a property from an ODrive
-    :param obj_path: Path of the property to get
+    :param obj_path: Path (or EndpointHandle) of the property to get
     :param node_id: Node id of odrive controller
+    :param timeout: seconds to wait for the reply, None waits forever
     :return:
     """
-    with can_bus_lock:
-        # Convert path to endpoint ID
-        endpoint_id = endpoints[obj_path]["id"]
-        endpoint_type = endpoints[obj_path]["type"]
-
-        # Flush CAN RX buffer so there are no more old pending messages
-        while bus.recv(timeout=0) is not None:
-            sleep(0.001)
-
-        # Send read command
-        bus.send(
-            can.Message(
-                arbitration_id=(node_id << 5 | 0x04),  # 0x04: RxSdo
-                data=struct.pack("<BHB", OPCODE_READ, endpoint_id, 0),
-                is_extended_id=False,
-            )
-        )
+    return _result(request_property_value(obj_path, node_id), timeout)
 
-        # Await reply
-        for msg in bus:
-            if msg.arbitration_id == (node_id << 5 | 0x05):  # 0x05: TxSdo
-                break
 
-        # Unpack and print reply
-        _, _, _, return_value = struct.unpack(
-            "<BHB" + format_lookup[endpoint_type], msg.data
-        )
-        return return_value
+def _collect(futures, timeout):
+    # timeout applies to the whole batch, not to each reply
+    deadline = None if timeout is None else monotonic() + timeout
+    results = []
+    for i, future in enumerate(futures):
+        if future is None:
+            results.append(None)
+            continue
+        remaining = None if deadline is None else max(0.0, deadline - monotonic())
+        try:
+            results.append(_result(future, remaining))
+        # either waiting ran out or the request had no reply (the builtin TimeoutError)
+        except (FutureTimeoutError, TimeoutError):
+            for later in futures[i + 1 :]:
+                if later is not None:
+                    later.cancel()
+            raise
+    return results
+
+
+def read_many(requests, timeout=None, priority=PRIORITY_CONFIG):
+    """
+    Get the values of many properties, possibly across many ODrives, sending every request back to back
+    and collecting the replies as they arrive
+    :param requests: list of (obj_path or EndpointHandle, node_id)
+    :param timeout: seconds to wait for all replies, None waits forever
+    :param priority: transmit priority class, see bus_manager
+    :return: list of values in the same order as requests
+    """
+    futures = [
+        _handle(obj_path).request_read(node_id, priority, timeout)
+        for obj_path, node_id in requests
+    ]
+    return _collect(futures, timeout)
+
+
+def write_many(messages, return_value=False, timeout=None, priority=PRIORITY_CONFIG):
+    """
+    Send many CAN messages, possibly across many ODrives, back to back
+    :param messages: list of (value, obj_path or EndpointHandle, node_id)
+    :param return_value: if True, wait for and return any outputs
+    :param timeout: seconds to wait for all replies, None waits forever
+    :param priority: transmit priority class, see bus_manager
+    :return: list of outputs in the same order as messages (None where there is no output)
+    """
+    futures = [
+        _handle(obj_path).request_write(value, node_id, return_value, priority)
+        for value, obj_path, node_id in messages
+    ]
+    if not return_value:
+        return
+    return _collect(futures, timeout)
 
 
 def shutdown():
     """
-    Shutdown CAN bus
+    Shutdown every CAN bus
     :return:
     """
-    bus.shutdown()
+    global _default_channel
+    with _connect_lock:
+        for channel, manager in list(_managers.items()):
+            manager.stop()
+            _buses.pop(channel).shutdown()
+            del _managers[channel]
+        _default_channel = None
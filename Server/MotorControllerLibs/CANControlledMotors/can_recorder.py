@@ -0,0 +1,326 @@
+"""
+Records every CAN frame sent and received through can_functions into a binary file for offline analysis,
+and plays recordings back onto a virtual bus. Run from the repository root to print a recording:
+    python -m Server.MotorControllerLibs.CANControlledMotors.can_recorder recording.canrec
+
+A recording is a HEADER_SIZE byte header followed by fixed-size records (record_dtype), so it can be opened
+with np.memmap (see load) and sliced without parsing. Timestamps are time.monotonic_ns().
+"""
+
+import struct
+import sys
+from collections import deque
+from threading import Event, Thread
+from time import monotonic_ns, perf_counter_ns, sleep
+
+import numpy as np
+
+from Server.MotorControllerLibs.CANControlledMotors.bus_manager import (
+    CMD_RX_SDO,
+    CMD_TX_SDO,
+)
+from Server.MotorControllerLibs.CANControlledMotors.can_functions import (
+    endpoint_names,
+    get_bus_managers,
+)
+
+MAGIC = b"ODCANREC"
+VERSION = 1
+# magic, version, record size, then the recorded channel names, comma separated and zero padded
+file_header = struct.Struct("<8sHH4x48s")
+HEADER_SIZE = file_header.size
+
+# one frame: timestamp, arbitration id, channel index, flags, payload length, payload
+record = struct.Struct("<QHBBB3x8s")
+record_dtype = np.dtype(
+    [
+        ("timestamp_ns", "<u8"),
+        ("arbitration_id", "<u2"),
+        ("channel", "u1"),
+        ("flags", "u1"),
+        ("dlc", "u1"),
+        ("reserved", "V3"),
+        ("data", "u1", 8),
+    ]
+)
+FLAG_TRANSMITTED = 0x01
+
+# records packed per write by the writer thread
+WRITE_BATCH = 4096
+
+# the last stretch before a frame's slot is spun rather than slept, see trajectory_stream
+SPIN_NS = 200_000
+
+# CANSimple command names, see https://docs.odriverobotics.com/v/latest/manual/can-protocol.html
+CMD_NAMES = {
+    0x00: "Get_Version",
+    0x01: "Heartbeat",
+    0x02: "Estop",
+    0x03: "Get_Error",
+    0x04: "RxSdo",
+    0x05: "TxSdo",
+    0x06: "Address",
+    0x07: "Set_Axis_State",
+    0x09: "Get_Encoder_Estimates",
+    0x0B: "Set_Controller_Mode",
+    0x0C: "Set_Input_Pos",
+    0x0D: "Set_Input_Vel",
+    0x0E: "Set_Input_Torque",
+    0x0F: "Set_Limits",
+    0x10: "Start_Anticogging",
+    0x11: "Set_Traj_Vel_Limit",
+    0x12: "Set_Traj_Accel_Limits",
+    0x13: "Set_Traj_Inertia",
+    0x14: "Get_Iq",
+    0x15: "Get_Temperature",
+    0x16: "Reboot",
+    0x17: "Get_Bus_Voltage_Current",
+    0x18: "Clear_Errors",
+    0x19: "Set_Absolute_Position",
+    0x1A: "Set_Pos_Gain",
+    0x1B: "Set_Vel_Gains",
+    0x1C: "Get_Torques",
+    0x1D: "Get_Powers",
+    0x1F: "Enter_DFU_Mode",
+}
+OPCODE_NAMES = ("read", "write")
+
+
+class CanRecorder:
+    def __init__(self, path, flush_interval=0.05):
+        """
+        Appends the frames of every connected bus to a recording. Frames are only timestamped and queued on the
+        threads that send and receive them, a writer thread packs and writes them in batches, so recording
+        takes no lock and does no I/O on the bus threads.
+        Buses connected after start() are not recorded.
+        :param path: file to write, replaced if it exists
+        :param flush_interval: seconds between writes
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.frames = 0
+        self.channels = []
+
+        # (timestamp, channel index, msg, transmitted), deque appends and pops are atomic
+        self._queue = deque()
+        self._taps = {}
+        self._stop = Event()
+        self._thread = None
+        self._file = None
+
+    def start(self):
+        """
+        Write the header and start recording every connected bus
+        :return: self
+        """
+        if self._thread is not None:
+            return self
+        managers = get_bus_managers()
+        self.channels = list(managers)
+        names = ",".join(self.channels).encode()
+        if len(names) > 48:
+            raise ValueError(f"Channel names too long to record: {names!r}")
+        self._file = open(self.path, "wb")
+        self._file.write(file_header.pack(MAGIC, VERSION, record.size, names))
+
+        self._stop.clear()
+        self._thread = Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+        for index, manager in enumerate(managers.values()):
+            self._taps[manager] = self._tap(index)
+            manager.add_tap(self._taps[manager])
+        return self
+
+    def _tap(self, index):
+        append = self._queue.append
+
+        def tap(msg, transmitted):
+            append((monotonic_ns(), index, msg, transmitted))
+
+        return tap
+
+    def stop(self):
+        """
+        Stop recording and write out everything still queued
+        :return: number of frames recorded
+        """
+        for manager, tap in self._taps.items():
+            manager.remove_tap(tap)
+        self._taps = {}
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        return self.frames
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+    def _write_loop(self):
+        buffer = bytearray(WRITE_BATCH * record.size)
+        pack_into = record.pack_into
+        popleft = self._queue.popleft
+        while True:
+            stopping = self._stop.wait(self.flush_interval)
+            while self._queue:
+                offset = 0
+                while self._queue and offset < len(buffer):
+                    timestamp, channel, msg, transmitted = popleft()
+                    pack_into(
+                        buffer,
+                        offset,
+                        timestamp,
+                        msg.arbitration_id,
+                        channel,
+                        FLAG_TRANSMITTED if transmitted else 0,
+                        msg.dlc,
+                        bytes(msg.data),
+                    )
+                    offset += record.size
+                self._file.write(memoryview(buffer)[:offset])
+                self.frames += offset // record.size
+            self._file.flush()
+            if stopping:
+                return
+
+
+def record_to(path, flush_interval=0.05):
+    """
+    Start recording every connected bus, e.g.
+        with record_to("moves.canrec"):
+            arm.move(angles).wait()
+    :param path: file to write
+    :param flush_interval: seconds between writes
+    :return: the started CanRecorder
+    """
+    return CanRecorder(path, flush_interval).start()
+
+
+def load(path):
+    """
+    Map a recording without reading it
+    :param path: recording file
+    :return: (list of channel names, read only memmap of record_dtype)
+    """
+    with open(path, "rb") as f:
+        magic, version, record_size, names = file_header.unpack(f.read(HEADER_SIZE))
+    if magic != MAGIC or version != VERSION or record_size != record_dtype.itemsize:
+        raise ValueError(f"{path} is not a version {VERSION} CAN recording")
+    channels = names.rstrip(b"\0").decode().split(",")
+    records = np.memmap(path, dtype=record_dtype, mode="r", offset=HEADER_SIZE)
+    return channels, records
+
+
+def decode(records, channels=None):
+    """
+    Annotate recorded frames with the node, the CANSimple command and, for SDO frames, the endpoint path
+    :param records: array of record_dtype, e.g. from load
+    :param channels: channel names from load, None to keep channel indexes
+    :return: list of dicts, one per frame
+    """
+    names = endpoint_names()
+    start = int(records["timestamp_ns"][0]) if len(records) else 0
+    decoded = []
+    for row in records:
+        arb_id = int(row["arbitration_id"])
+        cmd_id = arb_id & 0x1F
+        data = bytes(row["data"][: row["dlc"]])
+        channel = int(row["channel"])
+        frame = {
+            "time_ms": (int(row["timestamp_ns"]) - start) / 1e6,
+            "channel": channels[channel] if channels else channel,
+            "direction": "tx" if row["flags"] & FLAG_TRANSMITTED else "rx",
+            "node_id": arb_id >> 5,
+            "command": CMD_NAMES.get(cmd_id, hex(cmd_id)),
+            "data": data,
+        }
+        if cmd_id in (CMD_RX_SDO, CMD_TX_SDO) and len(data) >= 3:
+            endpoint_id = data[1] | data[2] << 8
+            frame["endpoint"] = names.get(endpoint_id, endpoint_id)
+            if cmd_id == CMD_RX_SDO:
+                frame["opcode"] = OPCODE_NAMES[data[0]] if data[0] < 2 else data[0]
+        decoded.append(frame)
+    return decoded
+
+
+def describe(frame):
+    """
+    :param frame: a dict from decode
+    :return: one line summary of the frame
+    """
+    line = (
+        f"{frame['time_ms']:12.3f} ms  {frame['channel']:<8} {frame['direction']}  "
+        f"node {frame['node_id']:<2} {frame['command']:<24}"
+    )
+    if "endpoint" in frame:
+        line += f" {frame.get('opcode', 'reply'):<5} {frame['endpoint']}"
+    return line + f"  [{frame['data'].hex()}]"
+
+
+def replay(path, channels=None, transmitted=None, speed=1.0):
+    """
+    Send a recording onto virtual buses with its original timing, e.g. to drive code under test with recorded
+    ODrive traffic (transmitted=False) or an OdriveSimulator with recorded commands (transmitted=True)
+    :param path: recording file
+    :param channels: dict of recorded channel -> virtual channel to send it on, None keeps the recorded names
+    :param transmitted: True for only the frames that were sent, False for only those received, None for both
+    :param speed: playback speed, 2 plays twice as fast
+    :return: number of frames sent
+    """
+    # python-can is slow to import, only needed here
+    import can
+
+    recorded_channels, records = load(path)
+    if transmitted is not None:
+        sent = (records["flags"] & FLAG_TRANSMITTED).astype(bool)
+        records = records[sent if transmitted else ~sent]
+    if not len(records):
+        return 0
+    channels = channels or {}
+    buses = [
+        can.interface.Bus(channels.get(channel, channel), interface="virtual")
+        for channel in recorded_channels
+    ]
+    # every frame's slot relative to the first, scheduled from one start so sleep overshoot never accumulates
+    offsets = ((records["timestamp_ns"] - records["timestamp_ns"][0]) / speed).astype(
+        np.int64
+    )
+    messages = [
+        can.Message(
+            arbitration_id=int(row["arbitration_id"]),
+            data=bytes(row["data"][: row["dlc"]]),
+            is_extended_id=False,
+        )
+        for row in records
+    ]
+
+    try:
+        start = perf_counter_ns()
+        for offset, channel, msg in zip(offsets.tolist(), records["channel"], messages):
+            deadline = start + offset
+            remaining = deadline - perf_counter_ns()
+            if remaining > SPIN_NS:
+                sleep((remaining - SPIN_NS) / 1e9)
+            while perf_counter_ns() < deadline:
+                pass
+            buses[channel].send(msg)
+    finally:
+        for bus in buses:
+            bus.shutdown()
+    return len(messages)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print(__doc__)
+        sys.exit(1)
+    recorded_channels, recorded = load(sys.argv[1])
+    for decoded_frame in decode(recorded, recorded_channels):
+        print(describe(decoded_frame))
@@ -0,0 +1,177 @@
+"""
+Dedicated CANSimple commands for the hot paths. Each one is a single frame with a precompiled layout,
+no endpoint lookup and no SDO header, see https://docs.odriverobotics.com/v/latest/manual/can-protocol.html
+Estop and IDLE go out in the safety class, everything else in the motion class so they keep their order.
+"""
+
+import struct
+
+from Server.MotorControllerLibs.CANControlledMotors.bus_manager import (
+    PRIORITY_MOTION,
+    PRIORITY_SAFETY,
+)
+from Server.MotorControllerLibs.CANControlledMotors.can_functions import get_bus_manager
+
+CMD_ESTOP = 0x02
+CMD_SET_AXIS_STATE = 0x07
+CMD_SET_CONTROLLER_MODE = 0x0B
+CMD_SET_INPUT_POS = 0x0C
+CMD_SET_INPUT_VEL = 0x0D
+CMD_SET_INPUT_TORQUE = 0x0E
+CMD_SET_TRAJ_VEL_LIMIT = 0x11
+CMD_SET_TRAJ_ACCEL_LIMITS = 0x12
+CMD_CLEAR_ERRORS = 0x18
+CMD_SET_ABSOLUTE_POSITION = 0x19
+
+AXIS_STATE_IDLE = 1
+AXIS_STATE_CLOSED_LOOP_CONTROL = 8
+
+CONTROL_MODE_POSITION = 3
+
+INPUT_MODE_PASSTHROUGH = 1
+INPUT_MODE_POS_FILTER = 3
+INPUT_MODE_TRAP_TRAJ = 5
+
+u32 = struct.Struct("<I")
+f32 = struct.Struct("<f")
+two_u32 = struct.Struct("<II")
+two_f32 = struct.Struct("<ff")
+# position, velocity feedforward (0.001 rev/s), torque feedforward (0.001 Nm)
+input_pos = struct.Struct("<fhh")
+
+INT16_MIN = -0x8000
+INT16_MAX = 0x7FFF
+
+
+def _scaled_int16(value):
+    return max(INT16_MIN, min(INT16_MAX, round(value * 1000)))
+
+
+def input_pos_data(pos, vel_ff=0.0, torque_ff=0.0):
+    """
+    Pack a Set_Input_Pos payload, for callers building several frames to send in one burst
+    :param pos: position in revolutions
+    :param vel_ff: velocity feedforward in rev/s, resolution 0.001
+    :param torque_ff: torque feedforward in Nm, resolution 0.001
+    :return: payload bytes
+    """
+    return input_pos.pack(pos, _scaled_int16(vel_ff), _scaled_int16(torque_ff))
+
+
+def estop(node_id):
+    """
+    Put the axis in IDLE and raise ESTOP_REQUESTED
+    :param node_id: Node id of the ODrive controller
+    :return: Future resolving once the frame is sent
+    """
+    return get_bus_manager(node_id).send(node_id << 5 | CMD_ESTOP, b"", PRIORITY_SAFETY)
+
+
+def set_axis_state(node_id, state):
+    """
+    :param node_id: Node id of the ODrive controller
+    :param state: requested axis state (AXIS_STATE_IDLE, AXIS_STATE_CLOSED_LOOP_CONTROL, ...)
+    :return: Future resolving once the frame is sent
+    """
+    priority = PRIORITY_SAFETY if state == AXIS_STATE_IDLE else PRIORITY_MOTION
+    return get_bus_manager(node_id).send(
+        node_id << 5 | CMD_SET_AXIS_STATE, u32.pack(state), priority
+    )
+
+
+def set_controller_mode(node_id, control_mode, input_mode):
+    """
+    :param node_id: Node id of the ODrive controller
+    :param control_mode: controller.config.control_mode
+    :param input_mode: controller.config.input_mode
+    :return: Future resolving once the frame is sent
+    """
+    return get_bus_manager(node_id).send(
+        node_id << 5 | CMD_SET_CONTROLLER_MODE,
+        two_u32.pack(control_mode, input_mode),
+        PRIORITY_MOTION,
+    )
+
+
+def set_input_pos(node_id, pos, vel_ff=0.0, torque_ff=0.0):
+    """
+    :param node_id: Node id of the ODrive controller
+    :param pos: position in revolutions
+    :param vel_ff: velocity feedforward in rev/s, resolution 0.001
+    :param torque_ff: torque feedforward in Nm, resolution 0.001
+    :return: Future resolving once the frame is sent
+    """
+    return get_bus_manager(node_id).send(
+        node_id << 5 | CMD_SET_INPUT_POS,
+        input_pos_data(pos, vel_ff, torque_ff),
+        PRIORITY_MOTION,
+    )
+
+
+def set_input_vel(node_id, vel, torque_ff=0.0):
+    """
+    :param node_id: Node id of the ODrive controller
+    :param vel: velocity in rev/s
+    :param torque_ff: torque feedforward in Nm
+    :return: Future resolving once the frame is sent
+    """
+    return get_bus_manager(node_id).send(
+        node_id << 5 | CMD_SET_INPUT_VEL, two_f32.pack(vel, torque_ff), PRIORITY_MOTION
+    )
+
+
+def set_input_torque(node_id, torque):
+    """
+    :param node_id: Node id of the ODrive controller
+    :param torque: torque in Nm
+    :return: Future resolving once the frame is sent
+    """
+    return get_bus_manager(node_id).send(
+        node_id << 5 | CMD_SET_INPUT_TORQUE, f32.pack(torque), PRIORITY_MOTION
+    )
+
+
+def set_traj_vel_limit(node_id, vel_limit):
+    """
+    :param node_id: Node id of the ODrive controller
+    :param vel_limit: trap_traj velocity limit in rev/s
+    :return: Future resolving once the frame is sent
+    """
+    return get_bus_manager(node_id).send(
+        node_id << 5 | CMD_SET_TRAJ_VEL_LIMIT, f32.pack(vel_limit), PRIORITY_MOTION
+    )
+
+
+def set_traj_accel_limits(node_id, accel_limit, decel_limit):
+    """
+    :param node_id: Node id of the ODrive controller
+    :param accel_limit: trap_traj acceleration limit in rev/s^2
+    :param decel_limit: trap_traj deceleration limit in rev/s^2
+    :return: Future resolving once the frame is sent
+    """
+    return get_bus_manager(node_id).send(
+        node_id << 5 | CMD_SET_TRAJ_ACCEL_LIMITS,
+        two_f32.pack(accel_limit, decel_limit),
+        PRIORITY_MOTION,
+    )
+
+
+def clear_errors(node_id):
+    """
+    :param node_id: Node id of the ODrive controller
+    :return: Future resolving once the frame is sent
+    """
+    return get_bus_manager(node_id).send(
+        node_id << 5 | CMD_CLEAR_ERRORS, b"\x00", PRIORITY_MOTION
+    )
+
+
+def set_absolute_position(node_id, pos):
+    """
+    :param node_id: Node id of the ODrive controller
+    :param pos: new absolute position in revolutions
+    :return: Future resolving once the frame is sent
+    """
+    return get_bus_manager(node_id).send(
+        node_id << 5 | CMD_SET_ABSOLUTE_POSITION, f32.pack(pos), PRIORITY_MOTION
+    )
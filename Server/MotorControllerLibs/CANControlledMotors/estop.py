@@ -0,0 +1,95 @@
+from concurrent.futures import Future, wait
+from time import monotonic, perf_counter
+
+from Server.MotorControllerLibs.CANControlledMotors.bus_manager import arbitration_id
+from Server.MotorControllerLibs.CANControlledMotors.can_functions import send_now
+from Server.MotorControllerLibs.CANControlledMotors.telemetry import telemetry
+from Server.MotorControllerLibs.CANControlledMotors import cansimple
+
+# ODrive AxisError bit the Estop command latches
+AXIS_ERROR_ESTOP_REQUESTED = 0x4000
+
+# how each mode stops an axis: command id and payload
+STOP_FRAMES = {
+    # IDLE with ESTOP_REQUESTED latched, clear_errors before the axis can be enabled again
+    "estop": (cansimple.CMD_ESTOP, b""),
+    # plain IDLE, nothing latched
+    "idle": (
+        cansimple.CMD_SET_AXIS_STATE,
+        cansimple.u32.pack(cansimple.AXIS_STATE_IDLE),
+    ),
+}
+
+
+def emergency_stop(node_ids=None, mode="estop", timeout=0.5, started=None):
+    """
+    Stop every axis at once: one frame per node, sent back to back from the calling thread ahead of anything
+    queued, then wait for each node's heartbeat to report IDLE
+    :param node_ids: nodes to stop, None for every node telemetry is decoding. ValueError if that leaves none
+    :param mode: "estop" (latches ESTOP_REQUESTED) or "idle"
+    :param timeout: seconds to wait for the heartbeats
+    :param started: perf_counter() of when the stop was asked for (e.g. when the server command arrived),
+    None for now
+    :return: dict with the nodes that confirmed (node id -> ms after started) and those that didn't,
+    the ms until the burst was sent and until the last confirmation
+    """
+    if started is None:
+        started = perf_counter()
+    if node_ids is None:
+        node_ids = list(telemetry.state)
+    if not node_ids:
+        raise ValueError("No ODrive nodes to stop")
+    cmd_id, data = STOP_FRAMES[mode]
+    frames = [(arbitration_id(node_id, cmd_id), data) for node_id in node_ids]
+
+    # listening before the burst goes out so a fast heartbeat can't be missed,
+    # only heartbeats stamped after this (telemetry uses monotonic()) count
+    stop_time = monotonic()
+    confirmations = {node_id: Future() for node_id in node_ids}
+    confirmed_at = {}
+
+    # an axis that was already IDLE only confirms an estop once the error is latched too
+    required_error = AXIS_ERROR_ESTOP_REQUESTED if mode == "estop" else 0
+
+    def on_sample(node_id, message, sample):
+        future = confirmations.get(node_id)
+        if (
+            message == "heartbeat"
+            and future is not None
+            and not future.done()
+            and sample[0] > stop_time
+            and sample[2] == cansimple.AXIS_STATE_IDLE
+            and sample[1] & required_error == required_error
+        ):
+            confirmed_at[node_id] = perf_counter()
+            future.set_result(sample)
+
+    telemetry.add_listener(on_sample)
+    try:
+        send_now(frames)
+        burst_done = perf_counter()
+        wait(list(confirmations.values()), timeout)
+    finally:
+        telemetry.remove_listener(on_sample)
+
+    confirmed = {
+        node_id: (confirmed_at[node_id] - started) * 1e3
+        for node_id in node_ids
+        if node_id in confirmed_at
+    }
+    report = {
+        "mode": mode,
+        "sent_ms": (burst_done - started) * 1e3,
+        "confirmed": confirmed,
+        "unconfirmed": [node_id for node_id in node_ids if node_id not in confirmed],
+        "total_ms": max(confirmed.values()) if confirmed else None,
+    }
+
+    print(
+        f"Emergency stop ({mode}) sent to {len(node_ids)} nodes in {report['sent_ms']:.2f} ms, "
+        f"{len(confirmed)} confirmed"
+        + (f" within {report['total_ms']:.1f} ms" if confirmed else "")
+    )
+    if report["unconfirmed"]:
+        print(f"Emergency stop not confirmed by nodes {report['unconfirmed']}")
+    return report
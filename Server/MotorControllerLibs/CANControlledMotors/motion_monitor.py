@@ -0,0 +1,178 @@
+from concurrent.futures import Future
+from threading import Lock, Thread
+from time import monotonic, sleep
+
+from Server.MotorControllerLibs.CANControlledMotors.bus_manager import (
+    PRIORITY_TELEMETRY,
+)
+from Server.MotorControllerLibs.CANControlledMotors.can_functions import (
+    prepare_endpoint,
+)
+from Server.MotorControllerLibs.CANControlledMotors.telemetry import telemetry
+from Server.MotorControllerLibs.CANControlledMotors import cansimple
+
+pos_estimate = prepare_endpoint("axis0.pos_estimate")
+
+
+class Move:
+    __slots__ = (
+        "node_id",
+        "target",
+        "tolerance",
+        "future",
+        "started",
+        "seen_busy",
+        "trajectory_done",
+        "pending_read",
+        "read_sent",
+    )
+
+    def __init__(self, node_id, target, tolerance):
+        self.node_id = node_id
+        self.target = target
+        self.tolerance = tolerance
+        self.future = Future()
+        self.started = monotonic()
+        # the heartbeat's trajectory done flag only counts once it has been seen cleared for this move,
+        # or once the axis is within tolerance of the target
+        self.seen_busy = False
+        # the flag of the latest heartbeat since the move started
+        self.trajectory_done = False
+        self.pending_read = None
+        self.read_sent = 0.0
+
+
+class MotionMonitor:
+    def __init__(self, telemetry, tolerance=0.1, poll_interval=0.1, read_timeout=0.5):
+        """
+        Tracks the in-flight move of every node and completes its future when the axis has settled at the
+        target: within tolerance of it with the heartbeat reporting the trajectory done, driven by the telemetry
+        the receiver thread already decodes. One background thread only covers nodes whose encoder messages
+        have gone quiet, with a non-blocking SDO read every poll_interval; without telemetry there is no
+        trajectory flag either, so those moves complete as soon as the read position is within tolerance.
+        :param telemetry: Telemetry the nodes report through
+        :param tolerance: default distance from the target, in revolutions, that counts as arrived
+        :param poll_interval: seconds between fallback reads for nodes without fresh telemetry
+        :param read_timeout: seconds a fallback read may go unanswered before it is sent again
+        """
+        self.telemetry = telemetry
+        self.tolerance = tolerance
+        self.poll_interval = poll_interval
+        self.read_timeout = read_timeout
+
+        self._moves = {}
+        self._lock = Lock()
+        self._thread = None
+
+        telemetry.add_listener(self._on_sample)
+
+    def track(self, node_id, target, tolerance=None):
+        """
+        Start tracking a move, call it right before sending the position command.
+        A move still in flight on the same node is superseded and its future cancelled.
+        :param node_id: Node id of the ODrive controller
+        :param target: target position in revolutions
+        :param tolerance: distance from the target that counts as arrived, defaults to the monitor's
+        :return: Future resolving to the position the axis settled at, see MotionMonitor
+        """
+        move = Move(node_id, target, self.tolerance if tolerance is None else tolerance)
+        with self._lock:
+            previous = self._moves.get(node_id)
+            self._moves[node_id] = move
+            if self._thread is None:
+                self._thread = Thread(target=self._fallback_loop, daemon=True)
+                self._thread.start()
+        if previous is not None:
+            previous.future.cancel()
+        return move.future
+
+    def cancel(self, node_id):
+        """
+        Stop tracking a node's move and cancel its future, e.g. after an e-stop
+        :param node_id: Node id of the ODrive controller
+        :return:
+        """
+        with self._lock:
+            move = self._moves.pop(node_id, None)
+        if move is not None:
+            move.future.cancel()
+
+    def in_flight(self):
+        """
+        :return: dict of node id -> target of every move not yet complete
+        """
+        with self._lock:
+            return {node_id: move.target for node_id, move in self._moves.items()}
+
+    def _complete(self, move, position):
+        with self._lock:
+            if self._moves.get(move.node_id) is not move:
+                return
+            del self._moves[move.node_id]
+        if move.future.set_running_or_notify_cancel():
+            move.future.set_result(position)
+
+    def _check_position(self, move, position):
+        if abs(move.target - position) <= move.tolerance:
+            self._complete(move, position)
+
+    def _on_sample(self, node_id, message, sample):
+        move = self._moves.get(node_id)
+        if move is None:
+            return
+        if message == "encoder":
+            # passing through the tolerance band on the way in doesn't count until the trajectory is done
+            if move.trajectory_done:
+                self._check_position(move, sample[1])
+        elif message == "heartbeat" and sample[0] > move.started:
+            axis_state, trajectory_done = sample[2], sample[4]
+            move.trajectory_done = bool(trajectory_done)
+            if not trajectory_done:
+                move.seen_busy = True
+                return
+            encoder = self.telemetry.latest(node_id, "encoder")
+            if (
+                move.seen_busy
+                and axis_state != cansimple.AXIS_STATE_CLOSED_LOOP_CONTROL
+            ):
+                # stopped (e-stop, error) rather than arrived
+                self.cancel(node_id)
+            elif move.seen_busy:
+                self._complete(move, move.target if encoder is None else encoder[1])
+            elif encoder is not None:
+                # a move short enough to finish between two heartbeats
+                self._check_position(move, encoder[1])
+
+    def _fallback_loop(self):
+        while True:
+            sleep(self.poll_interval)
+            with self._lock:
+                moves = list(self._moves.values())
+            for move in moves:
+                fresh = self.telemetry.latest(
+                    move.node_id, "encoder", max_age=2 * self.poll_interval
+                )
+                if fresh is not None:
+                    continue
+                pending = move.pending_read
+                if pending is not None and not pending.done():
+                    if monotonic() - move.read_sent < self.read_timeout:
+                        continue
+                    # reply lost, ask again (the bus manager drops the old reply if it still turns up)
+                    pending.cancel()
+                # a poll that can't go out before the next one is due isn't worth sending
+                move.read_sent = monotonic()
+                move.pending_read = pos_estimate.request_read(
+                    move.node_id, PRIORITY_TELEMETRY, self.poll_interval
+                )
+                move.pending_read.add_done_callback(self._make_read_callback(move))
+
+    def _make_read_callback(self, move):
+        def on_read(future):
+            if not future.cancelled() and future.exception() is None:
+                self._check_position(move, future.result())
+
+        return on_read
+
+
+motion_monitor = MotionMonitor(telemetry)
@@ -0,0 +1,173 @@
+from concurrent.futures import Future
+from math import sqrt
+from threading import Lock
+
+from Server.MotorControllerLibs.CANControlledMotors.bus_manager import (
+    PRIORITY_MOTION,
+    arbitration_id,
+)
+from Server.MotorControllerLibs.CANControlledMotors.can_functions import send_burst
+from Server.MotorControllerLibs.CANControlledMotors import cansimple
+from Server.MotorControllerLibs.CANControlledMotors.shadow_registers import (
+    TRAJ_ACCEL_LIMIT,
+    TRAJ_DECEL_LIMIT,
+    TRAJ_VEL_LIMIT,
+    shadow_registers,
+)
+
+
+def trapezoid_duration(distance, vel, accel, decel):
+    """
+    Get how long the ODrive's trap_traj planner takes to cover a distance starting and ending at rest
+    :param distance: revolutions, the sign is ignored
+    :param vel: velocity limit in rev/s
+    :param accel: acceleration limit in rev/s^2
+    :param decel: deceleration limit in rev/s^2
+    :return: duration in seconds
+    """
+    distance = abs(distance)
+    if distance == 0:
+        return 0.0
+    ramps = vel * vel / 2 * (1 / accel + 1 / decel)
+    if distance >= ramps:
+        return vel / accel + vel / decel + (distance - ramps) / vel
+    # never reaches the velocity limit, triangular profile
+    peak = sqrt(2 * distance * accel * decel / (accel + decel))
+    return peak / accel + peak / decel
+
+
+class MultiAxisMove:
+    def __init__(self, targets, speed_offset=1):
+        """
+        A move of several joints that start and finish together. Every joint's trap_traj limits are scaled
+        down so its profile stretches to the duration of the slowest joint, then the limits and position
+        commands for every node go out in one burst.
+        :param targets: dict of OdriveController -> angle in degrees
+        :param speed_offset: offset for the speed/accel of every joint, applied before synchronising
+        """
+        self.targets = dict(targets)
+        self.speed_offset = speed_offset
+
+        self.duration = 0.0
+        # node_id -> (target revolutions, vel limit, accel limit, decel limit)
+        self.plan = {}
+        self.frames_sent = 0
+        self.future = None
+
+    def _plan(self):
+        offset = self.speed_offset
+        joints = []
+        for controller, angle in self.targets.items():
+            target = controller.angle_to_rotation(angle)
+            distance = target - controller.start_position()
+            vel = controller.max_speed * offset
+            accel = controller.max_accel * offset
+            decel = controller.max_decel * offset
+            duration = trapezoid_duration(distance, vel, accel, decel)
+            joints.append((controller, target, vel, accel, decel, duration))
+
+        self.duration = max((joint[5] for joint in joints), default=0.0)
+        self.plan = {}
+        for controller, target, vel, accel, decel, duration in joints:
+            if duration > 0:
+                # stretching a trapezoid in time by s divides its velocity by s and its accelerations by s^2
+                stretch = self.duration / duration
+                vel /= stretch
+                accel /= stretch * stretch
+                decel /= stretch * stretch
+            self.plan[controller.node_id] = (target, vel, accel, decel)
+        return joints
+
+    def build(self):
+        """
+        Plan the move and build its burst, without sending anything
+        :return: (list of (controller, target revolutions), list of (arbitration_id, data))
+        """
+        joints = self._plan()
+
+        limit_frames = []
+        position_frames = []
+        for controller, target, _, _, _, duration in joints:
+            _, vel, accel, decel = self.plan[controller.node_id]
+            node_id = controller.node_id
+            # a joint that isn't going anywhere keeps its limits, the others only rewrite what changed
+            if duration > 0:
+                limit_frames += shadow_registers.frames(
+                    node_id,
+                    {
+                        TRAJ_VEL_LIMIT: vel,
+                        TRAJ_ACCEL_LIMIT: accel,
+                        TRAJ_DECEL_LIMIT: decel,
+                    },
+                )
+            position_frames.append(
+                (
+                    arbitration_id(node_id, cansimple.CMD_SET_INPUT_POS),
+                    cansimple.input_pos_data(target),
+                )
+            )
+
+        # limits first so no node starts its trajectory with the previous move's limits
+        return [joint[:2] for joint in joints], limit_frames + position_frames
+
+    def start(self):
+        """
+        Plan and send the move
+        :return: Future resolving to a dict of node id -> settled position once every joint has arrived
+        """
+        joints, frames = self.build()
+        futures = {
+            controller.node_id: controller.begin_move(target)
+            for controller, target in joints
+        }
+        self.future = self._gather(futures)
+
+        send_burst(frames, PRIORITY_MOTION)
+        self.frames_sent = len(frames)
+
+        print(
+            f"Moving {len(joints)} joints together in {self.duration:.2f} s "
+            f"({self.frames_sent} frames)"
+        )
+        return self.future
+
+    def wait(self, timeout=None):
+        """
+        Block until every joint has arrived
+        :param timeout: seconds to wait, None waits forever
+        :return: dict of node id -> settled position
+        """
+        return self.future.result(timeout)
+
+    @staticmethod
+    def _gather(futures):
+        combined = Future()
+        results = {}
+        lock = Lock()
+
+        if not futures:
+            combined.set_result(results)
+            return combined
+
+        def make_callback(node_id):
+            def on_done(future):
+                with lock:
+                    if combined.done():
+                        return
+                    if future.cancelled():
+                        # superseded by another move on the same joint
+                        combined.cancel()
+                    elif future.exception() is not None:
+                        combined.set_running_or_notify_cancel()
+                        combined.set_exception(future.exception())
+                    else:
+                        results[node_id] = future.result()
+                        if len(results) == len(futures):
+                            combined.set_running_or_notify_cancel()
+                            combined.set_result(results)
+
+            return on_done
+
+        for node_id, future in futures.items():
+            future.add_done_callback(make_callback(node_id))
+        return combined
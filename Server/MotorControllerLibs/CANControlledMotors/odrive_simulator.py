@@ -0,0 +1,513 @@
+"""
+Simulated ODrives on a python-can bus (normally the in-process "virtual" interface), so the CAN layer and
+OdriveController can be exercised and benchmarked without hardware:
+    simulator = OdriveSimulator([0, 1, 2], channel="sim", reply_latency=0.0005)
+    simulator.start()
+    can_functions.connect("sim", interface="virtual")
+"""
+
+import heapq
+import struct
+from itertools import count
+from math import copysign, sqrt
+from threading import Condition, Thread
+from time import monotonic, sleep
+
+from Server.MotorControllerLibs.CANControlledMotors.bus_manager import (
+    CMD_RX_SDO,
+    CMD_TX_SDO,
+    OPCODE_READ,
+    OPCODE_WRITE,
+    sdo_header,
+)
+from Server.MotorControllerLibs.CANControlledMotors.can_functions import (
+    format_lookup,
+    get_endpoint_data,
+)
+from Server.MotorControllerLibs.CANControlledMotors import cansimple
+
+CMD_GET_VERSION = 0x00
+CMD_HEARTBEAT = 0x01
+CMD_GET_ENCODER_ESTIMATES = 0x09
+CMD_GET_IQ = 0x14
+CMD_GET_BUS_VOLTAGE_CURRENT = 0x17
+
+AXIS_STATE_IDLE = 1
+AXIS_STATE_CLOSED_LOOP_CONTROL = 8
+
+INPUT_MODE_PASSTHROUGH = 1
+INPUT_MODE_TRAP_TRAJ = 5
+
+AXIS_ERROR_ESTOP_REQUESTED = 0x4000
+
+heartbeat_layout = struct.Struct("<IBBBx")
+two_floats = struct.Struct("<ff")
+version_layout = struct.Struct("<BBBBBBBB")
+
+# values an ODrive reports before anything is configured
+DEFAULT_VALUES = {
+    "vbus_voltage": 48.0,
+    "axis0.controller.config.input_mode": INPUT_MODE_PASSTHROUGH,
+    "axis0.trap_traj.config.vel_limit": 2.0,
+    "axis0.trap_traj.config.accel_limit": 0.5,
+    "axis0.trap_traj.config.decel_limit": 0.5,
+    "axis0.config.can.heartbeat_msg_rate_ms": 100,
+    "axis0.config.can.encoder_msg_rate_ms": 10,
+}
+
+
+class TrapezoidalTrajectory:
+    def __init__(
+        self, start_pos, start_vel, end_pos, vel_limit, accel_limit, decel_limit
+    ):
+        """
+        Trapezoidal (or triangular, for short moves) position profile, planned the same way the ODrive
+        firmware's trap_traj does, including a non-zero starting velocity
+        :param start_pos: position at t=0 in revolutions
+        :param start_vel: velocity at t=0 in rev/s
+        :param end_pos: target position in revolutions
+        :param vel_limit: rev/s
+        :param accel_limit: rev/s^2
+        :param decel_limit: rev/s^2
+        """
+        self.start_pos = start_pos
+        self.start_vel = start_vel
+        self.end_pos = end_pos
+
+        distance = end_pos - start_pos
+        stop_distance = copysign(start_vel * start_vel / (2 * decel_limit), start_vel)
+        direction = 1.0 if distance - stop_distance >= 0 else -1.0
+
+        self.accel = direction * accel_limit
+        self.decel = -direction * decel_limit
+        self.cruise_vel = direction * vel_limit
+        if direction * start_vel > direction * self.cruise_vel:
+            # already faster than allowed, slow down to the cruise speed first
+            self.accel = -self.accel
+
+        self.accel_time = (self.cruise_vel - start_vel) / self.accel
+        self.decel_time = -self.cruise_vel / self.decel
+        min_distance = 0.5 * self.accel_time * (
+            self.cruise_vel + start_vel
+        ) + 0.5 * self.decel_time * (self.cruise_vel)
+
+        if direction * distance < direction * min_distance:
+            # never reaches the cruise speed
+            self.cruise_vel = direction * sqrt(
+                max(
+                    (
+                        self.decel * start_vel * start_vel
+                        + 2 * self.accel * self.decel * distance
+                    )
+                    / (self.decel - self.accel),
+                    0.0,
+                )
+            )
+            self.accel_time = max(0.0, (self.cruise_vel - start_vel) / self.accel)
+            self.decel_time = max(0.0, -self.cruise_vel / self.decel)
+            self.cruise_time = 0.0
+        else:
+            self.cruise_time = (distance - min_distance) / self.cruise_vel
+
+        self.duration = self.accel_time + self.cruise_time + self.decel_time
+        self.accel_end_pos = (
+            start_pos
+            + start_vel * self.accel_time
+            + 0.5 * self.accel * self.accel_time**2
+        )
+
+    def evaluate(self, t):
+        """
+        :param t: seconds since the start of the move
+        :return: (position, velocity)
+        """
+        if t <= 0:
+            return self.start_pos, self.start_vel
+        if t < self.accel_time:
+            return (
+                self.start_pos + self.start_vel * t + 0.5 * self.accel * t * t,
+                self.start_vel + self.accel * t,
+            )
+        if t < self.accel_time + self.cruise_time:
+            return (
+                self.accel_end_pos + self.cruise_vel * (t - self.accel_time),
+                self.cruise_vel,
+            )
+        if t < self.duration:
+            remaining = t - self.duration
+            return (
+                self.end_pos + 0.5 * self.decel * remaining * remaining,
+                self.decel * remaining,
+            )
+        return self.end_pos, 0.0
+
+
+class SimulatedOdrive:
+    def __init__(self, node_id, endpoint_data):
+        """
+        State of one simulated ODrive: every endpoint value plus the axis motion
+        :param node_id: CAN node id
+        :param endpoint_data: endpoint table the simulated firmware implements
+        """
+        self.node_id = node_id
+        self.endpoints = endpoint_data["endpoints"]
+        self.by_id = {endpoint["id"]: path for path, endpoint in self.endpoints.items()}
+        self.values = {}
+        for path, value in DEFAULT_VALUES.items():
+            self.values[self.endpoints[path]["id"]] = value
+
+        self.axis_state = AXIS_STATE_IDLE
+        self.axis_error = 0
+        self.pos = 0.0
+        self.vel = 0.0
+        self.input_pos = 0.0
+        self.torque = 0.0
+        self.trajectory = None
+        self.trajectory_start = 0.0
+        self.trajectory_done = True
+        self.save_count = 0
+
+        # message period setting -> time it is next due
+        self.next_due = {}
+
+    def value(self, path):
+        """
+        Current value of a property endpoint
+        :param path: endpoint path
+        :return:
+        """
+        if path in ("axis0.pos_estimate", "encoder_estimator0.pos_estimate"):
+            return self.pos
+        if path in ("axis0.vel_estimate", "encoder_estimator0.vel_estimate"):
+            return self.vel
+        if path == "axis0.controller.pos_setpoint":
+            return self.pos
+        if path == "axis0.controller.input_pos":
+            return self.input_pos
+        if path in ("axis0.current_state", "axis0.requested_state"):
+            return self.axis_state
+        if path == "axis0.active_errors":
+            return self.axis_error
+        endpoint = self.endpoints[path]
+        return self.values.get(
+            endpoint["id"], 0.0 if endpoint["type"] == "float" else 0
+        )
+
+    def write(self, path, value, now):
+        """
+        Apply a property write, with the side effects the firmware would have
+        :param path: endpoint path
+        :param value: decoded value
+        :param now: monotonic time of the write
+        :return:
+        """
+        self.values[self.endpoints[path]["id"]] = value
+        if path == "axis0.requested_state":
+            self.set_axis_state(value)
+        elif path == "axis0.controller.input_pos":
+            self.set_input_pos(value, now)
+        elif path == "axis0.controller.input_torque":
+            self.torque = value
+
+    def call(self, path, value):
+        """
+        Run a function endpoint
+        :param path: endpoint path
+        :param value: first input, None if it has none
+        :return: first output, None if it has none
+        """
+        if path == "save_configuration":
+            self.save_count += 1
+            return True
+        if path == "clear_errors":
+            self.axis_error = 0
+        elif path in ("axis0.set_abs_pos", "axis0.pos_vel_mapper.set_abs_pos"):
+            self.set_absolute_position(value or 0.0)
+            return 0.0
+        outputs = self.endpoints[path]["outputs"]
+        if outputs:
+            return 0.0 if outputs[0]["type"] == "float" else 0
+        return None
+
+    def set_axis_state(self, state):
+        if state == AXIS_STATE_CLOSED_LOOP_CONTROL and self.axis_error:
+            return
+        self.axis_state = state
+        if state != AXIS_STATE_CLOSED_LOOP_CONTROL:
+            self.trajectory = None
+            self.trajectory_done = True
+            self.vel = 0.0
+        else:
+            self.input_pos = self.pos
+
+    def set_input_pos(self, pos, now, vel_ff=0.0):
+        self.input_pos = pos
+        if self.axis_state != AXIS_STATE_CLOSED_LOOP_CONTROL:
+            return
+        if self.value("axis0.controller.config.input_mode") == INPUT_MODE_TRAP_TRAJ:
+            self.trajectory = TrapezoidalTrajectory(
+                self.pos,
+                self.vel,
+                pos,
+                self.value("axis0.trap_traj.config.vel_limit"),
+                self.value("axis0.trap_traj.config.accel_limit"),
+                self.value("axis0.trap_traj.config.decel_limit"),
+            )
+            self.trajectory_start = now
+            self.trajectory_done = False
+        else:
+            # other input modes track the input directly
+            self.trajectory = None
+            self.pos = pos
+            self.vel = vel_ff
+
+    def set_absolute_position(self, pos):
+        self.pos = pos
+        self.input_pos = pos
+        self.trajectory = None
+        self.trajectory_done = True
+
+    def estop(self):
+        self.axis_error |= AXIS_ERROR_ESTOP_REQUESTED
+        self.set_axis_state(AXIS_STATE_IDLE)
+
+    def step(self, now):
+        """
+        Advance the motion to now
+        :param now: monotonic time
+        :return:
+        """
+        if self.trajectory is None:
+            return
+        self.pos, self.vel = self.trajectory.evaluate(now - self.trajectory_start)
+        if now - self.trajectory_start >= self.trajectory.duration:
+            self.trajectory = None
+            self.trajectory_done = True
+
+
+class OdriveSimulator:
+    def __init__(
+        self,
+        node_ids,
+        channel="odrive-sim",
+        interface="virtual",
+        reply_latency=0.0,
+        tick=0.001,
+        endpoint_data=None,
+    ):
+        """
+        Answers SDO requests, Get_Version and CANSimple commands for a set of simulated ODrives,
+        and sends their heartbeats and cyclic messages at the configured rates
+        :param node_ids: node ids to simulate
+        :param channel: bus channel, connect the code under test to the same one
+        :param interface: python-can interface, virtual unless you have a spare vcan/can pair
+        :param reply_latency: seconds between a request arriving and its reply being sent
+        :param tick: seconds between motion updates and cyclic message checks
+        :param endpoint_data: endpoint table to implement, defaults to flat_endpoints.json
+        """
+        self.channel = channel
+        self.interface = interface
+        self.reply_latency = reply_latency
+        self.tick = tick
+        endpoint_data = endpoint_data or get_endpoint_data()
+        self.endpoint_data = endpoint_data
+        self.nodes = {
+            node_id: SimulatedOdrive(node_id, endpoint_data) for node_id in node_ids
+        }
+
+        self.frames_received = 0
+        self.frames_sent = 0
+
+        self.bus = None
+        self.running = False
+        self._threads = []
+        # (due time, sequence, arbitration id, data) waiting to be sent
+        self._outbox = []
+        self._outbox_condition = Condition()
+        self._sequence = count()
+
+    def start(self):
+        """
+        Open the bus and start answering
+        :return:
+        """
+        import can
+
+        self._message = can.Message
+        self.bus = can.interface.Bus(self.channel, interface=self.interface)
+        self.running = True
+        self._threads = [
+            Thread(target=self._receive_loop, daemon=True),
+            Thread(target=self._send_loop, daemon=True),
+            Thread(target=self._tick_loop, daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        """
+        Stop the simulation and close the bus
+        :return:
+        """
+        self.running = False
+        with self._outbox_condition:
+            self._outbox_condition.notify()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self.bus.shutdown()
+
+    def _queue(self, arbitration_id, data, delay=0.0):
+        with self._outbox_condition:
+            heapq.heappush(
+                self._outbox,
+                (monotonic() + delay, next(self._sequence), arbitration_id, data),
+            )
+            self._outbox_condition.notify()
+
+    def _send_loop(self):
+        while self.running:
+            with self._outbox_condition:
+                while self.running and (
+                    not self._outbox or self._outbox[0][0] > monotonic()
+                ):
+                    timeout = self._outbox[0][0] - monotonic() if self._outbox else None
+                    self._outbox_condition.wait(timeout)
+                if not self.running:
+                    return
+                _, _, arbitration_id, data = heapq.heappop(self._outbox)
+            self.bus.send(
+                self._message(
+                    arbitration_id=arbitration_id, data=data, is_extended_id=False
+                )
+            )
+            self.frames_sent += 1
+
+    def _receive_loop(self):
+        while self.running:
+            msg = self.bus.recv(timeout=0.1)
+            if msg is None:
+                continue
+            self.frames_received += 1
+            node = self.nodes.get(msg.arbitration_id >> 5)
+            if node is not None:
+                self._handle(node, msg.arbitration_id & 0x1F, bytes(msg.data))
+
+    def _tick_loop(self):
+        while self.running:
+            now = monotonic()
+            for node in self.nodes.values():
+                node.step(now)
+                self._send_cyclic(node, now)
+            sleep(max(0.0, now + self.tick - monotonic()))
+
+    def _send_cyclic(self, node, now):
+        for setting, cmd_id, encode in (
+            ("axis0.config.can.heartbeat_msg_rate_ms", CMD_HEARTBEAT, self._heartbeat),
+            (
+                "axis0.config.can.encoder_msg_rate_ms",
+                CMD_GET_ENCODER_ESTIMATES,
+                lambda n: two_floats.pack(n.pos, n.vel),
+            ),
+            (
+                "axis0.config.can.iq_msg_rate_ms",
+                CMD_GET_IQ,
+                lambda n: two_floats.pack(n.torque, n.torque),
+            ),
+            (
+                "axis0.config.can.bus_voltage_msg_rate_ms",
+                CMD_GET_BUS_VOLTAGE_CURRENT,
+                lambda n: two_floats.pack(n.value("vbus_voltage"), 0.0),
+            ),
+        ):
+            period_ms = node.value(setting)
+            if not period_ms:
+                continue
+            due = node.next_due.get(cmd_id, now)
+            if now >= due:
+                node.next_due[cmd_id] = max(due + period_ms / 1000, now)
+                self._queue(node.node_id << 5 | cmd_id, encode(node))
+
+    @staticmethod
+    def _heartbeat(node):
+        return heartbeat_layout.pack(
+            node.axis_error, node.axis_state, 0, 1 if node.trajectory_done else 0
+        )
+
+    def _handle(self, node, cmd_id, data):
+        now = monotonic()
+        if cmd_id == CMD_RX_SDO:
+            self._handle_sdo(node, data, now)
+        elif cmd_id == CMD_GET_VERSION:
+            hw = [int(part) for part in self.endpoint_data["hw_version"].split(".")]
+            fw = [int(part) for part in self.endpoint_data["fw_version"].split(".")]
+            self._queue(
+                node.node_id << 5 | CMD_GET_VERSION,
+                version_layout.pack(2, *hw, *fw, 0),
+                self.reply_latency,
+            )
+        elif cmd_id == cansimple.CMD_ESTOP:
+            node.estop()
+        elif cmd_id == cansimple.CMD_SET_AXIS_STATE:
+            node.set_axis_state(cansimple.u32.unpack_from(data)[0])
+        elif cmd_id == cansimple.CMD_SET_CONTROLLER_MODE:
+            _, input_mode = cansimple.two_u32.unpack_from(data)
+            node.write("axis0.controller.config.input_mode", input_mode, now)
+        elif cmd_id == cansimple.CMD_SET_INPUT_POS:
+            pos, vel_ff, _ = cansimple.input_pos.unpack_from(data)
+            node.set_input_pos(pos, now, vel_ff / 1000)
+        elif cmd_id == cansimple.CMD_SET_INPUT_TORQUE:
+            node.torque = cansimple.f32.unpack_from(data)[0]
+        elif cmd_id == cansimple.CMD_SET_TRAJ_VEL_LIMIT:
+            node.write(
+                "axis0.trap_traj.config.vel_limit",
+                cansimple.f32.unpack_from(data)[0],
+                now,
+            )
+        elif cmd_id == cansimple.CMD_SET_TRAJ_ACCEL_LIMITS:
+            accel, decel = cansimple.two_f32.unpack_from(data)
+            node.write("axis0.trap_traj.config.accel_limit", accel, now)
+            node.write("axis0.trap_traj.config.decel_limit", decel, now)
+        elif cmd_id == cansimple.CMD_CLEAR_ERRORS:
+            node.axis_error = 0
+        elif cmd_id == cansimple.CMD_SET_ABSOLUTE_POSITION:
+            node.set_absolute_position(cansimple.f32.unpack_from(data)[0])
+
+    def _handle_sdo(self, node, data, now):
+        opcode, endpoint_id, _ = sdo_header.unpack_from(data)
+        path = node.by_id.get(endpoint_id)
+        if path is None:
+            return
+        endpoint = node.endpoints[path]
+
+        if endpoint["type"] == "function":
+            inputs, outputs = endpoint["inputs"], endpoint["outputs"]
+            value = None
+            if inputs and len(data) > sdo_header.size:
+                value = struct.unpack_from(
+                    "<" + format_lookup[inputs[0]["type"]], data, sdo_header.size
+                )[0]
+            result = node.call(path, value)
+            if outputs:
+                self._reply(
+                    node, endpoint_id, format_lookup[outputs[0]["type"]], result
+                )
+            return
+
+        value_format = format_lookup[endpoint["type"]]
+        if opcode == OPCODE_READ:
+            self._reply(node, endpoint_id, value_format, node.value(path))
+        elif opcode == OPCODE_WRITE:
+            node.write(
+                path,
+                struct.unpack_from("<" + value_format, data, sdo_header.size)[0],
+                now,
+            )
+
+    def _reply(self, node, endpoint_id, value_format, value):
+        data = struct.pack("<BHB" + value_format, 0, endpoint_id, 0, value)
+        self._queue(
+            node.node_id << 5 | CMD_TX_SDO,
+            data.ljust(8, b"\x00"),
+            self.reply_latency,
+        )
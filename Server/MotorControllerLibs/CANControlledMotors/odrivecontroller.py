@@ -1,50 +1,74 @@
 from Server.MotorControllerLibs.CANControlledMotors.can_functions import (
-    bus,
-    send_bus_message,
-    get_property_value,
-    endpoint_data,
+    get_bus_manager,
+    get_endpoint_data,
+    prepare_endpoint,
+    read_many,
+    set_node_channel,
+    write_many,
+)
+from Server.MotorControllerLibs.CANControlledMotors.bus_manager import arbitration_id
+from Server.MotorControllerLibs.CANControlledMotors.telemetry import telemetry
+from Server.MotorControllerLibs.CANControlledMotors import cansimple, estop
+from Server.MotorControllerLibs.CANControlledMotors.axis_health import axis_health
+from Server.MotorControllerLibs.CANControlledMotors.motion_monitor import (
+    motion_monitor,
+)
+from Server.MotorControllerLibs.CANControlledMotors.shadow_registers import (
+    TRAJ_ACCEL_LIMIT,
+    TRAJ_DECEL_LIMIT,
+    TRAJ_VEL_LIMIT,
+    shadow_registers,
 )
-import can
 import struct
-from time import sleep
+from math import isclose
+from time import perf_counter, sleep
 from constants import OdriveSpeeds
-import threading
+
+# seconds before a cached encoder sample is considered stale and the position is read over SDO instead
+TELEMETRY_MAX_AGE = 0.1
+
+# every SDO endpoint used below, resolved on first use
+vbus_voltage = prepare_endpoint("vbus_voltage")
+clear_errors = prepare_endpoint("clear_errors")
+save_configuration = prepare_endpoint("save_configuration")
+input_mode = prepare_endpoint("axis0.controller.config.input_mode")
+vel_limit = prepare_endpoint("axis0.trap_traj.config.vel_limit")
+accel_limit = prepare_endpoint("axis0.trap_traj.config.accel_limit")
+decel_limit = prepare_endpoint("axis0.trap_traj.config.decel_limit")
+pos_estimate = prepare_endpoint("axis0.pos_estimate")
+vel_estimate = prepare_endpoint("encoder_estimator0.vel_estimate")
 
 
 def setup(node_id, gear_ratio):
+    """
+    Bring up one ODrive: wait for power and presence, check its firmware against the endpoint table,
+    write the configuration and save it if anything differs from what the device has stored
+    :param node_id: Node id of the ODrive controller
+    :param gear_ratio: gear ratio the trap_traj limits are scaled by
+    :return: seconds the setup took, RuntimeError if the endpoint table doesn't match its firmware or hardware
+    """
+    start = perf_counter()
     print(f"Setting up CAN for ODrive with id: {node_id}")
 
     print("Waiting for main power...")
-    while get_property_value("vbus_voltage", node_id) < 40:
-        print(get_property_value("vbus_voltage", node_id))
+    while vbus_voltage.get(node_id) < 40:
+        print(vbus_voltage.get(node_id))
     print("Main power detected")
 
-    cmd_id = 0x01  # heartbeat command ID
-    message_id = node_id << 5 | cmd_id
+    bus_manager = get_bus_manager(node_id)
+    endpoint_data = get_endpoint_data()
 
-    for msg in bus:
-        if msg.arbitration_id == message_id:
-            print(f"ODrive with id {node_id}: step 1 complete")
-            break
+    message_id = arbitration_id(node_id, 0x01)  # 0x01: Heartbeat
+    version_id = arbitration_id(node_id, 0x00)  # 0x00: Get_Version
 
-    # Flush CAN RX buffer so there are no more old pending messages
-    while bus.recv(timeout=0) is not None:
-        sleep(0.001)
+    bus_manager.next_message(message_id).result()
+    print(f"ODrive with id {node_id}: step 1 complete")
 
-    # Send read command
-    bus.send(
-        can.Message(
-            arbitration_id=(node_id << 5 | 0x00),  # 0x00: Get_Version
-            data=b"",
-            is_extended_id=False,
-        )
-    )
-
-    # Await reply
-    for msg in bus:
-        if msg.arbitration_id == (node_id << 5 | 0x00):  # 0x00: Get_Version
-            print(f"ODrive with id {node_id}: step 2 complete")
-            break
+    # Register for the reply before sending the request so it can't be missed
+    reply = bus_manager.next_message(version_id)
+    bus_manager.send(version_id, b"")
+    msg = reply.result()
+    print(f"ODrive with id {node_id}: step 2 complete")
 
     (
         _,
@@ -57,69 +81,62 @@ def setup(node_id, gear_ratio):
         fw_unreleased,
     ) = struct.unpack("<BBBBBBBB", msg.data)
 
-    try:
-        # If one of these asserts fail, you're probably not using the right flat_endpoints.json file
-        assert endpoint_data["fw_version"] == f"{fw_major}.{fw_minor}.{fw_revision}"
-        assert (
-            endpoint_data["hw_version"]
-            == f"{hw_product_line}.{hw_version}.{hw_variant}"
-        )
-    except AssertionError:
-        print(
-            f"Error: Endpoint JSON file is for hardware version {endpoint_data['hw_version']} and firmware version {endpoint_data['fw_version']}, but the connected hardware is version {hw_product_line}.{hw_version}.{hw_variant} and firmware version {fw_major}.{fw_minor}.{fw_revision}"
+    # if this fails, you're probably not using the right flat_endpoints.json file.
+    # Raised rather than exiting, setup runs on a worker thread next to the other joints' (see ArmBus.setup_all)
+    if endpoint_data["fw_version"] != f"{fw_major}.{fw_minor}.{fw_revision}" or (
+        endpoint_data["hw_version"] != f"{hw_product_line}.{hw_version}.{hw_variant}"
+    ):
+        raise RuntimeError(
+            f"Endpoint JSON file is for hardware version {endpoint_data['hw_version']} and firmware version "
+            f"{endpoint_data['fw_version']}, but ODrive with id {node_id} is hardware version "
+            f"{hw_product_line}.{hw_version}.{hw_variant} and firmware version {fw_major}.{fw_minor}.{fw_revision}"
         )
-        exit(1)
 
     # clear errors
     print("Clearing errors...")
-    send_bus_message(None, "clear_errors", node_id)
+    clear_errors.set(None, node_id)
     print("ODrive errors cleared")
 
-    send_bus_message(5, "axis0.controller.config.input_mode", node_id)
+    # position/velocity reads come from the cyclic encoder messages from here on
+    telemetry.add_node(node_id)
+
+    settings = [
+        (5, input_mode),
+        (OdriveSpeeds.max_speed * (gear_ratio / 25), vel_limit),
+        (OdriveSpeeds.max_accel * (gear_ratio / 25), accel_limit),
+        (OdriveSpeeds.max_decel * (gear_ratio / 25), decel_limit),
+    ] + telemetry.rate_settings()
+    stored = read_many([(handle, node_id) for _, handle in settings])
+    changed = [
+        (value, handle, node_id)
+        for (value, handle), current in zip(settings, stored)
+        # floats come back rounded to single precision
+        if not isclose(value, current, rel_tol=1e-6)
+    ]
+
+    for value, handle in settings:
+        shadow_registers.record(node_id, handle.path, value)
+
+    if not changed:
+        print(f"ODrive with id {node_id}: stored configuration matches, not saving")
+        elapsed = perf_counter() - start
+        print(
+            f"------------------ ODrive with id {node_id} setup complete in {elapsed:.2f} s ------------------"
+        )
+        return elapsed
 
-    send_bus_message(
-        OdriveSpeeds.max_speed * (gear_ratio / 25),
-        "axis0.trap_traj.config.vel_limit",
-        node_id,
-    )
-
-    send_bus_message(
-        OdriveSpeeds.max_accel * (gear_ratio / 25),
-        "axis0.trap_traj.config.accel_limit",
-        node_id,
-    )
-    send_bus_message(
-        OdriveSpeeds.max_decel * (gear_ratio / 25),
-        "axis0.trap_traj.config.decel_limit",
-        node_id,
-    )
+    write_many(changed)
 
     # save configuration
-    send_bus_message(None, "save_configuration", node_id)
-
-    for msg in bus:
-        if msg.arbitration_id == message_id:
-            print(f"ODrive with id {node_id}: step 3 complete")
-            break
-
-    # Flush CAN RX buffer so there are no more old pending messages
-    while bus.recv(timeout=0) is not None:
-        sleep(0.001)
-
-    # Send read command
-    bus.send(
-        can.Message(
-            arbitration_id=(node_id << 5 | 0x00),  # 0x00: Get_Version
-            data=b"",
-            is_extended_id=False,
-        )
-    )
+    save_configuration.set(None, node_id)
+
+    bus_manager.next_message(message_id).result()
+    print(f"ODrive with id {node_id}: step 3 complete")
 
-    # Await reply
-    for msg in bus:
-        if msg.arbitration_id == (node_id << 5 | 0x00):  # 0x00: Get_Version
-            print(f"ODrive with id {node_id}: step 4 complete")
-            break
+    reply = bus_manager.next_message(version_id)
+    bus_manager.send(version_id, b"")
+    msg = reply.result()
+    print(f"ODrive with id {node_id}: step 4 complete")
 
     (
         _,
@@ -132,9 +149,11 @@ def setup(node_id, gear_ratio):
         fw_unreleased,
     ) = struct.unpack("<BBBBBBBB", msg.data)
 
+    elapsed = perf_counter() - start
     print(
-        f"------------------ ODrive with id {node_id} setup complete ------------------"
+        f"------------------ ODrive with id {node_id} setup complete in {elapsed:.2f} s ------------------"
     )
+    return elapsed
 
 
 def warning_message(message):
@@ -150,13 +169,17 @@ def error_message(message):
 
 
 class OdriveController:
-    def __init__(self, id_number, gear_ratio=25, motor_reversed=False):
+    def __init__(self, id_number, gear_ratio=25, motor_reversed=False, channel=None):
         """
         Odive controller class
         :param id_number: the CAN Bus ID of the ODrive
         :param gear_ratio: The gear ratio of the motor, it is in terms of x:1.
         :param motor_reversed: Whether or not the motor is reversed
+        :param channel: CAN channel the ODrive is on, None for its entry in can_functions.NODE_CHANNELS
+        (or the default bus)
         """
+        if channel is not None:
+            set_node_channel(id_number, channel)
         self.node_id = id_number
         self.enabled = False
         self.position = 0
@@ -169,29 +192,43 @@ class OdriveController:
         self.max_accel = OdriveSpeeds.max_accel * (self.gear_ratio / 25)
         self.max_decel = OdriveSpeeds.max_decel * (self.gear_ratio / 25)
 
-        setup(self.node_id, self.gear_ratio)
+        self.setup_time = setup(self.node_id, self.gear_ratio)
         self.zero_motor()
 
         self.moving = False
+        self.move_future = None
 
     def enable_motor(self):
-        send_bus_message(8, "axis0.requested_state", self.node_id)
+        cansimple.set_axis_state(self.node_id, cansimple.AXIS_STATE_CLOSED_LOOP_CONTROL)
         self.enabled = True
 
     def disable_motor(self):
-        send_bus_message(1, "axis0.requested_state", self.node_id)
+        cansimple.set_axis_state(self.node_id, cansimple.AXIS_STATE_IDLE)
         self.enabled = False
 
     def zero_motor(self):
-        send_bus_message(0, "axis0.set_abs_pos", self.node_id)
+        cansimple.set_absolute_position(self.node_id, 0)
         # print(f"Motor position offset by {offset} counts")
         self.position = 0
 
     def get_encoder_pos(self):
-        return get_property_value("axis0.controller.pos_setpoint", self.node_id)
+        sample = telemetry.latest(self.node_id, "encoder", TELEMETRY_MAX_AGE)
+        if sample is not None:
+            return sample[1]
+        return pos_estimate.get(self.node_id)
 
     def get_encoder_vel(self):
-        return get_property_value("encoder_estimator0.vel_estimate", self.node_id)
+        sample = telemetry.latest(self.node_id, "encoder", TELEMETRY_MAX_AGE)
+        if sample is not None:
+            return sample[2]
+        return vel_estimate.get(self.node_id)
+
+    def get_health(self):
+        """
+        Get the axis state and errors from the latest heartbeat, without touching the bus
+        :return: dict of axis_error, axis_state, procedure_result, trajectory_done, stale and age
+        """
+        return axis_health.state(self.node_id)
 
     def get_angle(self):
         pos = self.get_encoder_pos()
@@ -203,7 +240,7 @@ class OdriveController:
         :param speed: speed in rotations per second
         :return:
         """
-        send_bus_message(speed, "axis0.trap_traj.config.vel_limit", self.node_id)
+        shadow_registers.write(self.node_id, {TRAJ_VEL_LIMIT: speed})
 
         self.max_speed = speed
 
@@ -216,8 +253,9 @@ class OdriveController:
         :param decel: deceleration in rotations per second per second
         :return:
         """
-        send_bus_message(accel, "axis0.trap_traj.config.accel_limit", self.node_id)
-        send_bus_message(decel, "axis0.trap_traj.config.decel_limit", self.node_id)
+        shadow_registers.write(
+            self.node_id, {TRAJ_ACCEL_LIMIT: accel, TRAJ_DECEL_LIMIT: decel}
+        )
 
         self.max_accel = accel
         self.max_decel = decel
@@ -237,66 +275,116 @@ class OdriveController:
         Set the torque of the motor
         :param torque: Torque in Nm
         """
-        send_bus_message(torque, "axis0.controller.input_torque", self.node_id)
+        cansimple.set_input_torque(self.node_id, torque)
 
-    def wait_for_move(self, delay=0.05):
-        while abs(self.requested_position - self.get_encoder_pos()) > 0.1:
-            sleep(0.01)
+    def wait_for_move(self, delay=0.05, timeout=None):
+        """
+        Block until the current move is complete
+        :param delay: extra seconds to wait after arriving, for the axis to settle
+        :param timeout: seconds to wait for the move, None waits forever
+        :return:
+        """
+        future = self.move_future
+        if future is not None and not future.cancelled():
+            future.result(timeout)
         sleep(delay)
         print("Move complete")
 
-    def check_for_move(self):
-        self.wait_for_move()
-        self.moving = False
+    def _on_move_done(self, future):
+        # a superseded move must not clear the flag for the move that replaced it
+        if future is self.move_future:
+            self.moving = False
 
-    def move_to_rotation(self, pos):
+    def angle_to_rotation(self, angle):
         """
-        Move to a position
+        Convert a joint angle to a motor position
+        :param angle: angle in degrees
+        :return: position in revolutions, with the gear ratio and reversal applied
+        """
+        if self.reversed:
+            angle = -angle
+        return (angle / 360) * self.gear_ratio
+
+    def start_position(self):
+        """
+        Get the position the next trajectory will start from: the last commanded position once the axis has
+        settled there, the measured position while a move is still in flight
+        :return: position in revolutions
+        """
+        if self.moving:
+            return self.get_encoder_pos()
+        return self.requested_position
+
+    def begin_move(self, pos):
+        """
+        Track a move and update the commanded position, call right before the position command goes out
         :param pos: pos in revolutions
-        :return:
+        :return: Future resolving to the settled position once the move is complete
         """
-        print(f"Moving to position {pos}...")
         if not self.enabled:
             warning_message("Motor is not enabled, enabling...")
             self.enable_motor()
         self.moving = True
-        send_bus_message(pos, "axis0.controller.input_pos", self.node_id)
-
-        moving_thread = threading.Thread(target=self.check_for_move)
-        moving_thread.start()
+        self.move_future = motion_monitor.track(self.node_id, pos)
+        self.move_future.add_done_callback(self._on_move_done)
 
         self.requested_position = pos
         self.position = (pos * 360) / self.gear_ratio
+        return self.move_future
 
-    def move_to_angle(self, angle, speed_offset=1):
+    def traj_limit_values(self, speed_offset=1):
         """
-        Move to an angle
-        :param angle: angle in degrees
+        Get the trap_traj limits for a move
         :param speed_offset: offset for the speed/accel of the motor
-        :return:
+        :return: dict of endpoint path -> value, for shadow_registers
         """
-        original_speed = self.max_speed
-        original_accel = self.max_accel
-        original_decel = self.max_decel
+        return {
+            TRAJ_VEL_LIMIT: self.max_speed * speed_offset,
+            TRAJ_ACCEL_LIMIT: self.max_accel * speed_offset,
+            TRAJ_DECEL_LIMIT: self.max_decel * speed_offset,
+        }
 
-        if self.reversed:
-            angle = -angle
-
-        if speed_offset != 1:
-            self.set_speed(self.max_speed * speed_offset)
-            self.set_accel_decel(
-                self.max_accel * speed_offset, self.max_decel * speed_offset
-            )
+    def move_to_rotation(self, pos):
+        """
+        Move to a position
+        :param pos: pos in revolutions
+        :return: Future resolving to the settled position once the move is complete
+        """
+        print(f"Moving to position {pos}...")
+        # only writes anything if a MultiAxisMove left synchronised limits behind
+        shadow_registers.write(self.node_id, self.traj_limit_values())
+        future = self.begin_move(pos)
+        cansimple.set_input_pos(self.node_id, pos)
+        return future
 
-        revolutions = (angle / 360) * self.gear_ratio
+    def move_to_angle(self, angle, speed_offset=1):
+        """
+        Move to an angle
+        :param angle: angle in degrees
+        :param speed_offset: offset for the speed/accel of the motor, only for this move
+        :return: Future resolving to the settled position (in revolutions) once the move is complete
+        """
+        revolutions = self.angle_to_rotation(angle)
 
         print(f"Moving to angle {angle} by going to {revolutions} revolutions...")
 
-        self.move_to_rotation(revolutions)
-
-        self.max_speed = original_speed
-        self.max_accel = original_accel
-        self.max_decel = original_decel
+        if speed_offset == 1:
+            return self.move_to_rotation(revolutions)
+
+        # the ODrive plans the trajectory when the position arrives, so the limits can go back straight after
+        with shadow_registers.transaction() as transaction:
+            for path, value in self.traj_limit_values(speed_offset).items():
+                transaction.set(self.node_id, path, value)
+            future = self.begin_move(revolutions)
+            transaction.send(
+                [
+                    (
+                        arbitration_id(self.node_id, cansimple.CMD_SET_INPUT_POS),
+                        cansimple.input_pos_data(revolutions),
+                    )
+                ]
+            )
+        return future
 
     def set_percent_traj(self, percentage):
         """
@@ -309,6 +397,22 @@ class OdriveController:
             OdriveSpeeds.max_accel * percentage, OdriveSpeeds.max_decel * percentage
         )
 
-    def emergency_stop(self):
-        self.set_speed(0)
-        self.move_to_rotation(self.get_encoder_pos())
+    def stopped(self):
+        """
+        Forget the move in flight after the axis has been put in IDLE behind the controller's back
+        :return:
+        """
+        motion_monitor.cancel(self.node_id)
+        self.enabled = False
+        self.moving = False
+
+    def emergency_stop(self, mode="estop", timeout=0.5):
+        """
+        Stop the motor straight away, ahead of anything queued, see estop.emergency_stop
+        :param mode: "estop" (latches ESTOP_REQUESTED) or "idle"
+        :param timeout: seconds to wait for the heartbeat confirming it
+        :return: the emergency_stop report
+        """
+        report = estop.emergency_stop([self.node_id], mode, timeout)
+        self.stopped()
+        return report
@@ -0,0 +1,215 @@
+from math import isclose
+from threading import Lock
+
+from Server.MotorControllerLibs.CANControlledMotors.bus_manager import (
+    OPCODE_WRITE,
+    PRIORITY_MOTION,
+    RX_SDO_IDS,
+    arbitration_id,
+)
+from Server.MotorControllerLibs.CANControlledMotors.can_functions import (
+    get_bus_manager,
+    prepare_endpoint,
+    send_burst,
+)
+from Server.MotorControllerLibs.CANControlledMotors import cansimple
+
+TRAJ_VEL_LIMIT = "axis0.trap_traj.config.vel_limit"
+TRAJ_ACCEL_LIMIT = "axis0.trap_traj.config.accel_limit"
+TRAJ_DECEL_LIMIT = "axis0.trap_traj.config.decel_limit"
+
+
+class ShadowRegisters:
+    def __init__(self):
+        """
+        The last value written to each endpoint of each node, so writes of a value the ODrive already holds
+        can be skipped. Only writes made through here (or reported with record) are known, anything else
+        that writes an endpoint should forget it.
+        The trap_traj limits go out as their CANSimple commands rather than SDO writes.
+        """
+        # (node_id, path) -> value
+        self._values = {}
+        self._lock = Lock()
+
+    def known(self, node_id, path):
+        """
+        :param node_id: Node id of the ODrive controller
+        :param path: endpoint path
+        :return: the value last written, None if it isn't known
+        """
+        return self._values.get((node_id, path))
+
+    def record(self, node_id, path, value):
+        """
+        Note a value the ODrive holds without writing it, e.g. one read back or written elsewhere
+        :param node_id: Node id of the ODrive controller
+        :param path: endpoint path
+        :param value: the value it holds
+        :return:
+        """
+        with self._lock:
+            self._values[(node_id, path)] = value
+
+    def forget(self, node_id=None, path=None):
+        """
+        Drop cached values, after a reboot or a write made behind the cache's back
+        :param node_id: node to forget, None for every node
+        :param path: endpoint to forget, None for every endpoint
+        :return:
+        """
+        with self._lock:
+            for key in list(self._values):
+                if (node_id is None or key[0] == node_id) and (
+                    path is None or key[1] == path
+                ):
+                    del self._values[key]
+
+    def _matches(self, node_id, path, value):
+        current = self._values.get((node_id, path))
+        if current is None:
+            return False
+        if isinstance(value, float) or isinstance(current, float):
+            # floats are stored in single precision on the ODrive
+            return isclose(value, current, rel_tol=1e-6)
+        return value == current
+
+    def frames(self, node_id, values):
+        """
+        Build the frames for the writes that change something, and mark them written.
+        The caller is expected to send them.
+        :param node_id: Node id of the ODrive controller
+        :param values: dict of endpoint path -> value
+        :return: list of (arbitration_id, data)
+        """
+        frames = []
+        with self._lock:
+            changed = {
+                path: value
+                for path, value in values.items()
+                if not self._matches(node_id, path, value)
+            }
+            for path, value in changed.items():
+                self._values[(node_id, path)] = value
+
+            if TRAJ_VEL_LIMIT in changed:
+                frames.append(
+                    (
+                        arbitration_id(node_id, cansimple.CMD_SET_TRAJ_VEL_LIMIT),
+                        cansimple.f32.pack(changed.pop(TRAJ_VEL_LIMIT)),
+                    )
+                )
+            if TRAJ_ACCEL_LIMIT in changed or TRAJ_DECEL_LIMIT in changed:
+                # one command sets both, the other one has to be known to send it
+                accel = self._values.get((node_id, TRAJ_ACCEL_LIMIT))
+                decel = self._values.get((node_id, TRAJ_DECEL_LIMIT))
+                if accel is not None and decel is not None:
+                    changed.pop(TRAJ_ACCEL_LIMIT, None)
+                    changed.pop(TRAJ_DECEL_LIMIT, None)
+                    frames.append(
+                        (
+                            arbitration_id(
+                                node_id, cansimple.CMD_SET_TRAJ_ACCEL_LIMITS
+                            ),
+                            cansimple.two_f32.pack(accel, decel),
+                        )
+                    )
+
+        for path, value in changed.items():
+            handle = prepare_endpoint(path)
+            frames.append(
+                (
+                    RX_SDO_IDS[node_id],
+                    handle.write_struct.pack(
+                        OPCODE_WRITE, handle.endpoint_id, 0, value
+                    ),
+                )
+            )
+        return frames
+
+    def write(self, node_id, values, priority=PRIORITY_MOTION):
+        """
+        Write the values the ODrive doesn't already hold, in one burst
+        :param node_id: Node id of the ODrive controller
+        :param values: dict of endpoint path -> value
+        :param priority: transmit priority class, the default keeps limits in order with the moves they are for
+        :return: number of frames sent
+        """
+        frames = self.frames(node_id, values)
+        if frames:
+            get_bus_manager(node_id).send_burst(frames, priority)
+        return len(frames)
+
+    def transaction(self, restore=True, priority=PRIORITY_MOTION):
+        """
+        Group writes to any number of nodes into one burst, e.g.
+            with shadow_registers.transaction() as transaction:
+                transaction.set(node_id, TRAJ_VEL_LIMIT, 5)
+                transaction.send([input_pos_frame])
+        :param restore: put the values held before the transaction back when it ends
+        :param priority: transmit priority class of the bursts
+        :return: Transaction
+        """
+        return Transaction(self, restore, priority)
+
+
+class Transaction:
+    def __init__(self, registers, restore=True, priority=PRIORITY_MOTION):
+        """
+        Writes buffered until send() or the end of the with block, see ShadowRegisters.transaction
+        :param registers: ShadowRegisters the writes go through
+        :param restore: put the values held before the transaction back when it ends
+        :param priority: transmit priority class of the bursts
+        """
+        self.registers = registers
+        self.restore = restore
+        self.priority = priority
+        self.frames_sent = 0
+
+        # node_id -> {path: value} not sent yet
+        self._pending = {}
+        # (node_id, path) -> value before the transaction first wrote it, None if unknown
+        self._originals = {}
+
+    def set(self, node_id, path, value):
+        """
+        Queue a write
+        :param node_id: Node id of the ODrive controller
+        :param path: endpoint path
+        :param value: value to write
+        :return:
+        """
+        if (node_id, path) not in self._originals:
+            self._originals[(node_id, path)] = self.registers.known(node_id, path)
+        self._pending.setdefault(node_id, {})[path] = value
+
+    def send(self, frames=()):
+        """
+        Send the queued writes that change something, followed by any other frames, in one burst
+        :param frames: list of (arbitration_id, data) to send after the writes, e.g. the move they are for
+        :return: number of frames sent
+        """
+        burst = []
+        for node_id, values in self._pending.items():
+            burst += self.registers.frames(node_id, values)
+        self._pending = {}
+        burst += frames
+        if burst:
+            send_burst(burst, self.priority)
+        self.frames_sent += len(burst)
+        return len(burst)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.send()
+        if self.restore:
+            for (node_id, path), value in self._originals.items():
+                # a value that was never known can't be put back
+                if value is not None:
+                    self._pending.setdefault(node_id, {})[path] = value
+            self.send()
+        return False
+
+
+shadow_registers = ShadowRegisters()
@@ -0,0 +1,193 @@
+import struct
+from collections import deque
+from threading import Lock
+from time import monotonic
+
+from Server.MotorControllerLibs.CANControlledMotors.bus_manager import arbitration_id
+from Server.MotorControllerLibs.CANControlledMotors.can_functions import (
+    get_bus_manager,
+    prepare_endpoint,
+    write_many,
+)
+
+# CANSimple cyclic messages: command id -> (name, layout, field names)
+CYCLIC_MESSAGES = {
+    0x01: (
+        "heartbeat",
+        struct.Struct("<IBBB"),
+        ("axis_error", "axis_state", "procedure_result", "trajectory_done"),
+    ),
+    0x09: ("encoder", struct.Struct("<ff"), ("pos_estimate", "vel_estimate")),
+    0x14: ("iq", struct.Struct("<ff"), ("iq_setpoint", "iq_measured")),
+    0x17: ("bus_voltage", struct.Struct("<ff"), ("bus_voltage", "bus_current")),
+}
+
+# message name -> endpoint controlling its period
+RATE_ENDPOINTS = {
+    "heartbeat": prepare_endpoint("axis0.config.can.heartbeat_msg_rate_ms"),
+    "encoder": prepare_endpoint("axis0.config.can.encoder_msg_rate_ms"),
+    "iq": prepare_endpoint("axis0.config.can.iq_msg_rate_ms"),
+    "bus_voltage": prepare_endpoint("axis0.config.can.bus_voltage_msg_rate_ms"),
+}
+
+# default periods in ms, about 40% of a 250 kbit/s bus with six nodes
+DEFAULT_RATES_MS = {
+    "heartbeat": 100,
+    "encoder": 10,
+    "iq": 50,
+    "bus_voltage": 500,
+}
+
+
+class Telemetry:
+    def __init__(self, manager=None, history_length=1000):
+        """
+        Decodes the ODrive cyclic CANSimple messages into a per-node state table.
+        Samples are (monotonic timestamp, *fields) tuples, replaced atomically so reads never block.
+        :param manager: BusManager all the nodes are on, None for each node's own bus (opened on first use)
+        :param history_length: number of samples kept per node and message
+        """
+        self._manager = manager
+        self.history_length = history_length
+
+        # node_id -> message name -> latest sample
+        self.state = {}
+        # (node_id, message name) -> ring buffer of samples
+        self._history = {}
+        self._history_lock = Lock()
+        # node_id -> [(arbitration_id, callback)]
+        self._subscriptions = {}
+        # replaced rather than mutated so the receiver thread can iterate it without a lock
+        self._listeners = ()
+
+    def manager(self, node_id):
+        """
+        :param node_id: Node id of the ODrive controller
+        :return: the BusManager the node's messages arrive on
+        """
+        return self._manager or get_bus_manager(node_id)
+
+    def rate_settings(self, rates_ms=None):
+        """
+        Get the endpoint writes that set the cyclic message periods
+        :param rates_ms: message name -> period in ms, missing names use DEFAULT_RATES_MS
+        :return: list of (value, EndpointHandle)
+        """
+        rates = dict(DEFAULT_RATES_MS)
+        rates.update(rates_ms or {})
+        return [(rates[name], handle) for name, handle in RATE_ENDPOINTS.items()]
+
+    def configure(self, node_id, rates_ms=None):
+        """
+        Set the cyclic message periods on an ODrive, a period of 0 disables the message
+        :param node_id: Node id of the ODrive controller
+        :param rates_ms: message name -> period in ms, missing names use DEFAULT_RATES_MS
+        :return:
+        """
+        write_many(
+            [(value, handle, node_id) for value, handle in self.rate_settings(rates_ms)]
+        )
+
+    def add_node(self, node_id):
+        """
+        Start decoding the cyclic messages of a node
+        :param node_id: Node id of the ODrive controller
+        :return:
+        """
+        if node_id in self._subscriptions:
+            return
+        self.state[node_id] = {}
+        subscriptions = []
+        for cmd_id, (name, layout, _) in CYCLIC_MESSAGES.items():
+            with self._history_lock:
+                self._history[(node_id, name)] = deque(maxlen=self.history_length)
+            callback = self._make_decoder(node_id, name, layout)
+            self.manager(node_id).subscribe(arbitration_id(node_id, cmd_id), callback)
+            subscriptions.append((arbitration_id(node_id, cmd_id), callback))
+        self._subscriptions[node_id] = subscriptions
+
+    def remove_node(self, node_id):
+        """
+        Stop decoding the cyclic messages of a node and drop its state
+        :param node_id: Node id of the ODrive controller
+        :return:
+        """
+        for arb_id, callback in self._subscriptions.pop(node_id, []):
+            self.manager(node_id).unsubscribe(arb_id, callback)
+        self.state.pop(node_id, None)
+        with self._history_lock:
+            for name, _, _ in CYCLIC_MESSAGES.values():
+                self._history.pop((node_id, name), None)
+
+    def _make_decoder(self, node_id, name, layout):
+        node_state = self.state[node_id]
+        history = self._history[(node_id, name)]
+        lock = self._history_lock
+
+        def decode(msg):
+            sample = (monotonic(),) + layout.unpack_from(msg.data)
+            node_state[name] = sample
+            with lock:
+                history.append(sample)
+            for listener in self._listeners:
+                listener(node_id, name, sample)
+
+        return decode
+
+    def add_listener(self, callback):
+        """
+        Call callback(node_id, message, sample) from the receiver thread for every decoded sample
+        :param callback: function, must not block
+        :return:
+        """
+        self._listeners = self._listeners + (callback,)
+
+    def remove_listener(self, callback):
+        """
+        Remove a callback added with add_listener
+        :param callback: the registered callback
+        :return:
+        """
+        self._listeners = tuple(
+            listener for listener in self._listeners if listener is not callback
+        )
+
+    def latest(self, node_id, message="encoder", max_age=None):
+        """
+        Get the most recent sample of a message without touching the bus
+        :param node_id: Node id of the ODrive controller
+        :param message: heartbeat, encoder, iq or bus_voltage
+        :param max_age: seconds, older samples are treated as missing
+        :return: (timestamp, *fields) or None if there is no (fresh enough) sample
+        """
+        sample = self.state.get(node_id, {}).get(message)
+        if sample is None:
+            return None
+        if max_age is not None and monotonic() - sample[0] > max_age:
+            return None
+        return sample
+
+    def history(self, node_id, message="encoder"):
+        """
+        Get the buffered samples of a message, oldest first
+        :param node_id: Node id of the ODrive controller
+        :param message: heartbeat, encoder, iq or bus_voltage
+        :return: list of (timestamp, *fields)
+        """
+        with self._history_lock:
+            return list(self._history.get((node_id, message), ()))
+
+
+def field_names(message):
+    """
+    Get the field names of a message's samples, after the timestamp
+    :param message: heartbeat, encoder, iq or bus_voltage
+    :return: tuple of field names
+    """
+    for name, _, fields in CYCLIC_MESSAGES.values():
+        if name == message:
+            return fields
+    raise KeyError(message)
+
+
+telemetry = Telemetry()
@@ -0,0 +1,271 @@
+from concurrent.futures import Future, wait
+from threading import Event, Thread
+from time import perf_counter, sleep
+
+import numpy as np
+
+from Server.MotorControllerLibs.CANControlledMotors.bus_manager import (
+    PRIORITY_MOTION,
+    arbitration_id,
+)
+from Server.MotorControllerLibs.CANControlledMotors.can_functions import (
+    get_bus_manager,
+    prepare_endpoint,
+)
+from Server.MotorControllerLibs.CANControlledMotors import cansimple
+
+input_filter_bandwidth = prepare_endpoint(
+    "axis0.controller.config.input_filter_bandwidth"
+)
+
+# Set_Input_Pos payload: position, velocity feedforward (0.001 rev/s), torque feedforward (0.001 Nm)
+input_pos_dtype = np.dtype([("pos", "<f4"), ("vel_ff", "<i2"), ("torque_ff", "<i2")])
+
+# the last stretch before a deadline is spun rather than slept, sleep() overshoots by up to ~100 us
+SPIN_SECONDS = 0.0002
+
+
+class TrajectoryStream:
+    def __init__(
+        self,
+        controllers,
+        positions,
+        rate_hz=500,
+        vel_ff=None,
+        torque_ff=None,
+        input_mode=cansimple.INPUT_MODE_PASSTHROUGH,
+        filter_bandwidth=None,
+        start_tolerance=0.1,
+    ):
+        """
+        Streams a precomputed path to several joints at a fixed rate: every period one Set_Input_Pos frame per
+        node goes out in a single burst, from a scheduler thread that times each frame from the stream's start
+        so sleep overshoot never accumulates. A frame whose slot has passed by more than a period is dropped
+        and the stream catches up, so the joints stay on the path's clock. Lateness and jitter are measured
+        when a sample's frames have been handed to the interface, not when they are queued.
+        :param controllers: list of OdriveController, one per column
+        :param positions: array (samples, joints) of positions in revolutions
+        :param rate_hz: samples per second
+        :param vel_ff: optional array (samples, joints) of velocity feedforward in rev/s
+        :param torque_ff: optional array (samples, joints) of torque feedforward in Nm
+        :param input_mode: cansimple.INPUT_MODE_PASSTHROUGH or cansimple.INPUT_MODE_POS_FILTER
+        :param filter_bandwidth: input filter bandwidth in Hz for INPUT_MODE_POS_FILTER, None keeps the ODrive's
+        :param start_tolerance: revolutions the first sample may be from where a joint is, the ODrive would jump
+        """
+        self.controllers = list(controllers)
+        positions = np.asarray(positions, dtype=np.float64)
+        if positions.ndim != 2 or positions.shape[1] != len(self.controllers):
+            raise ValueError(
+                f"positions must be (samples, {len(self.controllers)}), got {positions.shape}"
+            )
+        self.positions = positions
+        self.rate_hz = rate_hz
+        self.period = 1 / rate_hz
+        self.input_mode = input_mode
+        self.filter_bandwidth = filter_bandwidth
+        self.start_tolerance = start_tolerance
+
+        # every frame is packed up front, the scheduler thread only slices bytes
+        payloads = np.zeros(positions.shape, dtype=input_pos_dtype)
+        payloads["pos"] = positions
+        for field, values in (("vel_ff", vel_ff), ("torque_ff", torque_ff)):
+            if values is not None:
+                payloads[field] = np.clip(
+                    np.rint(np.asarray(values, dtype=np.float64) * 1000),
+                    cansimple.INT16_MIN,
+                    cansimple.INT16_MAX,
+                )
+        ids = [
+            arbitration_id(controller.node_id, cansimple.CMD_SET_INPUT_POS)
+            for controller in self.controllers
+        ]
+        self._frames = [
+            list(zip(ids, (row[j].tobytes() for j in range(len(ids)))))
+            for row in payloads
+        ]
+
+        # seconds each sample was handed to the interface after its slot, nan where dropped
+        self.lateness = np.full(len(positions), np.nan)
+        self.sent = 0
+        self.dropped = 0
+        self.started = None
+        self.finished = None
+
+        self.future = None
+        self._stop = Event()
+        self._thread = None
+
+    @classmethod
+    def from_angles(cls, controllers, angles, rate_hz=500, **kwargs):
+        """
+        Build a stream from joint angles rather than motor positions
+        :param controllers: list of OdriveController, one per column
+        :param angles: array (samples, joints) of angles in degrees
+        :param rate_hz: samples per second
+        :param kwargs: other TrajectoryStream arguments
+        :return: TrajectoryStream
+        """
+        scale = np.array(
+            [
+                (-1 if controller.reversed else 1) * controller.gear_ratio / 360
+                for controller in controllers
+            ]
+        )
+        return cls(controllers, np.asarray(angles) * scale, rate_hz, **kwargs)
+
+    def start(self):
+        """
+        Switch the joints to streamed position input and start the scheduler thread
+        :return: Future resolving to stats() once the last sample has been sent or the stream is stopped
+        """
+        for column, controller in enumerate(self.controllers):
+            distance = abs(self.positions[0, column] - controller.start_position())
+            if distance > self.start_tolerance:
+                raise ValueError(
+                    f"ODrive with id {controller.node_id} is {distance:.3f} revolutions from the first sample, "
+                    f"move it there first"
+                )
+
+        for controller in self.controllers:
+            if self.filter_bandwidth is not None:
+                # the write isn't acknowledged, it goes in the motion lane so it is out before the mode switch
+                input_filter_bandwidth.set(
+                    self.filter_bandwidth, controller.node_id, priority=PRIORITY_MOTION
+                )
+            cansimple.set_controller_mode(
+                controller.node_id, cansimple.CONTROL_MODE_POSITION, self.input_mode
+            )
+            if not controller.enabled:
+                controller.enable_motor()
+            controller.moving = True
+
+        self.future = Future()
+        self._stop.clear()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self.future
+
+    def stop(self):
+        """
+        Stop streaming, the joints hold the last sample that was sent
+        :return:
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def wait(self, timeout=None):
+        """
+        Block until the stream is done
+        :param timeout: seconds to wait, None waits forever
+        :return: stats()
+        """
+        return self.future.result(timeout)
+
+    def _run(self):
+        # split each sample by the bus its nodes are on once, not on every send
+        buses = {}
+        for column, controller in enumerate(self.controllers):
+            buses.setdefault(get_bus_manager(controller.node_id), []).append(column)
+        frames = [
+            [
+                (manager, [row[column] for column in columns])
+                for manager, columns in buses.items()
+            ]
+            for row in self._frames
+        ]
+        period = self.period
+        count = len(frames)
+        last = -1
+        queued = []
+
+        try:
+            start = perf_counter()
+            self.started = start
+            index = 0
+            while index < count and not self._stop.is_set():
+                deadline = start + index * period
+                remaining = deadline - perf_counter()
+                if remaining > SPIN_SECONDS:
+                    sleep(remaining - SPIN_SECONDS)
+                while perf_counter() < deadline:
+                    pass
+
+                now = perf_counter()
+                behind = int((now - deadline) / period)
+                if behind:
+                    # too late for this slot (and maybe more), jump to the sample due now
+                    skipped = min(behind, count - 1 - index)
+                    self.dropped += skipped
+                    index += skipped
+                    deadline = start + index * period
+
+                queued = [
+                    manager.send_burst(burst, PRIORITY_MOTION)
+                    for manager, burst in frames[index]
+                ]
+                for future in queued:
+                    future.add_done_callback(self._make_sent_callback(index, deadline))
+                self.sent += 1
+                last = index
+                index += 1
+            # the motion lane is first in first out, once the last sample is out so is everything before it
+            wait(queued, timeout=1)
+        except Exception as e:
+            self.finished = perf_counter()
+            self._finish(last)
+            self.future.set_exception(e)
+            return
+
+        self.finished = perf_counter()
+        self._finish(last)
+        stats = self.stats()
+        print(
+            f"Streamed {stats['sent']} samples at {stats['rate_hz']:.1f} Hz "
+            f"(target {self.rate_hz} Hz), jitter {stats['jitter_us']:.0f} us rms / "
+            f"{stats['max_late_us']:.0f} us max, {stats['dropped']} dropped"
+        )
+        self.future.set_result(stats)
+
+    def _make_sent_callback(self, index, deadline):
+        def on_sent(future):
+            # called from the transmit thread, a sample split over several buses is out with its last frame
+            if not future.cancelled() and future.exception() is None:
+                self.lateness[index] = np.fmax(
+                    self.lateness[index], perf_counter() - deadline
+                )
+
+        return on_sent
+
+    def _finish(self, last):
+        for column, controller in enumerate(self.controllers):
+            # back to point to point moves, starting from wherever the stream left the joint
+            cansimple.set_controller_mode(
+                controller.node_id,
+                cansimple.CONTROL_MODE_POSITION,
+                cansimple.INPUT_MODE_TRAP_TRAJ,
+            )
+            if last >= 0:
+                pos = float(self.positions[last, column])
+                controller.requested_position = pos
+                controller.position = (pos * 360) / controller.gear_ratio
+            controller.moving = False
+
+    def stats(self):
+        """
+        :return: dict with samples sent and dropped, the achieved rate in Hz and the send jitter in microseconds
+        """
+        late = self.lateness[~np.isnan(self.lateness)]
+        sent_at = np.flatnonzero(~np.isnan(self.lateness))
+        rate = 0.0
+        if len(sent_at) > 1:
+            first = self.started + sent_at[0] * self.period + late[0]
+            last = self.started + sent_at[-1] * self.period + late[-1]
+            rate = float((len(sent_at) - 1) / (last - first))
+        return {
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "rate_hz": rate,
+            "jitter_us": float(np.std(late) * 1e6) if len(late) else 0.0,
+            "max_late_us": float(np.max(late) * 1e6) if len(late) else 0.0,
+        }
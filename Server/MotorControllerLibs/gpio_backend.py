@@ -0,0 +1,346 @@
+"""
+GPIO backends for the stepper motion engine. A motion engine hands a backend a whole pulse train, an array of
+edge_dtype sorted by time, in one send() call:
+    PigpioBackend   pigpio waveforms, timed by DMA in the pigpiod daemon, rates Python can't toggle at
+    RPiGPIOBackend  RPi.GPIO, one output() call per edge timed in Python
+    RecordingBackend  no hardware, keeps every edge with its clock time for checking timing offline
+default_backend() picks the first one that works here. Software timing goes through a clock, WallClock normally,
+a VirtualClock lets a RecordingBackend play trains instantly in simulated time (see stepper_simulation).
+"""
+
+from time import perf_counter_ns, sleep
+
+import numpy as np
+
+HIGH = 1
+LOW = 0
+
+# one edge of a pulse train: when (ns from the start of the train, or perf_counter_ns() once recorded),
+# which BCM pin and the level it goes to
+edge_dtype = np.dtype([("time_ns", "<i8"), ("pin", "u1"), ("level", "u1")])
+
+# step pulse width, drivers like the A4988/DRV8825 need 1-2 us
+PULSE_NS = 2_000
+
+# the last stretch before an edge is spun rather than slept, sleep() overshoots by up to ~100 us
+SPIN_NS = 200_000
+
+# pulses per pigpio waveform, pigpiod's default limit is 12000
+MAX_WAVE_PULSES = 10_000
+
+
+class WallClock:
+    virtual = False
+
+    def now(self):
+        """
+        :return: perf_counter_ns()
+        """
+        return perf_counter_ns()
+
+    def sleep_until(self, deadline):
+        """
+        Sleep until SPIN_NS before the deadline, then spin to it
+        :param deadline: perf_counter_ns() to wake at
+        :return:
+        """
+        remaining = deadline - perf_counter_ns()
+        if remaining > SPIN_NS:
+            sleep((remaining - SPIN_NS) / 1e9)
+        while perf_counter_ns() < deadline:
+            pass
+
+
+class VirtualClock:
+    virtual = True
+
+    def __init__(self, start=0):
+        """
+        Simulated time that only moves when something sleeps on it, so nothing ever waits
+        :param start: time to start at in ns
+        """
+        self.time = start
+
+    def now(self):
+        """
+        :return: simulated time in ns
+        """
+        return self.time
+
+    def sleep_until(self, deadline):
+        """
+        Jump to the deadline
+        :param deadline: simulated time in ns
+        :return:
+        """
+        if deadline > self.time:
+            self.time = deadline
+
+
+wall_clock = WallClock()
+
+
+def step_train(step_pin, times, pulse_ns=PULSE_NS):
+    """
+    Build the pulse train of a run of steps
+    :param step_pin: BCM pin of the step input
+    :param times: int64 array of step times in ns, see stepper_profile.step_times
+    :param pulse_ns: pulse width
+    :return: array of edge_dtype, a rising and a falling edge per step
+    """
+    edges = np.zeros(2 * len(times), dtype=edge_dtype)
+    edges["time_ns"][0::2] = times
+    edges["time_ns"][1::2] = times + pulse_ns
+    edges["pin"] = step_pin
+    edges["level"][0::2] = HIGH
+    return edges
+
+
+def merge_trains(trains):
+    """
+    Merge pulse trains into one, edges at the same time keep the order of trains
+    :param trains: list of edge_dtype arrays
+    :return: array of edge_dtype sorted by time
+    """
+    edges = np.concatenate(trains) if trains else np.zeros(0, dtype=edge_dtype)
+    return edges[np.argsort(edges["time_ns"], kind="stable")]
+
+
+class GpioBackend:
+    # True when send() is timed by hardware rather than by the calling thread
+    batched = False
+    # what software timing and start times are measured on
+    clock = wall_clock
+
+    def setup(self, pin):
+        """
+        Make a pin an output
+        :param pin: BCM pin number
+        :return:
+        """
+        raise NotImplementedError
+
+    def output(self, pin, level):
+        """
+        Set a pin straight away
+        :param pin: BCM pin number
+        :param level: HIGH or LOW
+        :return:
+        """
+        raise NotImplementedError
+
+    def send(self, edges, start_ns=None):
+        """
+        Play a pulse train and return once its last edge is out. Here every edge is timed in the calling
+        thread against its absolute deadline (sleep, then spin), edges at the same time go out back to back.
+        :param edges: array of edge_dtype sorted by time, times relative to start_ns
+        :param start_ns: clock time the train starts at, None for now
+        :return: int64 array of ns each edge went out after its deadline
+        """
+        count = len(edges)
+        lateness = np.zeros(count, dtype=np.int64)
+        times = edges["time_ns"].tolist()
+        pins = edges["pin"].tolist()
+        levels = edges["level"].tolist()
+        output = self.output
+        now = self.clock.now
+        sleep_until = self.clock.sleep_until
+
+        start = now() if start_ns is None else start_ns
+        index = 0
+        while index < count:
+            offset = times[index]
+            deadline = start + offset
+            sleep_until(deadline)
+            first = index
+            while index < count and times[index] == offset:
+                output(pins[index], levels[index])
+                index += 1
+            lateness[first:index] = now() - deadline
+        return lateness
+
+    def cleanup(self):
+        """
+        Release the pins
+        :return:
+        """
+
+
+class RPiGPIOBackend(GpioBackend):
+    def __init__(self):
+        """
+        RPi.GPIO with BCM numbering, every edge is its own output() call
+        """
+        import RPi.GPIO as GPIO
+
+        self.gpio = GPIO
+        GPIO.setmode(GPIO.BCM)
+
+    def setup(self, pin):
+        self.gpio.setup(pin, self.gpio.OUT)
+
+    def output(self, pin, level):
+        self.gpio.output(pin, level)
+
+    def cleanup(self):
+        self.gpio.cleanup()
+
+
+class PigpioBackend(GpioBackend):
+    batched = True
+
+    def __init__(self, host=None):
+        """
+        pigpio waveforms: the train is turned into pulses and played by DMA in the pigpiod daemon, long trains
+        go out as a chain of waveforms built while the previous one plays
+        :param host: host running pigpiod, None for this one
+        """
+        import pigpio
+
+        self._pigpio = pigpio
+        self.pi = pigpio.pi() if host is None else pigpio.pi(host)
+        if not self.pi.connected:
+            raise RuntimeError("pigpiod is not running")
+
+    def setup(self, pin):
+        self.pi.set_mode(pin, self._pigpio.OUTPUT)
+
+    def output(self, pin, level):
+        self.pi.write(pin, level)
+
+    def pulses(self, edges):
+        """
+        Convert a pulse train to pigpio pulses: one per distinct edge time, with the set and clear masks
+        of the edges at that time and the delay until the next one
+        :param edges: array of edge_dtype sorted by time
+        :return: list of pigpio.pulse
+        """
+        # whole microseconds from the start, so rounding never accumulates
+        times = np.rint(edges["time_ns"] / 1000).astype(np.int64)
+        unique_times, first = np.unique(times, return_index=True)
+        masks = np.left_shift(1, edges["pin"].astype(np.uint32)).astype(np.uint32)
+        high = edges["level"] == HIGH
+        on = np.bitwise_or.reduceat(np.where(high, masks, 0), first)
+        # a pulse ending as the next one on the same pin starts stays high, there's no time for the low
+        off = np.bitwise_or.reduceat(np.where(high, 0, masks), first) & ~on
+        delays = np.diff(unique_times, append=unique_times[-1])
+
+        pulse = self._pigpio.pulse
+        pulses = [pulse(0, 0, int(unique_times[0]))] if unique_times[0] > 0 else []
+        pulses += [
+            pulse(int(on_mask), int(off_mask), int(delay))
+            for on_mask, off_mask, delay in zip(on, off, delays)
+        ]
+        return pulses
+
+    def send(self, edges, start_ns=None):
+        if not len(edges):
+            return np.zeros(0, dtype=np.int64)
+        pulses = self.pulses(edges)
+        if start_ns is not None:
+            # measured once the pulses are built, converting a long train takes a while
+            delay = (start_ns - perf_counter_ns()) // 1000
+            if delay > 0:
+                pulses.insert(0, self._pigpio.pulse(0, 0, delay))
+        pi = self.pi
+        waves = []
+        try:
+            for first in range(0, len(pulses), MAX_WAVE_PULSES):
+                if waves:
+                    # only two waves in the daemon at a time, the one playing and the next: wait for the
+                    # last one sent to start playing, everything before it has finished then
+                    while pi.wave_tx_at() != waves[-1] and pi.wave_tx_busy():
+                        sleep(0.001)
+                    for wave in waves[:-1]:
+                        pi.wave_delete(wave)
+                    del waves[:-1]
+                pi.wave_add_generic(pulses[first : first + MAX_WAVE_PULSES])
+                wave = pi.wave_create()
+                # starts when the wave before it ends, so the chain has no gaps
+                pi.wave_send_using_mode(wave, self._pigpio.WAVE_MODE_ONE_SHOT_SYNC)
+                waves.append(wave)
+            while pi.wave_tx_busy():
+                sleep(0.001)
+        finally:
+            for wave in waves:
+                pi.wave_delete(wave)
+        # timed by DMA
+        return np.zeros(len(edges), dtype=np.int64)
+
+    def cleanup(self):
+        self.pi.wave_tx_stop()
+        self.pi.stop()
+
+
+class RecordingBackend(GpioBackend):
+    def __init__(self, clock=None):
+        """
+        No hardware: every output() is kept with its clock time, see edges()
+        :param clock: WallClock or VirtualClock, None for the wall clock. On a VirtualClock send() records
+        the whole train at its scheduled times in one go and moves the clock to its end
+        """
+        if clock is not None:
+            self.clock = clock
+        # recorded edges as arrays of edge_dtype, then output() calls not yet added to them
+        self._chunks = []
+        self._edges = []
+
+    @property
+    def batched(self):
+        return self.clock.virtual
+
+    def setup(self, pin):
+        pass
+
+    def output(self, pin, level):
+        self._edges.append((self.clock.now(), pin, level))
+
+    def send(self, edges, start_ns=None):
+        if not self.clock.virtual:
+            return super().send(edges, start_ns)
+        start = self.clock.now() if start_ns is None else start_ns
+        self._flush()
+        recorded = edges.copy()
+        recorded["time_ns"] += start
+        self._chunks.append(recorded)
+        if len(edges):
+            self.clock.sleep_until(start + int(edges["time_ns"][-1]))
+        return np.zeros(len(edges), dtype=np.int64)
+
+    def _flush(self):
+        if self._edges:
+            self._chunks.append(np.array(self._edges, dtype=edge_dtype))
+            self._edges = []
+
+    def edges(self, pin=None):
+        """
+        :param pin: only the edges of this pin, None for all of them
+        :return: array of edge_dtype of everything output so far, times are clock times
+        """
+        self._flush()
+        edges = np.concatenate([np.zeros(0, dtype=edge_dtype)] + self._chunks)
+        if pin is not None:
+            edges = edges[edges["pin"] == pin]
+        return edges
+
+    def clear(self):
+        """
+        Forget the recorded edges
+        :return:
+        """
+        self._chunks = []
+        self._edges = []
+
+
+def default_backend():
+    """
+    :return: PigpioBackend if pigpiod is running, otherwise RPiGPIOBackend, otherwise (off the Pi) RecordingBackend
+    """
+    try:
+        return PigpioBackend()
+    except (ImportError, RuntimeError):
+        pass
+    try:
+        return RPiGPIOBackend()
+    except ImportError:
+        return RecordingBackend()
@@ -0,0 +1,152 @@
+"""
+Benchmarks for the stepper motion engine, on whatever backend gpio_backend.default_backend finds (the recording
+one off the Pi).
+Run from Server/MotorControllerLibs:
+    python stepper_benchmark.py [benchmark ...]
+With no benchmark names every benchmark is run.
+"""
+
+import argparse
+import contextlib
+import io
+from time import perf_counter, process_time, sleep
+
+import numpy as np
+
+from gpio_backend import RecordingBackend, merge_trains, step_train
+from stepper_group import StepperGroup
+from stepper_motor_controller import StepperMotor
+from stepper_profile import step_times
+
+# step and direction pins of up to 8 motors, enable and micro stepping pins are shared
+MOTOR_PINS = [[pin, pin + 1, 0, [5, 6]] for pin in range(8, 24, 2)]
+
+
+def make_motors(number, speed_steps=1000, accel_steps=10000, backend=None):
+    """
+    :param number: motors to create
+    :param speed_steps: speed limit in steps per second
+    :param accel_steps: acceleration in steps per second^2
+    :param backend: GpioBackend, None for the default one
+    :return: list of StepperMotor
+    """
+    motors = []
+    for pins in MOTOR_PINS[:number]:
+        motor = StepperMotor(pins, backend)
+        motor.max_speed = speed_steps * motor.step_angle
+        motor.acceleration = accel_steps * motor.step_angle
+        motors.append(motor)
+    return motors
+
+
+def report(name, lateness, cpu, wall):
+    """
+    Print a step jitter summary
+    :param name: label for the measurement
+    :param lateness: array of ns each step went out after its deadline
+    :param cpu: process CPU seconds used
+    :param wall: wall clock seconds
+    :return:
+    """
+    late = lateness / 1e3
+    print(
+        f"{name:<24} steps {len(late):6d}   median {np.median(late):7.1f} us   "
+        f"p99 {np.percentile(late, 99):8.1f} us   max {late.max():8.1f} us   "
+        f"cpu {cpu / wall:5.0%}"
+    )
+
+
+def bench_step_jitter(motor_counts=(1, 4, 8), steps=1500):
+    """
+    Time how late each step goes out with several motors moving at once, every motor on its own move thread
+    versus one StepperGroup scheduler thread
+    """
+    print(f"Step lateness, {steps} steps per motor at up to 1000 steps/s")
+    for number in motor_counts:
+        motors = make_motors(number)
+        group = StepperGroup(motors)
+        quiet = io.StringIO()
+
+        cpu = process_time()
+        wall = perf_counter()
+        with contextlib.redirect_stdout(quiet):
+            for motor in motors:
+                motor.set_step(motor.steps + steps)
+            while any(motor.moving for motor in motors):
+                sleep(0.01)
+        report(
+            f"{number} motors, threads",
+            np.concatenate([motor.lateness for motor in motors]),
+            process_time() - cpu,
+            perf_counter() - wall,
+        )
+
+        cpu = process_time()
+        wall = perf_counter()
+        moves = group.move_steps(
+            {motor: motor.steps - steps for motor in motors}, blocking=True
+        )
+        report(
+            f"{number} motors, group",
+            np.concatenate([move.lateness for move in moves]),
+            process_time() - cpu,
+            perf_counter() - wall,
+        )
+
+
+def bench_pulse_train(motors=8, steps=10000):
+    """
+    Time building a merged pulse train for a synchronised move, then play one motor's train on a
+    RecordingBackend and check the recorded edges against the schedule
+    """
+    times = [step_times(steps, 5000, 20000 + 1000 * index) for index in range(motors)]
+    repeats = 20
+    wall = perf_counter()
+    for _ in range(repeats):
+        edges = merge_trains(
+            [step_train(MOTOR_PINS[index][0], times[index]) for index in range(motors)]
+        )
+    wall = (perf_counter() - wall) / repeats
+    print(
+        f"Pulse train, {motors} motors x {steps} steps: {len(edges)} edges built in "
+        f"{wall * 1e3:.1f} ms ({wall / len(edges) * 1e9:.0f} ns per edge)"
+    )
+
+    backend = RecordingBackend()
+    motor = make_motors(1, backend=backend)[0]
+    schedule = step_times(2000, 1000, 10000)
+    cpu = process_time()
+    wall = perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        motor.set_step(motor.steps + 2000, blocking=True)
+    report(
+        "recorded train", motor.lateness, process_time() - cpu, perf_counter() - wall
+    )
+
+    recorded = backend.edges(motor.step_pin)
+    rising = recorded["time_ns"][recorded["level"] == 1]
+    falling = recorded["time_ns"][recorded["level"] == 0]
+    error = np.abs((rising - rising[0]) - (schedule - schedule[0])) / 1e3
+    print(
+        f"recorded {len(rising)} pulses   width median {np.median(falling - rising) / 1e3:.1f} us   "
+        f"error vs schedule median {np.median(error):.1f} us   max {error.max():.1f} us"
+    )
+
+
+BENCHMARKS = {
+    "step_jitter": bench_step_jitter,
+    "pulse_train": bench_pulse_train,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stepper benchmarks")
+    parser.add_argument("benchmarks", nargs="*", help=", ".join(BENCHMARKS))
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark {name}")
+
+    for name in args.benchmarks or list(BENCHMARKS):
+        BENCHMARKS[name]()
+        print()
@@ -1,37 +1,4 @@
-def import_gpio():
-    # Try to import RPi.GPIO; if it fails, define a mock GPIO class for simulation
-    try:
-        import RPi.GPIO as GPIO
-
-        return GPIO
-    except ImportError:
-        print("RPi.GPIO not found; using mock GPIO class for simulation")
-
-        class GPIO:
-            BCM = "BCM"
-            OUT = "OUT"
-            HIGH = True
-            LOW = False
-
-            @staticmethod
-            def setmode(mode):
-                # empty for simulation
-                pass
-
-            @staticmethod
-            def setup(pin, mode):
-                # empty for simulation
-                pass
-
-            @staticmethod
-            def output(pin, state):
-                # empty for simulation
-                pass
-
-        return GPIO
-
-
-GPIO = import_gpio()
+from gpio_backend import HIGH, LOW
 
 
 class StepperConstants:
@@ -39,10 +6,10 @@ class StepperConstants:
     microstepping = 16  # micro stepping of the stepper motor (8, 16, 32, 64)
 
     microstep_map = {
-        8: (GPIO.LOW, GPIO.LOW),
-        16: (GPIO.HIGH, GPIO.HIGH),
-        32: (GPIO.HIGH, GPIO.LOW),
-        64: (GPIO.LOW, GPIO.HIGH),
+        8: (LOW, LOW),
+        16: (HIGH, HIGH),
+        32: (HIGH, LOW),
+        64: (LOW, HIGH),
     }
 
     # -----------
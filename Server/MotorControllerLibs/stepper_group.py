@@ -0,0 +1,232 @@
+from heapq import heappop, heappush
+from itertools import count
+from threading import Condition, Event, Lock, Thread
+from time import perf_counter_ns
+
+import numpy as np
+
+from gpio_backend import HIGH, LOW, SPIN_NS, merge_trains, step_train
+
+# moves start this far in the future so every motor of a synchronised move shares the same start
+START_DELAY_NS = 1_000_000
+
+
+class StepMove:
+    __slots__ = (
+        "motor",
+        "times",
+        "direction",
+        "deadlines",
+        "lateness",
+        "index",
+        "done",
+    )
+
+    def __init__(self, motor, times, direction):
+        """
+        One motor's part of a group move, stepped through by the scheduler thread once begun
+        :param motor: StepperMotor
+        :param times: int64 array of ns from the start of the move
+        :param direction: 1 or -1
+        """
+        self.motor = motor
+        self.times = times
+        self.direction = direction
+        # clock times of the steps, set by begin
+        self.deadlines = None
+        self.lateness = np.zeros(len(times), dtype=np.int64)
+        self.index = 0
+        self.done = Event()
+
+    def begin(self, start):
+        """
+        Fix when the move starts, and set the motor's direction pin and the schedule its position follows
+        :param start: clock time the move starts at
+        :return:
+        """
+        self.deadlines = (self.times + start).tolist()
+        self.motor._begin_move(start, self.times, self.direction)
+
+
+class StepperGroup:
+    def __init__(self, motors, backend=None):
+        """
+        Drives several StepperMotors from one timing thread. Every running move is a cursor into its
+        precomputed step times, the cursors sit in a heap ordered by their next deadline, so the thread
+        always sleeps until the earliest step of any motor, spins the last SPIN_NS and emits it.
+        On a batched backend (pigpio, or recording on a VirtualClock) there is no timing thread: each move goes
+        out as one merged pulse train, and moves run one after the other.
+        Use it instead of the motors' own set_position, not alongside it.
+        :param motors: list of StepperMotor, all on the same backend
+        :param backend: GpioBackend, None for the first motor's
+        """
+        self.motors = list(motors)
+        self.backend = self.motors[0].backend if backend is None else backend
+        # one pulse train in the backend at a time
+        self._send_lock = Lock()
+
+        self._condition = Condition()
+        # heap of (deadline, sequence, StepMove)
+        self._heap = []
+        self._sequence = count()
+        # motor -> its StepMove in flight
+        self._active = {}
+
+        self._thread = None
+        if not self.backend.batched:
+            self._thread = Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def move(self, targets, synchronized=True, blocking=False):
+        """
+        Move several motors at once
+        :param targets: dict of StepperMotor -> position in degrees
+        :param synchronized: stretch every motor's profile to the slowest one's so they all finish together
+        :param blocking: wait for the move to finish
+        :return: list of StepMove, one per motor that has somewhere to go
+        """
+        return self.move_steps(
+            {motor: motor.degrees_to_steps(angle) for motor, angle in targets.items()},
+            synchronized,
+            blocking,
+        )
+
+    def move_steps(self, targets, synchronized=True, blocking=False):
+        """
+        Move several motors at once, see move
+        :param targets: dict of StepperMotor -> position in steps
+        :param synchronized: stretch every motor's profile to the slowest one's so they all finish together
+        :param blocking: wait for the move to finish
+        :return: list of StepMove, one per motor that has somewhere to go
+        """
+        # a motor still moving finishes its current move first
+        for motor in targets:
+            active = self._active.get(motor)
+            if active is not None:
+                active.done.wait()
+
+        plans = {motor: motor.plan_steps(target) for motor, target in targets.items()}
+        plans = {motor: plan for motor, plan in plans.items() if len(plan[0])}
+        if synchronized and plans:
+            duration = max(int(times[-1]) for times, _ in plans.values())
+            # stretching a trapezoid in time by s divides its velocity by s and its acceleration by s^2
+            plans = {
+                motor: (
+                    np.rint(times * (duration / times[-1])).astype(np.int64),
+                    direction,
+                )
+                for motor, (times, direction) in plans.items()
+            }
+
+        moves = []
+        for motor, (times, direction) in plans.items():
+            motor.moving = True
+            moves.append(StepMove(motor, times, direction))
+
+        if self.backend.batched:
+            with self._condition:
+                for move in moves:
+                    self._active[move.motor] = move
+            edges = merge_trains(
+                [
+                    step_train(motor.step_pin, times)
+                    for motor, (times, _) in plans.items()
+                ]
+            )
+            Thread(target=self._send, args=(edges, moves), daemon=True).start()
+        else:
+            start = self.backend.clock.now() + START_DELAY_NS
+            for move in moves:
+                move.begin(start)
+            self._queue(moves)
+
+        if blocking:
+            for move in moves:
+                move.done.wait()
+        return moves
+
+    def _queue(self, moves):
+        with self._condition:
+            for move in moves:
+                self._active[move.motor] = move
+                heappush(self._heap, (move.deadlines[0], next(self._sequence), move))
+            self._condition.notify()
+
+    def _send(self, edges, moves):
+        with self._send_lock:
+            # only known once the pulse train before this one is done
+            start = self.backend.clock.now() + START_DELAY_NS
+            for move in moves:
+                move.begin(start)
+            self.backend.send(edges, start)
+        for move in moves:
+            self._finish(move)
+
+    def wait(self, timeout=None):
+        """
+        Block until every motor has stopped
+        :param timeout: seconds to wait for each move, None waits forever
+        :return: True if everything stopped in time
+        """
+        return all(move.done.wait(timeout) for move in list(self._active.values()))
+
+    def moving(self):
+        """
+        :return: True while any motor of the group is moving
+        """
+        return bool(self._active)
+
+    def _finish(self, move):
+        motor = move.motor
+        motor._end_move(move.lateness)
+        motor.moving = False
+        with self._condition:
+            if self._active.get(motor) is move:
+                del self._active[motor]
+        move.done.set()
+
+    def _run(self):
+        heap = self._heap
+        condition = self._condition
+        output = self.backend.output
+
+        while True:
+            with condition:
+                while not heap:
+                    condition.wait()
+                deadline = heap[0][0]
+                remaining = deadline - perf_counter_ns()
+                if remaining > SPIN_NS:
+                    # woken early by a new move, whose first step may now be the earliest
+                    condition.wait((remaining - SPIN_NS) / 1e9)
+                    continue
+                # every step due by then goes out together, e.g. all the motors of a synchronised move
+                due = [heappop(heap)[2]]
+                while heap and heap[0][0] <= deadline:
+                    due.append(heappop(heap)[2])
+
+            while perf_counter_ns() < deadline:
+                pass
+            for move in due:
+                output(move.motor.step_pin, HIGH)
+            sent = perf_counter_ns()
+            for move in due:
+                output(move.motor.step_pin, LOW)
+
+            requeue = []
+            for move in due:
+                index = move.index
+                move.lateness[index] = sent - move.deadlines[index]
+                index += 1
+                move.index = index
+                if index < len(move.deadlines):
+                    requeue.append(move)
+                else:
+                    self._finish(move)
+            if requeue:
+                with condition:
+                    for move in requeue:
+                        heappush(
+                            heap,
+                            (move.deadlines[move.index], next(self._sequence), move),
+                        )
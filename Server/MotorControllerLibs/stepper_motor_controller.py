@@ -1,216 +1,252 @@
-from math import sqrt
-from threading import Thread
-from time import sleep, time
+from threading import Lock, Thread
 
-from stepper_constants import StepperConstants, import_gpio
+import numpy as np
 
-GPIO = import_gpio()
-GPIO.setmode(GPIO.BCM)  # Use BCM GPIO numbering
+from gpio_backend import HIGH, LOW, default_backend, step_train
+from stepper_constants import StepperConstants
+from stepper_profile import step_intervals, step_times
+
+# shared by every motor that isn't given a backend of its own
+gpio = default_backend()
 
 
 class StepperMotor:
-    def __init__(self, motor_pins):
+    def __init__(self, motor_pins, backend=None):
         """
-        Stepper Motor class to control a stepper motor using the RPi.GPIO library.
+        Stepper Motor class to control a stepper motor through a GPIO backend.
         :param motor_pins: the pins to control the stepper motor in the following order:
         [step_pin, direction_pin, enable_pin, [micro_stepping_pins]]
+        :param backend: GpioBackend from gpio_backend, None for the shared default one
         """
         self.step_pin = motor_pins[0]
         self.direction_pin = motor_pins[1]
         self.enable_pin = motor_pins[2]
         self.micro_stepping_pins = motor_pins[3]
 
-        GPIO.setup(self.step_pin, GPIO.OUT)
-        GPIO.setup(self.direction_pin, GPIO.OUT)
-        GPIO.setup(self.enable_pin, GPIO.OUT)
-        GPIO.setup(self.micro_stepping_pins, GPIO.OUT)
+        self.backend = gpio if backend is None else backend
+        for pin in [self.step_pin, self.direction_pin, self.enable_pin]:
+            self.backend.setup(pin)
+        for pin in self.micro_stepping_pins:
+            self.backend.setup(pin)
+
+        self.backend.output(self.enable_pin, HIGH)
 
-        GPIO.output(self.enable_pin, GPIO.HIGH)
+        # position as a signed count of (micro)steps from zero, the degrees are derived from it.
+        # Updated once a move is done, current_position follows the move while it runs
+        self.steps = 0
+        self.moving = False
+        # (start clock time, step times, direction, velocities, steps at the start) of the move in flight
+        self._schedule = None
+
+        # moves asked for and not finished yet, moving stays True until the last of them is done
+        self._moves_pending = 0
+        self._pending_lock = Lock()
 
         self.micro_stepping = StepperConstants.microstepping
         self.set_micro_stepping(StepperConstants.microstepping)
 
-        self.current_position = 0
-        self.current_velocity = 0
-        self.moving = False
-
         self.max_speed = StepperConstants.max_speed
         self.acceleration = StepperConstants.acceleration
 
-        self.running_thread = Thread(target=self.running_thread)
-        self.running_thread.start()
+        # one move at a time, a move asked for while another runs starts once it is done
+        self._move_lock = Lock()
+        self.lateness = np.zeros(0, dtype=np.int64)
 
     def set_micro_stepping(self, micro_stepping):
-        GPIO.output(
-            self.micro_stepping_pins[0],
-            StepperConstants.microstep_map[micro_stepping][0],
-        )
-        GPIO.output(
-            self.micro_stepping_pins[1],
-            StepperConstants.microstep_map[micro_stepping][1],
-        )
-        self.micro_stepping = micro_stepping
-
-    def running_thread(self):
-        while True:
-            start_time = time()
-            if self.current_velocity > 0:
-                GPIO.output(self.direction_pin, GPIO.HIGH)
-            elif self.current_velocity < 0:
-                GPIO.output(self.direction_pin, GPIO.LOW)
-
-            step_velocity = abs(self.current_velocity) / (
-                StepperConstants.degrees_per_step / self.micro_stepping
-            )
-            if step_velocity != 0:
-                GPIO.output(self.step_pin, GPIO.HIGH)
-                sleep(1 / (2 * step_velocity))
-                GPIO.output(self.step_pin, GPIO.LOW)
-                sleep(1 / (2 * step_velocity))
-            else:
-                sleep(0.01)
-            self.current_position += self.current_velocity * (time() - start_time)
-
-    def set_position(self, position, blocking=False):
-        if blocking:
-            self._set_position(position)
-        else:
-            Thread(target=self._set_position, args=(position,)).start()
-            sleep(0.05)
-
-    def _set_position(self, position):
-        print(f"Moving to position: {position}")
-        self.moving = True
-        change_in_position = position - self.current_position
-        start_position = self.current_position
-        print(f"Change in position: {change_in_position}")
-
-        if self._get_acceleration_distance() * 2 > abs(change_in_position):
-            print("Move too short to get to max speed...")
-            accelerate_position = position - change_in_position / 2
-            decelerate_position = position - change_in_position / 2
-        else:
-            accelerate_position = (
-                self.current_position
-                + self._get_acceleration_distance()
-                * (1 if change_in_position > 0 else -1)
-            )
-            decelerate_position = position - self._get_acceleration_distance() * (
-                1 if change_in_position > 0 else -1
-            )
-
-        self.current_position = (
-            0.01 if self.current_position == 0 else self.current_position
-        )
-
-        print(f"Accelerate Position: {accelerate_position}")
-        print(f"Decelerate Position: {decelerate_position}")
-
-        def get_acceleration_velocity():
-            return sqrt(
-                2
-                * self.acceleration
-                * abs(self.current_position - (start_position - 0.1))
-            )
-
-        def get_deceleration_velocity():
-            return sqrt(
-                2
-                * self.acceleration
-                * abs(
-                    (self.current_position - start_position)
-                    - (position - start_position)
+        """
+        Change the micro stepping and count the position in the new step size
+        :param micro_stepping: one of StepperConstants.microstep_map
+        :return: ValueError while the motor is moving, or if the position falls between two steps
+        of a coarser setting
+        """
+        levels = StepperConstants.microstep_map[micro_stepping]
+        # held so no move can start between the check and the rescale
+        with self._pending_lock:
+            if self.moving:
+                raise ValueError(
+                    "Can't change the micro stepping while the motor is moving"
                 )
-            )
+            # exact both ways, a coarser setting is refused rather than rounding a step away
+            steps, remainder = divmod(self.steps * micro_stepping, self.micro_stepping)
+            if remainder:
+                raise ValueError(
+                    f"Position {self.steps} at {self.micro_stepping} micro stepping "
+                    f"isn't a whole step at {micro_stepping}"
+                )
+            self.backend.output(self.micro_stepping_pins[0], levels[0])
+            self.backend.output(self.micro_stepping_pins[1], levels[1])
+            self.steps = steps
+            self.micro_stepping = micro_stepping
 
-        if change_in_position > 0:
-            while self.current_position < accelerate_position:
-                self.current_velocity = get_acceleration_velocity()
-                sleep(0.0001)
+    @property
+    def step_angle(self):
+        """
+        :return: degrees per (micro)step at the current micro stepping
+        """
+        return StepperConstants.degrees_per_step / self.micro_stepping
 
-            while self.current_position < decelerate_position:
-                self.current_velocity = self.max_speed
-                sleep(0.0001)
+    def step_now(self):
+        """
+        :return: (position in steps, velocity in degrees per second) right now, read off the schedule
+        of the move in flight since the backend reports nothing back while it plays a pulse train
+        """
+        schedule = self._schedule
+        if schedule is None:
+            return self.steps, 0
+        start, times, direction, velocities, steps = schedule
+        done = int(np.searchsorted(times, self.backend.clock.now() - start, "right"))
+        velocity = float(velocities[done - 1]) if 0 < done < len(times) else 0
+        return steps + direction * done, velocity
+
+    @property
+    def current_position(self):
+        """
+        :return: position in degrees
+        """
+        return self.step_now()[0] * self.step_angle
 
-            while self.current_position < position:
-                self.current_velocity = get_deceleration_velocity()
-                sleep(0.0001)
-        else:
-            while self.current_position > accelerate_position:
-                self.current_velocity = -get_acceleration_velocity()
-                sleep(0.0001)
+    @property
+    def current_velocity(self):
+        """
+        :return: velocity in degrees per second
+        """
+        return self.step_now()[1]
 
-            while self.current_position > decelerate_position:
-                self.current_velocity = -self.max_speed
-                sleep(0.0001)
+    def degrees_to_steps(self, degrees):
+        """
+        :param degrees: position in degrees
+        :return: the nearest whole step at the current micro stepping
+        """
+        return round(degrees / self.step_angle)
 
-            while self.current_position > position:
-                self.current_velocity = -get_deceleration_velocity()
-                sleep(0.0001)
+    def set_position(self, position, blocking=False):
+        """
+        Move to a position along a trapezoidal profile
+        :param position: position in degrees, rounded to the nearest step
+        :param blocking: wait for the move to finish, otherwise it runs on its own thread
+        :return:
+        """
+        print(f"Moving to position: {position}")
+        self.set_step(self.degrees_to_steps(position), blocking)
 
-        self.current_velocity = 0
-        self.moving = False
-        print(f"Stopped at: {self.current_position}\n")
+    def set_step(self, target, blocking=False):
+        """
+        Move to a step count along a trapezoidal profile
+        :param target: position in steps at the current micro stepping
+        :param blocking: wait for the move to finish, otherwise it runs on its own thread
+        :return:
+        """
+        # set before returning so callers polling moving don't see the move as already done
+        with self._pending_lock:
+            self._moves_pending += 1
+            self.moving = True
+        if blocking:
+            self._set_step(target)
+        else:
+            Thread(target=self._set_step, args=(target,)).start()
 
-    def _get_acceleration_time(self):
-        return self.max_speed / self.acceleration
+    def plan_steps(self, target):
+        """
+        Plan a move from the current step count at this motor's speed and acceleration
+        :param target: position in steps at the current micro stepping
+        :return: (step times in ns from the start, see stepper_profile.step_times, direction 1 or -1)
+        """
+        steps = target - self.steps
+        step_angle = self.step_angle
+        times = step_times(
+            steps, self.max_speed / step_angle, self.acceleration / step_angle
+        )
+        return times, 1 if steps > 0 else -1
+
+    def _set_step(self, target):
+        try:
+            with self._move_lock:
+                times, direction = self.plan_steps(target)
+                print(
+                    f"Change in position: {direction * len(times) * self.step_angle} ({len(times)} steps)"
+                )
+                self._run_steps(times, direction)
+                print(f"Stopped at: {self.current_position}\n")
+        finally:
+            with self._pending_lock:
+                self._moves_pending -= 1
+                # a move waiting on _move_lock keeps the motor moving
+                self.moving = self._moves_pending > 0
+
+    def _begin_move(self, start, times, direction):
+        """
+        Set the direction pin and the schedule current_position follows
+        :param start: backend clock time the move starts at
+        :param times: int64 array of nanoseconds from the start of the move
+        :param direction: 1 or -1
+        :return:
+        """
+        self.backend.output(self.direction_pin, HIGH if direction > 0 else LOW)
+        velocities = (
+            direction * self.step_angle * 1e9 / np.maximum(step_intervals(times), 1)
+        )
+        self._schedule = (start, times, direction, velocities, self.steps)
 
-    def _get_acceleration_distance(self):
-        return 0.5 * self.acceleration * self._get_acceleration_time() ** 2
+    def _end_move(self, lateness):
+        """
+        Commit the steps of the move in flight
+        :param lateness: int64 array of ns each step went out after its deadline
+        :return:
+        """
+        _, times, direction, _, steps = self._schedule
+        # steps first, so current_position never counts the move twice
+        self.steps = steps + direction * len(times)
+        self._schedule = None
+        # nanoseconds each step of the last move went out after its deadline
+        self.lateness = lateness
+
+    def _run_steps(self, times, direction):
+        """
+        Send the whole move to the backend as one pulse train, timed against absolute deadlines from the start
+        of the move so sleep overshoot never accumulates
+        :param times: int64 array of nanoseconds from the start of the move, see stepper_profile.step_times
+        :param direction: 1 or -1
+        :return:
+        """
+        start = self.backend.clock.now()
+        self._begin_move(start, times, direction)
+        lateness = self.backend.send(step_train(self.step_pin, times), start)
+        # rising edges
+        self._end_move(lateness[0::2])
 
 
 if __name__ == "__main__":
+    from stepper_simulation import run, sample, simulated_motor, trace
+
     graph_enabled = False  # Toggle graphing here
 
+    # in virtual time, the moves take as long to simulate as it takes to plan them
+    motor = simulated_motor()
+    moves = [180, -180]
+    run(motor, moves, pause=0.5)
+    steps = trace(motor)
+    print(
+        f"{len(steps)} steps over {steps['time_ns'][-1] / 1e9:.2f} s, "
+        f"stopped at {motor.current_position}, top speed {abs(steps['velocity']).max():.2f} deg/s"
+    )
+
     if graph_enabled:
         import matplotlib.pyplot as plt  # Only import if graphing is enabled
 
-    motor = StepperMotor([1, 12, 0, [5, 6]])
-
-    moves = [180, -180]
-
-    positions = []
-    velocities = []
-    time_steps = []
-    start_time = time()
+        time_steps, positions, velocities = sample(steps)
 
-    if graph_enabled:
         plt.figure(figsize=(10, 5))
         plt.subplot(2, 1, 1)
-        (pos_plot,) = plt.plot([], [], label="Position")
+        plt.plot(time_steps, positions, label="Position")
         plt.title("Stepper Motor Position Over Time")
         plt.ylabel("Position")
         plt.legend()
 
         plt.subplot(2, 1, 2)
-        (vel_plot,) = plt.plot([], [], label="Velocity", color="orange")
+        plt.plot(time_steps, velocities, label="Velocity", color="orange")
         plt.title("Stepper Motor Velocity Over Time")
         plt.ylabel("Velocity")
         plt.xlabel("Time (s)")
         plt.legend()
 
-    for move in moves:
-        motor.set_position(move, blocking=False)
-
-        while motor.moving:
-            positions.append(motor.current_position)
-            velocities.append(motor.current_velocity)
-            time_steps.append(time() - start_time)
-
-            if graph_enabled:
-                pos_plot.set_data(time_steps, positions)
-                vel_plot.set_data(time_steps, velocities)
-
-                plt.subplot(2, 1, 1)
-                plt.xlim(0, max(time_steps))
-                plt.ylim(min(positions), max(positions))
-
-                plt.subplot(2, 1, 2)
-                plt.xlim(0, max(time_steps))
-                plt.ylim(min(velocities), max(velocities))
-
-                plt.pause(0.01)  # Pause to update the plot
-            sleep(0.01)
-
-    if graph_enabled:
         plt.show()
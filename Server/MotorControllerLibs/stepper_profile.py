@@ -0,0 +1,46 @@
+from math import sqrt
+
+import numpy as np
+
+
+def step_times(steps, max_speed, acceleration):
+    """
+    Get when every step of a trapezoidal move starting and ending at rest is due. A step fires when the ideal
+    position reaches its halfway point, so the first and last steps aren't stretched by the ramp.
+    :param steps: number of steps, the sign is ignored
+    :param max_speed: speed limit in steps per second
+    :param acceleration: acceleration (and deceleration) in steps per second^2
+    :return: int64 array of nanoseconds from the start of the move, one per step
+    """
+    count = abs(int(steps))
+    if count == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    ramp = max_speed * max_speed / (2 * acceleration)
+    peak = max_speed
+    if 2 * ramp > count:
+        # never reaches the speed limit, triangular profile
+        ramp = count / 2
+        peak = sqrt(acceleration * count)
+    ramp_time = peak / acceleration
+    total = 2 * ramp_time + (count - 2 * ramp) / peak
+
+    position = np.arange(count) + 0.5
+    times = np.where(
+        position <= ramp,
+        np.sqrt(2 * position / acceleration),
+        np.where(
+            position <= count - ramp,
+            ramp_time + (position - ramp) / peak,
+            total - np.sqrt(2 * np.maximum(count - position, 0) / acceleration),
+        ),
+    )
+    return np.rint(times * 1e9).astype(np.int64)
+
+
+def step_intervals(times):
+    """
+    :param times: step times from step_times
+    :return: int64 array of nanoseconds since the previous step (since the start for the first one)
+    """
+    return np.diff(times, prepend=0)
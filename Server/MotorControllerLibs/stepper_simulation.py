@@ -0,0 +1,192 @@
+"""
+Run StepperMotor moves in virtual time: the motor drives a RecordingBackend on a VirtualClock, so a move takes
+as long as building its pulse train rather than as long as the motion, and the recorded edges are turned into
+position/velocity traces. Run from Server/MotorControllerLibs:
+    python stepper_simulation.py [cases]
+to check that many random profiles against their speed and acceleration limits.
+"""
+
+import argparse
+from time import perf_counter
+
+import numpy as np
+
+from gpio_backend import HIGH, RecordingBackend, VirtualClock
+from stepper_motor_controller import StepperMotor
+
+SIMULATED_PINS = [1, 12, 0, [5, 6]]
+
+# one row per step
+trace_dtype = np.dtype(
+    [
+        ("time_ns", "<i8"),
+        ("move_ns", "<i8"),
+        ("steps", "<i8"),
+        ("position", "<f8"),
+        ("velocity", "<f8"),
+    ]
+)
+
+
+def simulated_motor(max_speed=None, acceleration=None, micro_stepping=None):
+    """
+    :param max_speed: speed limit in degrees per second, None for the StepperConstants one
+    :param acceleration: acceleration in degrees per second^2, None for the StepperConstants one
+    :param micro_stepping: micro stepping, None for the StepperConstants one
+    :return: StepperMotor on a RecordingBackend with its own VirtualClock
+    """
+    motor = StepperMotor(SIMULATED_PINS, RecordingBackend(VirtualClock()))
+    if micro_stepping is not None:
+        motor.set_micro_stepping(micro_stepping)
+    if max_speed is not None:
+        motor.max_speed = max_speed
+    if acceleration is not None:
+        motor.acceleration = acceleration
+    return motor
+
+
+def run(motor, positions, pause=0.0):
+    """
+    Move through positions one after the other, without the prints of set_position
+    :param motor: StepperMotor from simulated_motor
+    :param positions: positions in degrees
+    :param pause: seconds to stay still between moves
+    :return:
+    """
+    clock = motor.backend.clock
+    for position in positions:
+        times, direction = motor.plan_steps(motor.degrees_to_steps(position))
+        motor._run_steps(times, direction)
+        clock.sleep_until(clock.now() + int(pause * 1e9))
+
+
+def trace(motor):
+    """
+    Rebuild what the motor did from the edges its backend recorded
+    :param motor: StepperMotor from simulated_motor
+    :return: array of trace_dtype, one row per step: when it went out (on the clock and since the start of its
+    move), the step count and position in degrees after it and the velocity in degrees per second since the step
+    before (or the start of its move)
+    """
+    backend = motor.backend
+    step_edges = backend.edges(motor.step_pin)
+    times = step_edges["time_ns"][step_edges["level"] == HIGH]
+    direction_edges = backend.edges(motor.direction_pin)
+    move_starts = direction_edges["time_ns"]
+
+    # each move sets the direction pin as it starts
+    move = np.searchsorted(move_starts, times, "right") - 1
+    direction = np.where(direction_edges["level"][move] == HIGH, 1, -1)
+    previous = np.maximum(
+        np.concatenate([times[:1] * 0, times[:-1]]), move_starts[move]
+    )
+
+    steps = np.cumsum(direction)
+    result = np.zeros(len(times), dtype=trace_dtype)
+    result["time_ns"] = times
+    result["move_ns"] = times - move_starts[move]
+    result["steps"] = steps
+    result["position"] = steps * motor.step_angle
+    result["velocity"] = (
+        direction * motor.step_angle * 1e9 / np.maximum(times - previous, 1)
+    )
+    return result
+
+
+def sample(steps, interval=0.01):
+    """
+    Resample a trace at a fixed interval, e.g. for plotting
+    :param steps: array of trace_dtype
+    :param interval: seconds between samples
+    :return: (times in seconds, positions in degrees, velocities in degrees per second)
+    """
+    if not len(steps):
+        return np.zeros(0), np.zeros(0), np.zeros(0)
+    times = np.arange(0, steps["time_ns"][-1] + 1, int(interval * 1e9))
+    index = np.searchsorted(steps["time_ns"], times, "right") - 1
+    moved = index >= 0
+    positions = np.where(moved, steps["position"][index], 0.0)
+    velocities = np.where(moved, steps["velocity"][index], 0.0)
+    return times / 1e9, positions, velocities
+
+
+def check(steps, max_speed, acceleration, tolerance=0.01):
+    """
+    Check a move's trace against the limits it was planned with. Between two steps the motor covers exactly
+    one step, so the traced velocity is its mean velocity over the interval, and that can't be above the
+    trapezoid min(a t, max speed, a (T - t)) at the interval's midpoint. T is the end of the move, a profile
+    is symmetric so it ends as long after the last step as the first step is after the start.
+    :param steps: array of trace_dtype of a single move
+    :param max_speed: speed limit in degrees per second
+    :param acceleration: acceleration in degrees per second^2
+    :param tolerance: allowed excess as a fraction of the limit
+    :return: list of problems, empty when the trace is within its limits
+    """
+    if len(steps) < 2:
+        return []
+    times = steps["move_ns"] / 1e9
+    end = times[0] + times[-1]
+    midpoints = (times[1:] + times[:-1]) / 2
+    envelope = np.minimum(
+        np.minimum(acceleration * midpoints, max_speed),
+        acceleration * (end - midpoints),
+    )
+    excess = np.abs(steps["velocity"][1:]) / envelope - 1
+    worst = int(np.argmax(excess))
+    if excess[worst] > tolerance:
+        return [
+            f"step {worst + 1} at {abs(steps['velocity'][worst + 1]):.3f} over the "
+            f"profile's {envelope[worst]:.3f} at {midpoints[worst]:.4f} s"
+        ]
+    return []
+
+
+def regression(cases=1000, seed=0):
+    """
+    Simulate random moves and check each one's trace against its limits
+    :param cases: number of moves
+    :param seed: random seed
+    :return: list of (case, parameters, problems) that failed
+    """
+    rng = np.random.default_rng(seed)
+    failures = []
+    for case in range(cases):
+        parameters = {
+            "max_speed": float(rng.uniform(1, 360)),
+            "acceleration": float(rng.uniform(1, 3600)),
+            "micro_stepping": int(rng.choice([8, 16, 32])),
+            "target": float(rng.uniform(-720, 720)),
+        }
+        motor = simulated_motor(
+            parameters["max_speed"],
+            parameters["acceleration"],
+            parameters["micro_stepping"],
+        )
+        run(motor, [parameters["target"]])
+        steps = trace(motor)
+        problems = check(steps, parameters["max_speed"], parameters["acceleration"])
+        if motor.steps != motor.degrees_to_steps(parameters["target"]):
+            problems.append(f"stopped at step {motor.steps}")
+        if len(steps) and steps["steps"][-1] != motor.steps:
+            problems.append(f"traced {steps['steps'][-1]} steps, counted {motor.steps}")
+        if problems:
+            failures.append((case, parameters, problems))
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Stepper profile regression in virtual time"
+    )
+    parser.add_argument("cases", nargs="?", type=int, default=1000)
+    args = parser.parse_args()
+
+    wall = perf_counter()
+    failures = regression(args.cases)
+    wall = perf_counter() - wall
+    for case, parameters, problems in failures:
+        print(f"case {case} {parameters}: {', '.join(problems)}")
+    print(
+        f"{args.cases} cases in {wall:.2f} s ({wall / args.cases * 1e3:.2f} ms each), "
+        f"{len(failures)} failed"
+    )
@@ -1,10 +1,30 @@
-from SocketCommunication.server import Server
+from time import perf_counter
 
+from SocketCommunication.server import Server
+from Server.MotorControllerLibs.CANControlledMotors.arm_bus import ArmBus
+from Server.MotorControllerLibs.CANControlledMotors.axis_health import axis_health
+from Server.MotorControllerLibs.CANControlledMotors.can_functions import (
+    publish_bus_metrics,
+)
 
 server_connection = Server()
+# the ODrive joints, the emergency_stop command stops every one set up here
+arm = ArmBus()
+# clients can get the heartbeat table of every ODrive from the data channel
+axis_health.publish(server_connection.data)
+# and the bus load and round trip latencies of every bus
+publish_bus_metrics(server_connection.data)
 
 
 def command_handler(command, args):
+    if command == "emergency_stop":
+        # latency is reported from here to the last heartbeat confirming the stop
+        received = perf_counter()
+        try:
+            report = arm.emergency_stop(started=received)
+        except ValueError as e:
+            return {"status": "error", "message": str(e)}
+        return {"status": "success", "result": report}
     if command == "move":
         return {"status": "success", "result": sum(args)}
     return {"status": "error", "message": "Invalid command."}
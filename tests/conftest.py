@@ -0,0 +1,84 @@
+import os
+import sys
+import time
+from itertools import count
+
+import pytest
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+# the CAN modules import through the Server package, the stepper modules are scripts importing their neighbours
+sys.path.insert(0, REPOSITORY_ROOT)
+sys.path.insert(0, os.path.join(REPOSITORY_ROOT, "Server", "MotorControllerLibs"))
+
+_channels = count()
+
+
+@pytest.fixture
+def channel():
+    """
+    :return: a virtual bus channel no other test uses
+    """
+    return f"test-{os.getpid()}-{next(_channels)}"
+
+
+@pytest.fixture
+def peer(channel):
+    """
+    :return: python-can bus on the test's channel, standing in for an ODrive
+    """
+    import can
+
+    bus = can.Bus(channel, interface="virtual")
+    yield bus
+    bus.shutdown()
+
+
+@pytest.fixture
+def manager(channel, peer):
+    """
+    :return: started BusManager on the test's channel with a short SDO reply timeout
+    """
+    import can
+
+    from Server.MotorControllerLibs.CANControlledMotors.bus_manager import BusManager
+
+    manager = BusManager(can.Bus(channel, interface="virtual"), reply_timeout=0.5)
+    manager.start()
+    yield manager
+    manager.stop()
+    manager.bus.shutdown()
+
+
+@pytest.fixture
+def simulator(channel):
+    """
+    :return: OdriveSimulator with nodes 0-2 on the test's channel, connected as can_functions' default bus
+    """
+    from Server.MotorControllerLibs.CANControlledMotors import can_functions
+    from Server.MotorControllerLibs.CANControlledMotors.odrive_simulator import (
+        OdriveSimulator,
+    )
+
+    simulator = OdriveSimulator(range(3), channel=channel, reply_latency=0.001)
+    simulator.start()
+    can_functions.connect(channel, interface="virtual")
+    yield simulator
+    can_functions.shutdown()
+    simulator.stop()
+
+
+@pytest.fixture
+def wait_until():
+    """
+    :return: function(condition, timeout=2.0) polling condition() until it is true, False if it never was
+    """
+
+    def wait(condition, timeout=2.0):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.005)
+        return True
+
+    return wait
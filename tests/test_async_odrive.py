@@ -0,0 +1,86 @@
+import asyncio
+import struct
+
+import can
+import pytest
+
+# the controller takes its default speeds from the deployment's constants module
+pytest.importorskip("constants")
+
+from Server.MotorControllerLibs.CANControlledMotors import cansimple
+from Server.MotorControllerLibs.CANControlledMotors.async_odrive import (
+    AsyncArm,
+    AsyncBus,
+)
+from Server.MotorControllerLibs.CANControlledMotors.bus_manager import (
+    CMD_TX_SDO,
+    arbitration_id,
+)
+
+VEL_LIMIT = "axis0.trap_traj.config.vel_limit"
+float_reply = struct.Struct("<BHBf")
+
+
+def test_reads_are_matched_to_their_nodes(simulator):
+    for node_id in range(3):
+        simulator.nodes[node_id].write(VEL_LIMIT, node_id + 0.5, 0)
+
+    async def main():
+        async with AsyncBus(simulator.channel, interface="virtual") as bus:
+            return await bus.read_many(
+                [(VEL_LIMIT, node_id % 3) for node_id in range(30)], timeout=2
+            )
+
+    assert asyncio.run(main()) == [node_id % 3 + 0.5 for node_id in range(30)]
+
+
+def test_one_request_in_flight_and_late_replies_dropped(channel, peer):
+    async def main():
+        async with AsyncBus(channel, interface="virtual", reply_timeout=0.2) as bus:
+            first = bus.sdo_request(1, 7, b"\x00" * 8, float_reply)
+            second = bus.sdo_request(1, 7, b"\x01" * 8, float_reply)
+            assert peer.recv(1) is not None
+            with pytest.raises(TimeoutError):
+                await first
+            # the second request still waits behind the first one's late reply
+            assert peer.recv(0.05) is None
+            peer.send(
+                can.Message(
+                    arbitration_id=arbitration_id(1, CMD_TX_SDO),
+                    data=float_reply.pack(0, 7, 0, 1.0),
+                    is_extended_id=False,
+                )
+            )
+            await asyncio.sleep(0.05)
+            assert not second.done()
+            assert peer.recv(1).data == b"\x01" * 8
+            peer.send(
+                can.Message(
+                    arbitration_id=arbitration_id(1, CMD_TX_SDO),
+                    data=float_reply.pack(0, 7, 0, 2.0),
+                    is_extended_id=False,
+                )
+            )
+            return await asyncio.wait_for(second, 1)
+
+    assert asyncio.run(main()) == 2.0
+
+
+def test_arm_moves_and_stops(simulator):
+    async def main():
+        async with AsyncBus(simulator.channel, interface="virtual") as bus:
+            arm = AsyncArm(bus)
+            await arm.setup_all([{"id_number": node_id} for node_id in range(3)])
+            positions = await asyncio.wait_for(arm.move({0: 10, 1: 20, 2: -15}), 10)
+            angles = await arm.get_angles()
+            report = await arm.emergency_stop()
+            return arm, positions, angles, report
+
+    arm, positions, angles, report = asyncio.run(main())
+    assert set(positions) == {0, 1, 2}
+    assert angles == pytest.approx({0: 10, 1: 20, 2: -15}, abs=0.1)
+    assert sorted(report["confirmed"]) == [0, 1, 2]
+    assert report["unconfirmed"] == []
+    for node_id in range(3):
+        assert simulator.nodes[node_id].axis_state == cansimple.AXIS_STATE_IDLE
+        assert not arm[node_id].enabled
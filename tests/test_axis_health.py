@@ -0,0 +1,89 @@
+import time
+
+from Server.MotorControllerLibs.CANControlledMotors.axis_health import AxisHealth
+
+
+class Heartbeats:
+    """
+    Stands in for the Telemetry an AxisHealth listens to, sends it heartbeat samples directly
+    """
+
+    def __init__(self):
+        self.listeners = []
+
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    def send(self, node_id, axis_error=0, axis_state=1, trajectory_done=True):
+        for listener in self.listeners:
+            listener(
+                node_id,
+                "heartbeat",
+                (time.monotonic(), axis_error, axis_state, 0, trajectory_done),
+            )
+
+
+def test_heartbeats_fill_the_table():
+    heartbeats = Heartbeats()
+    health = AxisHealth(heartbeats)
+    assert health.nodes() == []
+    assert health.state(3)["age"] is None
+
+    heartbeats.send(3, axis_state=8, trajectory_done=False)
+    heartbeats.send(5, axis_error=0x4000)
+    assert health.nodes() == [3, 5]
+    state = health.state(3)
+    assert state["axis_state"] == 8
+    assert not state["trajectory_done"]
+    assert not state["stale"]
+    assert 0 <= state["age"] < 1
+    assert health.errors() == {5: 0x4000}
+    assert "age" not in health.snapshot(with_age=False)[5]
+
+
+def test_listeners_hear_about_changes_only():
+    heartbeats = Heartbeats()
+    health = AxisHealth(heartbeats)
+    events = []
+    health.add_listener(lambda *event: events.append(event))
+
+    heartbeats.send(2, axis_state=1)
+    heartbeats.send(2, axis_state=1)
+    heartbeats.send(2, axis_state=8, trajectory_done=False)
+    assert events == [
+        (2, "axis_state", 0, 1),
+        (2, "trajectory_done", False, True),
+        (2, "axis_state", 1, 8),
+        (2, "trajectory_done", True, False),
+    ]
+
+
+def test_silent_nodes_go_stale_and_come_back():
+    heartbeats = Heartbeats()
+    health = AxisHealth(heartbeats, stale_after=0.05, check_interval=0.01)
+    events = []
+    health.add_listener(
+        lambda node_id, field, old, new: field == "stale"
+        and events.append((node_id, new))
+    )
+
+    heartbeats.send(1)
+    time.sleep(0.2)
+    assert health.stale_nodes() == [1]
+    assert events == [(1, True)]
+
+    heartbeats.send(1)
+    assert health.stale_nodes() == []
+    assert events == [(1, True), (1, False)]
+
+
+def test_publish_rebuilds_on_change_without_the_age():
+    heartbeats = Heartbeats()
+    health = AxisHealth(heartbeats)
+    data = {}
+    health.publish(data)
+    assert data["axis_health"] == {}
+
+    heartbeats.send(4, axis_state=8)
+    assert data["axis_health"][4]["axis_state"] == 8
+    assert "age" not in data["axis_health"][4]
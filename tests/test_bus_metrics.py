@@ -0,0 +1,107 @@
+import can
+import pytest
+
+from Server.MotorControllerLibs.CANControlledMotors import bus_metrics
+from Server.MotorControllerLibs.CANControlledMotors.bus_metrics import (
+    FRAME_BITS,
+    MAX_VALUE,
+    SUB_BUCKETS,
+    BusMetrics,
+    LatencyHistogram,
+)
+
+
+def bucket_top(value):
+    histogram = LatencyHistogram()
+    histogram.record(value)
+    # max is kept exactly, the percentile is capped by it: record a larger value to see the bucket's top
+    histogram.record(MAX_VALUE)
+    return histogram.percentile(50)
+
+
+def test_small_values_are_exact():
+    for value in range(2 * SUB_BUCKETS):
+        assert bucket_top(value) == value
+
+
+@pytest.mark.parametrize("value", [64, 65, 100, 1000, 12345, 999_999, 2**30 + 7])
+def test_buckets_hold_their_value_within_the_resolution(value):
+    top = bucket_top(value)
+    assert value <= top <= value * (1 + 1 / SUB_BUCKETS)
+
+
+def test_bucket_edges():
+    # 64 to 127 are counted in pairs, 128 to 255 in fours
+    assert bucket_top(64) == 65
+    assert bucket_top(65) == 65
+    assert bucket_top(128) == 131
+    assert bucket_top(131) == 131
+    assert bucket_top(132) == 135
+
+
+def test_percentiles_and_summary():
+    histogram = LatencyHistogram()
+    for microseconds in range(1, 1001):
+        histogram.record(microseconds)
+    # clamped to the range
+    histogram.record(-5)
+    assert histogram.count == 1001
+    assert histogram.percentile(0) == 0
+    assert 500 <= histogram.percentile(50) <= 500 * (1 + 1 / SUB_BUCKETS)
+    assert 990 <= histogram.percentile(99) <= 1000
+    assert histogram.percentile(100) == 1000
+    summary = histogram.summary()
+    assert summary["max_ms"] == 1.0
+    assert summary["mean_ms"] == pytest.approx(500500 / 1001 / 1e3)
+    assert LatencyHistogram().summary()["p99_ms"] == 0
+
+
+def test_frames_are_counted_per_direction_and_node():
+    metrics = BusMetrics(250000)
+    metrics.tap(can.Message(arbitration_id=3 << 5 | 0x09, data=b"\x00" * 8), False)
+    metrics.tap(can.Message(arbitration_id=3 << 5 | 0x04, data=b"\x00" * 8), True)
+    metrics.tap(can.Message(arbitration_id=5 << 5 | 0x0C, data=b"\x00" * 4), True)
+    assert metrics.frames == [1, 2]
+    assert metrics.bits == [FRAME_BITS[8], FRAME_BITS[8] + FRAME_BITS[4]]
+    stats = metrics.stats()
+    assert stats["frames"]["per_node"] == {
+        3: {"received": 1, "sent": 1},
+        5: {"received": 0, "sent": 1},
+    }
+    assert stats["interface_load"] is None
+
+
+def test_round_trips_are_kept_per_endpoint_node_and_opcode():
+    metrics = BusMetrics(250000)
+    metrics.round_trip(1, 200, 0, 0.002)
+    metrics.round_trip(2, 200, 1, 0.004)
+    round_trips = metrics.stats({200: "axis0.pos_estimate"})["round_trips"]
+    assert round_trips["endpoint"]["axis0.pos_estimate"]["count"] == 2
+    assert round_trips["node"][2]["max_ms"] == 4.0
+    assert set(round_trips["opcode"]) == {"read", "write"}
+
+
+def test_interface_readings_are_kept_per_caller(tmp_path, monkeypatch):
+    statistics = tmp_path / "can0"
+    statistics.mkdir()
+
+    def counters(packets, data_bytes):
+        for direction in ("rx", "tx"):
+            (statistics / f"{direction}_packets").write_text(str(packets))
+            (statistics / f"{direction}_bytes").write_text(str(data_bytes))
+
+    monkeypatch.setattr(
+        bus_metrics, "INTERFACE_STATISTICS", str(tmp_path / "{}" / "{}")
+    )
+    metrics = BusMetrics(250000, "can0")
+    counters(0, 0)
+    assert metrics.interface_utilization("publish") is None
+    assert metrics.interface_utilization() is None
+
+    counters(100, 800)
+    # someone asking in between doesn't cut the publisher's window short
+    assert metrics.interface_utilization()["frames_per_second"] > 0
+    load = metrics.interface_utilization("publish")
+    assert load is not None
+    assert load["frames_per_second"] > 0
+    assert load["utilization"] <= load["utilization_max"]
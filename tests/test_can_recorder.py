@@ -0,0 +1,65 @@
+import can
+import numpy as np
+import pytest
+
+from Server.MotorControllerLibs.CANControlledMotors import can_recorder
+from Server.MotorControllerLibs.CANControlledMotors.can_functions import (
+    get_property_value,
+)
+
+VEL_LIMIT = "axis0.trap_traj.config.vel_limit"
+
+
+def test_recording_round_trip(simulator, tmp_path):
+    path = tmp_path / "read.canrec"
+    with can_recorder.record_to(str(path)) as recorder:
+        value = get_property_value(VEL_LIMIT, 2, timeout=2)
+    assert recorder.frames >= 2
+
+    channels, records = can_recorder.load(str(path))
+    assert channels == [simulator.channel]
+    assert records.dtype == can_recorder.record_dtype
+    assert len(records) == recorder.frames
+    assert np.all(np.diff(records["timestamp_ns"].astype(np.int64)) >= 0)
+
+    frames = can_recorder.decode(records, channels)
+    request = next(frame for frame in frames if frame["command"] == "RxSdo")
+    assert request["direction"] == "tx"
+    assert request["node_id"] == 2
+    assert request["opcode"] == "read"
+    assert request["endpoint"] == VEL_LIMIT
+    reply = next(frame for frame in frames if frame["command"] == "TxSdo")
+    assert reply["direction"] == "rx"
+    assert reply["endpoint"] == VEL_LIMIT
+    assert np.frombuffer(reply["data"][4:8], "<f4")[0] == value
+    assert VEL_LIMIT in can_recorder.describe(reply)
+
+
+def test_load_refuses_other_files(tmp_path):
+    path = tmp_path / "not.canrec"
+    path.write_bytes(b"\x00" * can_recorder.HEADER_SIZE)
+    with pytest.raises(ValueError):
+        can_recorder.load(str(path))
+
+
+def test_replay_sends_the_recorded_frames(simulator, tmp_path, channel):
+    path = tmp_path / "replay.canrec"
+    with can_recorder.record_to(str(path)):
+        get_property_value(VEL_LIMIT, 0, timeout=2)
+    _, records = can_recorder.load(str(path))
+    sent = records[(records["flags"] & can_recorder.FLAG_TRANSMITTED).astype(bool)]
+
+    target = channel + "-replay"
+    listener = can.Bus(target, interface="virtual")
+    try:
+        count = can_recorder.replay(
+            str(path), {simulator.channel: target}, transmitted=True, speed=10
+        )
+        assert count == len(sent)
+        replayed = [listener.recv(1) for _ in range(count)]
+    finally:
+        listener.shutdown()
+    assert [msg.arbitration_id for msg in replayed] == sent["arbitration_id"].tolist()
+    assert [bytes(msg.data) for msg in replayed] == [
+        bytes(row["data"][: row["dlc"]]) for row in sent
+    ]
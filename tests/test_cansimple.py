@@ -0,0 +1,30 @@
+from Server.MotorControllerLibs.CANControlledMotors import cansimple
+
+
+def test_input_pos_data_layout():
+    data = cansimple.input_pos_data(1.25, vel_ff=2.0, torque_ff=-0.5)
+    assert len(data) == 8
+    assert cansimple.input_pos.unpack(data) == (1.25, 2000, -500)
+
+
+def test_input_pos_data_rounds_and_clips_feedforward():
+    assert cansimple.input_pos.unpack(cansimple.input_pos_data(0, 0.0014))[1] == 1
+    assert cansimple.input_pos.unpack(cansimple.input_pos_data(0, 0.0016))[1] == 2
+    _, vel_ff, torque_ff = cansimple.input_pos.unpack(
+        cansimple.input_pos_data(0, 1e6, -1e6)
+    )
+    assert (vel_ff, torque_ff) == (cansimple.INT16_MAX, cansimple.INT16_MIN)
+
+
+def test_stop_commands_go_in_the_safety_class(simulator):
+    from Server.MotorControllerLibs.CANControlledMotors.can_functions import (
+        get_bus_manager,
+    )
+
+    manager = get_bus_manager(0)
+    cansimple.set_axis_state(0, cansimple.AXIS_STATE_IDLE).result(1)
+    cansimple.estop(0).result(1)
+    cansimple.set_axis_state(0, cansimple.AXIS_STATE_CLOSED_LOOP_CONTROL).result(1)
+    stats = manager.tx_stats()
+    assert stats["safety"]["sent"] == 2
+    assert stats["motion"]["sent"] == 1
@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+
+from gpio_backend import (
+    HIGH,
+    LOW,
+    PULSE_NS,
+    RecordingBackend,
+    edge_dtype,
+    merge_trains,
+    step_train,
+)
+from stepper_motor_controller import StepperMotor
+
+
+def test_step_train_has_a_pulse_per_step():
+    edges = step_train(7, np.array([0, 1000, 5000], dtype=np.int64))
+    assert edges.dtype == edge_dtype
+    assert edges["time_ns"].tolist() == [
+        0,
+        PULSE_NS,
+        1000,
+        1000 + PULSE_NS,
+        5000,
+        5000 + PULSE_NS,
+    ]
+    assert edges["level"].tolist() == [HIGH, LOW] * 3
+    assert set(edges["pin"].tolist()) == {7}
+
+
+def test_merged_trains_are_sorted_and_stable():
+    first = step_train(1, np.array([0, 10_000], dtype=np.int64))
+    second = step_train(2, np.array([0, 5_000], dtype=np.int64))
+    edges = merge_trains([first, second])
+    assert np.all(np.diff(edges["time_ns"]) >= 0)
+    # edges at the same time keep the order of the trains
+    assert edges["pin"][:2].tolist() == [1, 2]
+    assert len(merge_trains([])) == 0
+
+
+def test_recording_backend_plays_the_train_in_time():
+    backend = RecordingBackend()
+    times = np.arange(1, 21, dtype=np.int64) * 500_000
+    lateness = backend.send(step_train(3, times))
+    edges = backend.edges(3)
+    assert len(edges) == 2 * len(times)
+    rising = edges["time_ns"][edges["level"] == HIGH]
+    # edges go out at or after their deadline, never before
+    assert np.all(np.diff(rising) >= 400_000)
+    assert np.all(lateness >= 0)
+    backend.clear()
+    assert len(backend.edges()) == 0
+
+
+def test_motor_steps_through_its_backend():
+    backend = RecordingBackend()
+    motor = StepperMotor([4, 5, 0, [8, 9]], backend)
+    motor.max_speed = 3600
+    motor.acceleration = 360_000
+    motor.set_step(-25, blocking=True)
+    assert len(backend.edges(4)) == 50
+    # the direction pin was set before the first step
+    direction = backend.edges(5)
+    assert direction["level"][-1] == LOW
+    assert direction["time_ns"][-1] <= backend.edges(4)["time_ns"][0]
+    assert motor.steps == -25
+    assert len(motor.lateness) == 25
+
+
+def test_pigpio_pulses_combine_edges_at_the_same_time():
+    pigpio = pytest.importorskip("pigpio")
+    from gpio_backend import PigpioBackend
+
+    # only the conversion, no daemon needed
+    backend = PigpioBackend.__new__(PigpioBackend)
+    backend._pigpio = pigpio
+    edges = merge_trains(
+        [
+            step_train(1, np.array([1_000, 11_000], dtype=np.int64)),
+            step_train(2, np.array([1_000], dtype=np.int64)),
+        ]
+    )
+    pulses = backend.pulses(edges)
+    # a leading delay, both pins up together, both down together, pin 1 up and down again
+    assert [(p.gpio_on, p.gpio_off, p.delay) for p in pulses] == [
+        (0, 0, 1),
+        (0b110, 0, 2),
+        (0, 0b110, 8),
+        (0b10, 0, 2),
+        (0, 0b10, 0),
+    ]
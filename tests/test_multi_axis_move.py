@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+from Server.MotorControllerLibs.CANControlledMotors.multi_axis_move import (
+    trapezoid_duration,
+)
+from Server.MotorControllerLibs.CANControlledMotors.odrive_simulator import (
+    TrapezoidalTrajectory,
+)
+
+
+def test_trapezoid_duration_zero_and_sign():
+    assert trapezoid_duration(0, 2, 4, 4) == 0.0
+    assert trapezoid_duration(-3, 2, 4, 4) == trapezoid_duration(3, 2, 4, 4)
+
+
+def test_trapezoid_duration_trapezoid_and_triangle():
+    # 0.5 s up to 2 rev/s and 0.25 s down cover 0.75 rev, the other 2.25 at 2 rev/s
+    assert trapezoid_duration(3, 2, 4, 8) == pytest.approx(0.75 + 2.25 / 2)
+    # too short to reach the limit: peak sqrt(2 d a) for equal ramps
+    assert trapezoid_duration(0.25, 2, 4, 4) == pytest.approx(2 * np.sqrt(0.25 * 4) / 4)
+
+
+def test_trapezoid_duration_continuous_at_the_limit():
+    ramps = 2 * 2 / 2 * (1 / 4 + 1 / 8)
+    below = trapezoid_duration(ramps * (1 - 1e-9), 2, 4, 8)
+    above = trapezoid_duration(ramps * (1 + 1e-9), 2, 4, 8)
+    assert below == pytest.approx(above, rel=1e-6)
+
+
+@pytest.mark.parametrize(
+    "distance, vel, accel, decel",
+    [(3, 2, 4, 8), (0.25, 2, 4, 4), (10, 5, 2, 3), (-6, 1.5, 6, 2)],
+)
+def test_trapezoid_duration_matches_the_simulated_planner(distance, vel, accel, decel):
+    trajectory = TrapezoidalTrajectory(0.0, 0.0, distance, vel, accel, decel)
+    assert trapezoid_duration(distance, vel, accel, decel) == pytest.approx(
+        trajectory.duration, rel=1e-9
+    )
@@ -0,0 +1,49 @@
+import pytest
+
+from Server.MotorControllerLibs.CANControlledMotors import cansimple
+from Server.MotorControllerLibs.CANControlledMotors.can_functions import (
+    prepare_endpoint,
+)
+
+
+def test_simulator_reads(simulator):
+    vel_limit = prepare_endpoint("axis0.trap_traj.config.vel_limit")
+    expected = simulator.nodes[0].value("axis0.trap_traj.config.vel_limit")
+    futures = [
+        vel_limit.request_read(node_id) for node_id in range(3) for _ in range(4)
+    ]
+    assert [future.result(2) for future in futures] == pytest.approx(
+        [expected] * len(futures)
+    )
+
+
+def test_commands_reach_the_simulator(simulator, wait_until):
+    node = simulator.nodes[1]
+    cansimple.set_traj_vel_limit(1, 3.5).result(1)
+    cansimple.set_traj_accel_limits(1, 7.0, 9.0).result(1)
+    cansimple.set_controller_mode(
+        1, cansimple.CONTROL_MODE_POSITION, cansimple.INPUT_MODE_PASSTHROUGH
+    ).result(1)
+    cansimple.set_absolute_position(1, 0.5).result(1)
+    cansimple.set_axis_state(1, cansimple.AXIS_STATE_CLOSED_LOOP_CONTROL).result(1)
+
+    assert wait_until(
+        lambda: node.axis_state == cansimple.AXIS_STATE_CLOSED_LOOP_CONTROL
+    )
+    assert node.value("axis0.trap_traj.config.vel_limit") == 3.5
+    assert node.value("axis0.trap_traj.config.accel_limit") == 7.0
+    assert node.value("axis0.trap_traj.config.decel_limit") == 9.0
+    assert (
+        node.value("axis0.controller.config.input_mode")
+        == cansimple.INPUT_MODE_PASSTHROUGH
+    )
+    assert node.pos == 0.5
+
+    cansimple.set_input_pos(1, 2.25).result(1)
+    assert wait_until(lambda: node.pos == 2.25)
+
+    cansimple.estop(1).result(1)
+    assert wait_until(lambda: node.axis_state == cansimple.AXIS_STATE_IDLE)
+    assert node.axis_error
+    cansimple.clear_errors(1).result(1)
+    assert wait_until(lambda: node.axis_error == 0)
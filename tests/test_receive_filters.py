@@ -0,0 +1,70 @@
+import struct
+
+import can
+
+from Server.MotorControllerLibs.CANControlledMotors.bus_manager import (
+    CMD_TX_SDO,
+    OPCODE_READ,
+    arbitration_id,
+    sdo_header,
+)
+
+HEARTBEAT = arbitration_id(1, 0x01)
+ENCODER = arbitration_id(1, 0x09)
+float_reply = struct.Struct("<BHBf")
+
+
+def send(peer, arb_id, data=b"\x00" * 8):
+    peer.send(can.Message(arbitration_id=arb_id, data=data, is_extended_id=False))
+
+
+def test_only_subscribed_ids_are_received(manager, peer, wait_until):
+    heartbeats = []
+    manager.subscribe(HEARTBEAT, heartbeats.append)
+    assert manager.rx_stats()["filters"] == 1
+
+    send(peer, ENCODER)
+    send(peer, HEARTBEAT)
+    assert wait_until(lambda: len(heartbeats) == 1)
+    stats = manager.rx_stats()
+    assert stats["received"] == 1
+    assert stats["used"] == 1
+
+
+def test_filters_follow_the_subscriptions(manager, peer, wait_until):
+    heartbeats = []
+    encoders = []
+    manager.subscribe(HEARTBEAT, heartbeats.append)
+    manager.subscribe(ENCODER, encoders.append)
+    assert manager.rx_stats()["filters"] == 2
+
+    manager.unsubscribe(ENCODER, encoders.append)
+    assert manager.rx_stats()["filters"] == 1
+    send(peer, ENCODER)
+    send(peer, HEARTBEAT)
+    assert wait_until(lambda: len(heartbeats) == 1)
+    assert encoders == []
+    assert manager.rx_stats()["received"] == 1
+
+
+def test_sdo_replies_stay_in_the_filters(manager, peer):
+    manager.subscribe(HEARTBEAT, lambda msg: None)
+    future = manager.sdo_request(1, 7, sdo_header.pack(OPCODE_READ, 7, 0), float_reply)
+    assert manager.rx_stats()["filters"] == 2
+    assert peer.recv(1) is not None
+
+    send(peer, arbitration_id(1, CMD_TX_SDO), float_reply.pack(0, 7, 0, 2.5))
+    assert future.result(1) == 2.5
+    # replies come and go too fast to change the filters for every request
+    assert manager.rx_stats()["filters"] == 2
+
+
+def test_filters_off_receives_everything(manager, peer, wait_until):
+    manager.subscribe(HEARTBEAT, lambda msg: None)
+    manager.set_receive_filters(False)
+    assert manager.rx_stats()["filters"] is None
+
+    send(peer, ENCODER)
+    send(peer, HEARTBEAT)
+    assert wait_until(lambda: manager.rx_stats()["received"] == 2)
+    assert manager.rx_stats()["used"] == 1
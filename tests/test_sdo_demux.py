@@ -0,0 +1,133 @@
+import struct
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import can
+import pytest
+
+from Server.MotorControllerLibs.CANControlledMotors.bus_manager import (
+    CMD_TX_SDO,
+    OPCODE_READ,
+    RX_SDO_IDS,
+    arbitration_id,
+    sdo_header,
+)
+
+NODE = 1
+ENDPOINT = 7
+float_reply = struct.Struct("<BHBf")
+
+
+def read_frame(endpoint=ENDPOINT):
+    return sdo_header.pack(OPCODE_READ, endpoint, 0)
+
+
+def reply(peer, value, endpoint=ENDPOINT, node=NODE):
+    peer.send(
+        can.Message(
+            arbitration_id=arbitration_id(node, CMD_TX_SDO),
+            data=float_reply.pack(0, endpoint, 0, value),
+            is_extended_id=False,
+        )
+    )
+
+
+def received(peer, timeout=0.05):
+    """
+    :return: list of the frames the peer got within timeout of each other
+    """
+    frames = []
+    msg = peer.recv(timeout)
+    while msg is not None:
+        frames.append(msg)
+        msg = peer.recv(timeout)
+    return frames
+
+
+def test_reply_resolves_request(manager, peer):
+    future = manager.sdo_request(NODE, ENDPOINT, read_frame(), float_reply)
+    (frame,) = received(peer)
+    assert frame.arbitration_id == RX_SDO_IDS[NODE]
+    reply(peer, 1.5)
+    assert future.result(1) == 1.5
+
+
+def test_one_request_in_flight_per_endpoint(manager, peer):
+    first = manager.sdo_request(NODE, ENDPOINT, read_frame(), float_reply)
+    second = manager.sdo_request(NODE, ENDPOINT, read_frame(), float_reply)
+    other = manager.sdo_request(
+        NODE, ENDPOINT + 1, read_frame(ENDPOINT + 1), float_reply
+    )
+    # the second request for the endpoint waits for the first one's reply, other endpoints don't
+    assert len(received(peer)) == 2
+
+    reply(peer, 1.0)
+    assert first.result(1) == 1.0
+    assert len(received(peer)) == 1
+    reply(peer, 2.0)
+    reply(peer, 3.0, ENDPOINT + 1)
+    assert second.result(1) == 2.0
+    assert other.result(1) == 3.0
+
+
+def test_request_times_out(manager, peer):
+    future = manager.sdo_request(NODE, ENDPOINT, read_frame(), float_reply)
+    with pytest.raises(TimeoutError):
+        future.result(1)
+
+
+def test_late_reply_is_dropped(manager, peer):
+    first = manager.sdo_request(NODE, ENDPOINT, read_frame(), float_reply)
+    second = manager.sdo_request(NODE, ENDPOINT, read_frame(), float_reply)
+    with pytest.raises(TimeoutError):
+        first.result(1)
+
+    # still within twice the timeout: the reply belongs to the first request, not the second
+    reply(peer, 1.0)
+    with pytest.raises(FutureTimeoutError):
+        second.result(0.05)
+    assert len(received(peer)) == 2
+
+    reply(peer, 2.0)
+    assert second.result(1) == 2.0
+
+
+def test_cancelled_request_reply_is_dropped(manager, peer):
+    first = manager.sdo_request(NODE, ENDPOINT, read_frame(), float_reply)
+    second = manager.sdo_request(NODE, ENDPOINT, read_frame(), float_reply)
+    assert first.cancel()
+    reply(peer, 1.0)
+    with pytest.raises(FutureTimeoutError):
+        second.result(0.05)
+
+    reply(peer, 2.0)
+    assert second.result(1) == 2.0
+
+
+def test_lost_reply_frees_the_endpoint(manager, peer):
+    first = manager.sdo_request(NODE, ENDPOINT, read_frame(), float_reply)
+    second = manager.sdo_request(NODE, ENDPOINT, read_frame(), float_reply)
+    assert len(received(peer)) == 1
+    with pytest.raises(TimeoutError):
+        first.result(1)
+
+    # after twice the timeout the first reply is given up on and the second request goes out
+    assert peer.recv(2 * manager.reply_timeout) is not None
+    reply(peer, 2.0)
+    assert second.result(1) == 2.0
+
+
+def test_receiver_survives_short_frames_and_failing_taps(manager, peer):
+    def failing_tap(msg, transmitted):
+        raise RuntimeError("tap failed")
+
+    manager.add_tap(failing_tap)
+    peer.send(
+        can.Message(
+            arbitration_id=arbitration_id(NODE, CMD_TX_SDO),
+            data=b"\x00",
+            is_extended_id=False,
+        )
+    )
+    future = manager.sdo_request(NODE, ENDPOINT, read_frame(), float_reply)
+    reply(peer, 4.0)
+    assert future.result(1) == 4.0
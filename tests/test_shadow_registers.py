@@ -0,0 +1,71 @@
+from Server.MotorControllerLibs.CANControlledMotors import cansimple
+from Server.MotorControllerLibs.CANControlledMotors.bus_manager import (
+    RX_SDO_IDS,
+    arbitration_id,
+)
+from Server.MotorControllerLibs.CANControlledMotors.shadow_registers import (
+    TRAJ_ACCEL_LIMIT,
+    TRAJ_DECEL_LIMIT,
+    TRAJ_VEL_LIMIT,
+    ShadowRegisters,
+)
+
+
+def test_unchanged_values_are_skipped():
+    registers = ShadowRegisters()
+    assert len(registers.frames(0, {TRAJ_VEL_LIMIT: 2.0})) == 1
+    assert registers.frames(0, {TRAJ_VEL_LIMIT: 2.0}) == []
+    # single precision on the ODrive
+    assert registers.frames(0, {TRAJ_VEL_LIMIT: 2.0000001}) == []
+    # other nodes are cached separately
+    assert len(registers.frames(1, {TRAJ_VEL_LIMIT: 2.0})) == 1
+
+    registers.forget(0)
+    assert len(registers.frames(0, {TRAJ_VEL_LIMIT: 2.0})) == 1
+
+
+def test_limits_go_out_as_cansimple_commands():
+    registers = ShadowRegisters()
+    (vel_limit,) = registers.frames(2, {TRAJ_VEL_LIMIT: 3.0})
+    assert vel_limit == (
+        arbitration_id(2, cansimple.CMD_SET_TRAJ_VEL_LIMIT),
+        cansimple.f32.pack(3.0),
+    )
+
+    # one command sets both, so a lone acceleration goes out as an SDO write until the deceleration is known
+    (accel,) = registers.frames(2, {TRAJ_ACCEL_LIMIT: 4.0})
+    assert accel[0] == RX_SDO_IDS[2]
+    registers.record(2, TRAJ_DECEL_LIMIT, 6.0)
+    (limits,) = registers.frames(2, {TRAJ_ACCEL_LIMIT: 5.0})
+    assert limits == (
+        arbitration_id(2, cansimple.CMD_SET_TRAJ_ACCEL_LIMITS),
+        cansimple.two_f32.pack(5.0, 6.0),
+    )
+
+
+def test_transaction_restores_the_limits(simulator, wait_until):
+    registers = ShadowRegisters()
+    node = simulator.nodes[0]
+    registers.record(0, TRAJ_VEL_LIMIT, node.value(TRAJ_VEL_LIMIT))
+    before = node.value(TRAJ_VEL_LIMIT)
+
+    with registers.transaction() as transaction:
+        transaction.set(0, TRAJ_VEL_LIMIT, before + 1.5)
+        # nothing goes out before send
+        assert node.value(TRAJ_VEL_LIMIT) == before
+        assert transaction.send() == 1
+        assert wait_until(lambda: node.value(TRAJ_VEL_LIMIT) == before + 1.5)
+
+    assert wait_until(lambda: node.value(TRAJ_VEL_LIMIT) == before)
+    assert registers.known(0, TRAJ_VEL_LIMIT) == before
+    assert transaction.frames_sent == 2
+
+
+def test_transaction_without_restore_keeps_the_values(simulator, wait_until):
+    registers = ShadowRegisters()
+    node = simulator.nodes[1]
+    with registers.transaction(restore=False) as transaction:
+        transaction.set(1, TRAJ_VEL_LIMIT, 7.25)
+    assert wait_until(lambda: node.value(TRAJ_VEL_LIMIT) == 7.25)
+    assert registers.known(1, TRAJ_VEL_LIMIT) == 7.25
+    assert transaction.frames_sent == 1
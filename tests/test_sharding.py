@@ -0,0 +1,60 @@
+import pytest
+
+from Server.MotorControllerLibs.CANControlledMotors import can_functions, cansimple
+from Server.MotorControllerLibs.CANControlledMotors.odrive_simulator import (
+    OdriveSimulator,
+)
+
+VEL_LIMIT = "axis0.trap_traj.config.vel_limit"
+
+
+@pytest.fixture
+def second_bus(simulator, channel, monkeypatch):
+    """
+    :return: OdriveSimulator with node 3 on a second channel, node 3 is put on it but the channel isn't connected
+    """
+    other = channel + "-b"
+    second = OdriveSimulator([3], channel=other, reply_latency=0.001)
+    second.start()
+    monkeypatch.setitem(can_functions.NODE_CHANNELS, 3, other)
+    yield second
+    # before the simulator fixture's shutdown, so the bus opened on first use is closed first
+    can_functions.shutdown()
+    second.stop()
+
+
+def test_nodes_use_their_own_bus(simulator, second_bus, wait_until):
+    # node 3 isn't on the default bus's simulator, a request sent there would go unanswered
+    values = can_functions.read_many([(VEL_LIMIT, n) for n in (0, 3, 1)], timeout=2)
+    assert values == pytest.approx(
+        [
+            simulator.nodes[0].value(VEL_LIMIT),
+            second_bus.nodes[3].value(VEL_LIMIT),
+            simulator.nodes[1].value(VEL_LIMIT),
+        ]
+    )
+    # opened on first use with the default bus's interface
+    assert set(can_functions.get_bus_managers()) == {
+        simulator.channel,
+        second_bus.channel,
+    }
+    assert can_functions.get_bus_manager(3) is not can_functions.get_bus_manager(0)
+
+
+def test_bursts_are_split_by_bus(simulator, second_bus, wait_until):
+    can_functions.send_burst(
+        [
+            (
+                0 << 5 | cansimple.CMD_SET_TRAJ_VEL_LIMIT,
+                cansimple.f32.pack(4.5),
+            ),
+            (
+                3 << 5 | cansimple.CMD_SET_TRAJ_VEL_LIMIT,
+                cansimple.f32.pack(5.5),
+            ),
+        ]
+    )
+    assert wait_until(lambda: simulator.nodes[0].value(VEL_LIMIT) == 4.5)
+    assert wait_until(lambda: second_bus.nodes[3].value(VEL_LIMIT) == 5.5)
+    assert can_functions.get_bus_manager(0).tx_stats()["config"]["sent"] == 1
+    assert can_functions.get_bus_manager(3).tx_stats()["config"]["sent"] == 1
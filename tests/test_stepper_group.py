@@ -0,0 +1,52 @@
+import pytest
+
+from stepper_group import StepperGroup
+from stepper_motor_controller import StepperMotor
+
+
+def fast_motor(step_pin):
+    motor = StepperMotor([step_pin, step_pin + 1, 0, [5, 6]])
+    motor.max_speed = 3600
+    motor.acceleration = 360_000
+    return motor
+
+
+@pytest.fixture
+def motors():
+    return [fast_motor(pin) for pin in (20, 22, 24)]
+
+
+def test_group_moves_every_motor(motors):
+    group = StepperGroup(motors)
+    moves = group.move_steps(
+        {motors[0]: 120, motors[1]: -45, motors[2]: 0}, blocking=True
+    )
+    # the motor with nowhere to go gets no move
+    assert len(moves) == 2
+    assert [motor.steps for motor in motors] == [120, -45, 0]
+    assert not group.moving()
+    assert not any(motor.moving for motor in motors)
+
+
+def test_synchronized_moves_finish_together(motors):
+    group = StepperGroup(motors)
+    first, second = group.move_steps({motors[0]: 300, motors[1]: 30}, blocking=True)
+    assert first.deadlines[-1] == second.deadlines[-1]
+    assert len(first.lateness) == 300
+    assert len(second.lateness) == 30
+
+
+def test_unsynchronized_moves_keep_their_own_profile(motors):
+    group = StepperGroup(motors)
+    long, short = group.move_steps(
+        {motors[0]: 300, motors[1]: 30}, synchronized=False, blocking=True
+    )
+    assert short.deadlines[-1] < long.deadlines[-1]
+
+
+def test_a_moving_motor_finishes_first(motors):
+    group = StepperGroup(motors)
+    group.move_steps({motors[0]: 200})
+    group.move({motors[0]: 0})
+    assert group.wait(5)
+    assert motors[0].steps == 0
@@ -0,0 +1,67 @@
+import pytest
+
+from stepper_motor_controller import StepperMotor
+
+PINS = [1, 12, 0, [5, 6]]
+
+
+@pytest.fixture
+def motor():
+    """
+    :return: StepperMotor fast enough for moves to take a few ms
+    """
+    motor = StepperMotor(PINS)
+    motor.max_speed = 3600
+    motor.acceleration = 360_000
+    return motor
+
+
+def test_moves_count_whole_steps(motor):
+    motor.set_step(40, blocking=True)
+    assert motor.steps == 40
+    motor.set_position(-9, blocking=True)
+    assert motor.steps == motor.degrees_to_steps(-9)
+    assert motor.current_position == pytest.approx(-9)
+    assert not motor.moving
+
+
+def test_no_drift_over_many_moves(motor):
+    for position in [0.1, 33.3, -7.77, 180.05, -0.01] * 4:
+        motor.set_position(position, blocking=True)
+    motor.set_position(0, blocking=True)
+    assert motor.steps == 0
+    assert motor.current_position == 0
+
+
+def test_micro_stepping_rescales_the_count(motor):
+    motor.set_step(6, blocking=True)
+    position = motor.current_position
+    motor.set_micro_stepping(8)
+    assert motor.steps == 3
+    motor.set_micro_stepping(64)
+    assert motor.steps == 24
+    motor.set_micro_stepping(16)
+    assert motor.steps == 6
+    assert motor.current_position == pytest.approx(position)
+
+
+@pytest.mark.parametrize("steps", [3, -3, 1, -1])
+def test_coarser_micro_stepping_between_steps_is_refused(motor, steps):
+    motor.set_step(steps, blocking=True)
+    with pytest.raises(ValueError):
+        motor.set_micro_stepping(8)
+    assert motor.steps == steps
+    assert motor.micro_stepping == 16
+
+
+def test_micro_stepping_refused_while_moving(motor):
+    motor.acceleration = 3600
+    motor.set_step(200)
+    assert motor.moving
+    with pytest.raises(ValueError):
+        motor.set_micro_stepping(32)
+    motor.set_step(0, blocking=True)
+    assert not motor.moving
+    assert motor.steps == 0
+    motor.set_micro_stepping(32)
+    assert motor.micro_stepping == 32
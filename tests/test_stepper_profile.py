@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from stepper_profile import step_intervals, step_times
+
+
+def test_step_times_no_steps():
+    assert len(step_times(0, 100, 1000)) == 0
+
+
+@pytest.mark.parametrize("steps", [1, 2, 7, 100, 5000])
+def test_step_times_one_per_step_in_order(steps):
+    times = step_times(steps, 400, 2000)
+    assert times.dtype == np.int64
+    assert len(times) == steps
+    assert np.all(step_intervals(times) > 0)
+
+
+def test_step_times_ignores_the_sign():
+    assert np.array_equal(step_times(-300, 400, 2000), step_times(300, 400, 2000))
+
+
+@pytest.mark.parametrize("steps", [50, 3000])
+def test_step_times_symmetric(steps):
+    # a profile ends as long after its last step as its first step is after the start
+    times = step_times(steps, 400, 2000)
+    end = times[0] + times[-1]
+    assert np.allclose(times + times[::-1], end, atol=2)
+
+
+@pytest.mark.parametrize(
+    "steps, max_speed, acceleration",
+    [(3000, 400, 2000), (50, 400, 2000), (10000, 1000, 500)],
+)
+def test_step_times_within_limits(steps, max_speed, acceleration):
+    times = step_times(steps, max_speed, acceleration) / 1e9
+    # one step per interval, so the mean speed over it can't beat the trapezoid at its midpoint
+    midpoints = (times[1:] + times[:-1]) / 2
+    end = times[0] + times[-1]
+    envelope = np.minimum(
+        np.minimum(acceleration * midpoints, max_speed),
+        acceleration * (end - midpoints),
+    )
+    assert np.all(1 / np.diff(times) <= envelope * 1.01)
+
+
+def test_step_times_cruise_duration():
+    # reaches 400 steps/s after 0.2 s and 40 steps, cruises the 920 in between
+    times = step_times(1000, 400, 2000)
+    assert (times[0] + times[-1]) / 1e9 == pytest.approx(0.4 + 920 / 400, rel=1e-6)
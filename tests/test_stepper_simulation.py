@@ -0,0 +1,77 @@
+from time import perf_counter
+
+import numpy as np
+import pytest
+
+from gpio_backend import RecordingBackend, VirtualClock
+from stepper_group import StepperGroup
+from stepper_simulation import check, regression, run, sample, simulated_motor, trace
+
+
+def test_virtual_clock_only_moves_forward():
+    clock = VirtualClock(5)
+    clock.sleep_until(3)
+    assert clock.now() == 5
+    clock.sleep_until(1_000_000_000)
+    assert clock.now() == 1_000_000_000
+
+
+def test_a_long_move_takes_no_time():
+    # at the StepperConstants limits a half turn is over 20 s of motion
+    motor = simulated_motor()
+    wall = perf_counter()
+    run(motor, [180])
+    wall = perf_counter() - wall
+    steps = trace(motor)
+    assert motor.steps == motor.degrees_to_steps(180)
+    assert steps["steps"][-1] == motor.steps
+    assert steps["time_ns"][-1] / 1e9 > 20
+    assert wall < 2
+    assert check(steps, motor.max_speed, motor.acceleration) == []
+
+
+def test_trace_follows_the_direction_of_each_move():
+    motor = simulated_motor(90, 900)
+    run(motor, [45, -45, 0], pause=0.25)
+    steps = trace(motor)
+    assert motor.steps == 0
+    assert steps["steps"].max() == motor.degrees_to_steps(45)
+    assert steps["steps"].min() == motor.degrees_to_steps(-45)
+    times, positions, velocities = sample(steps, 0.05)
+    assert len(times) == len(positions) == len(velocities)
+    assert np.all(np.abs(velocities) <= 90 * 1.01)
+
+
+def test_check_catches_a_profile_over_its_limits():
+    motor = simulated_motor(90, 900)
+    run(motor, [90])
+    # the same trace against half the speed limit
+    assert check(trace(motor), 45, 900) != []
+
+
+def test_regression():
+    assert regression(200, seed=1) == []
+
+
+def test_batched_group_moves_start_after_the_train_before():
+    backend = RecordingBackend(VirtualClock())
+    motors = [simulated_motor() for _ in range(2)]
+    for motor in motors:
+        motor.backend = backend
+    group = StepperGroup(motors, backend)
+    assert group._thread is None
+
+    (first,) = group.move_steps({motors[0]: 500})
+    (second,) = group.move_steps({motors[1]: -300})
+    assert group.wait(5)
+    assert second.deadlines[0] > first.deadlines[-1]
+    assert [motor.steps for motor in motors] == [500, -300]
+    assert motors[1].step_now() == (-300, 0)
+
+
+@pytest.mark.parametrize("micro_stepping", [8, 32])
+def test_simulated_micro_stepping(micro_stepping):
+    motor = simulated_motor(micro_stepping=micro_stepping)
+    run(motor, [10])
+    assert motor.steps == motor.degrees_to_steps(10)
+    assert motor.current_position == pytest.approx(10, abs=motor.step_angle)